@@ -35,6 +35,9 @@ Commands:
     jobdelete
         Remove OnRamp job run from environment.
 
+    statemigrate
+        Copy module and job state from one state backend to another.
+
     shell
         Initializes an interactive python shell in the OnRamp PCE environment.
 """
@@ -52,10 +55,12 @@ from validate import Validator
 from os.path import abspath, expanduser
 
 from PCE import tools
+from PCE.tools.config import get_pce_config
 from PCE.tools.jobs import init_job_delete, job_init_state, job_preprocess, \
                            job_run, get_jobs
 from PCE.tools.modules import deploy_module, get_source_types, \
                               init_module_delete, install_module, ModState
+from PCE.tools.state import migrate_state
 from PCEHelper import pce_root
 
 _pidfile = os.path.join(pce_root, 'src', '.onrampRESTservice.pid')
@@ -570,6 +575,42 @@ def _job_delete():
 
     sys.exit(result)
 
+def _state_migrate():
+    """Copy module and job state from one state backend to another.
+
+    Usage: onramp_pce_service.py statemigrate [-h] [-v] {json,sqlite}
+                                              {json,sqlite}
+
+    positional arguments:
+      {json,sqlite}  state backend to copy from
+      {json,sqlite}  state backend to copy to
+
+    optional arguments:
+      -h, --help     show this help message and exit
+      -v, --verbose  increase output verbosity
+    """
+    descrip = 'Copy module and job state from one state backend to another.'
+    parser = argparse.ArgumentParser(prog='onramp_pce_service.py statemigrate',
+                                     description=descrip)
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='increase output verbosity')
+    parser.add_argument('source', choices=['json', 'sqlite'],
+                        help='state backend to copy from')
+    parser.add_argument('dest', choices=['json', 'sqlite'],
+                        help='state backend to copy to')
+    args = parser.parse_args(args=sys.argv[2:])
+
+    if _getPID() > 0:
+        sys.stderr.write('Stop the REST server before migrating state.\n')
+        sys.exit(-1)
+
+    counts = migrate_state(args.source, args.dest)
+    print ('Migrated %d module(s) and %d job(s) from %s to %s'
+           % (counts['modules'], counts['jobs'], args.source, args.dest))
+    print ('Set [state] backend = %s in bin/onramp_pce_config.cfg to use the '
+           'migrated state.' % args.dest)
+    sys.exit(0)
+
 def _shell():
     """Initialize an interactive python shell in the OnRamp PCE environment.
 
@@ -598,6 +639,7 @@ switch = {
     'modready': _mod_ready,
     'joblaunch': _job_launch,
     'jobdelete': _job_delete,
+    'statemigrate': _state_migrate,
     'shell': _shell
 }
 
@@ -618,10 +660,7 @@ if __name__ == '__main__':
     }
     log_file = os.path.join(pce_root, 'log', 'onramp.log')
     log_level = 'INFO'
-    cfg = ConfigObj(os.path.join(pce_root, 'bin', 'onramp_pce_config.cfg'),
-                    configspec=os.path.join(pce_root, 'src', 'configspecs',
-                                            'onramp_pce_config.cfgspec'))
-    cfg.validate(Validator())
+    cfg = get_pce_config()
     if 'cluster' in cfg.keys():
         if 'log_level' in cfg['cluster'].keys():
             log_level = cfg['cluster']['log_level']
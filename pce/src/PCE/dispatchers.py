@@ -4,25 +4,109 @@ Exports:
     Files: Access visible files from job runs.
     Modules: View, add, update, and remove PCE educational modules.
     Jobs: Launch, update, remove, and get status of PCE jobs.
+    JobOutput: Stream output of PCE jobs.
+    JobEvents: Receive run events of PCE jobs.
+    JobWatch: Long-poll for changes to PCE jobs.
+    Events: Stream changes to PCE jobs as Server-Sent Events.
     Cluster: View cluster status.
 """
 
+import hashlib
+import json
 import logging
 import os
-from multiprocessing import Process
+import threading
 
 import cherrypy
 from cherrypy.lib.static import serve_file
 from configobj import ConfigObj
-from validate import Validator
 
 from PCE.tools import get_visible_file
-from PCE.tools.jobs import get_jobs, init_job_delete, launch_job
-from PCE.tools.modules import deploy_module, get_modules, \
-                              get_available_modules, init_module_delete, \
+from PCE.tools.config import get_configspec, get_pce_config, get_validator
+from PCE.tools.jobs import apply_run_event, expand_sweep, \
+                           follow_job_changes, follow_job_output, \
+                           get_job_changes, get_job_etag, get_job_output_file, \
+                           get_jobs, init_job_delete, launch_interrupted, \
+                           launch_job, watch_job
+from PCE.tools.lineindex import read_lines, read_tail
+from PCE.tools.modules import deploy_interrupted, deploy_module, \
+                              get_module_changes, get_module_etag, \
+                              get_modules, get_available_modules, \
+                              init_module_delete, install_interrupted, \
                               install_module
+from PCE.tools.workqueue import QueueFull, get_work_queue
 from PCEHelper import pce_root
 
+# Default and max seconds a job watch waits for a change.
+_watch_timeout = 30
+_max_watch_timeout = 300
+# Number of event streams, output follows, and job watches open, each holding
+# a server thread.
+_open_streams = 0
+_streams_lock = threading.Lock()
+
+def _open_stream():
+    """Count a new event stream, output follow, or job watch, unless
+    max_streams are open.
+
+    Sets the HTTP status to 503, with a Retry-After header, if refused.
+
+    Returns:
+        True if the stream may be opened, in which case _close_stream() must
+        be called when it ends. False otherwise.
+    """
+    global _open_streams
+    max_streams = get_pce_config()['server']['max_streams']
+    with _streams_lock:
+        if _open_streams < max_streams:
+            _open_streams += 1
+            return True
+    cherrypy.response.status = 503
+    cherrypy.response.headers['Retry-After'] = '10'
+    return False
+
+def _close_stream():
+    """Count the end of a stream opened with _open_stream()."""
+    global _open_streams
+    with _streams_lock:
+        _open_streams -= 1
+
+def _get_page(filename, lines=None, tail=None):
+    """Return a page of lines from a file for a 'lines' or 'tail' query.
+
+    Sets the X-Total-Lines response header to the number of lines in the
+    file, and the HTTP status to 400 if the query is malformed.
+
+    Args:
+        filename (str): Path of the file.
+
+    Kwargs:
+        lines (str): Range of 1-based line numbers, as FIRST-LAST.
+        tail (str): Number of lines to return from the end of the file.
+
+    Returns:
+        The requested lines or a string indicating error.
+    """
+    try:
+        if tail is not None:
+            n = int(tail)
+            if n < 0:
+                raise ValueError
+            page, total = read_tail(filename, n)
+        else:
+            first, last = [int(x) for x in lines.split('-')]
+            if first < 1 or last < first:
+                raise ValueError
+            page, total = read_lines(filename, first, last)
+    except ValueError:
+        cherrypy.response.status = 400
+        return 'Invalid lines or tail query'
+
+    cherrypy.response.headers['Content-Type'] = 'text/plain'
+    cherrypy.response.headers['X-Total-Lines'] = str(total)
+    return page
+
+
 class Files:
     """Provide access to visible files in job runs.
 
@@ -47,7 +131,8 @@ class Files:
             Ordered list of folders between base dir and specific
             file requested.
         **kwargs:
-            Unused
+            'lines' (FIRST-LAST) or 'tail' (N) return only the given lines
+            of the file.
 
         Returns:
             The requested file or a sting indicating error.
@@ -56,6 +141,10 @@ class Files:
         if result[0] == 0:
             # Good.
             cherrypy.response.headers['Content-Type'] = 'text/plain'
+            if 'lines' in kwargs or 'tail' in kwargs:
+                result[1].close()
+                return _get_page(result[1].name, kwargs.get('lines'),
+                                 kwargs.get('tail'))
         if result[0] == -1:
             # Not visible
             cherrypy.response.status = 403
@@ -70,6 +159,175 @@ class Files:
         return result[1]
 
 
+class JobOutput:
+    """Provide access to job output files, mapped to /jobs/:id/output.
+
+    Methods:
+        GET: Return or follow output of a job.
+    """
+    exposed = True
+    _cp_config = {
+        'tools.json_out.on': False,
+        'tools.json_in.on': False,
+        'response.stream': True
+    }
+
+    def __init__(self, conf, log_name):
+        """Initialize JobOutput dispatcher.
+
+        Args:
+            conf (ConfigObj): Application/server configuration object.
+            log_name (str): Name of an initialized logger to use.
+        """
+        self.conf = conf
+        self.logger = logging.getLogger(log_name)
+
+    def GET(self, id, follow=None, offset=None, lines=None, tail=None,
+            element=None, **kwargs):
+        """Return output of a job, or indication of error.
+
+        Output of finished jobs is served from the output file, with support
+        for HTTP Range requests. If the job is still running and 'follow' is
+        given, output is streamed as it is written until the job finishes.
+        Following is refused (HTTP 503) if max_streams event streams, output
+        follows, and job watches are already open.
+
+        Args:
+            id (str): Id of the job.
+
+        Kwargs:
+            follow (str): If given, follow output of a running job.
+            offset (str): Byte offset to start following output from.
+            lines (str): If given, return only lines FIRST-LAST.
+            tail (str): If given, return only the last tail lines.
+            element (str): Index of the array element to return output of,
+                for array jobs.
+            **kwargs: Unused
+
+        Returns:
+            The output or a string indicating error.
+        """
+        try:
+            job_id = int(id)
+            offset = int(offset) if offset else 0
+            if element is not None:
+                element = int(element)
+            if offset < 0:
+                raise ValueError
+        except ValueError:
+            cherrypy.response.status = 400
+            return 'Invalid job id, offset, or element'
+
+        result = get_job_output_file(job_id, element=element)
+        if result[0] < 0:
+            cherrypy.response.status = 404
+            return result[1]
+
+        if lines is not None or tail is not None:
+            return _get_page(result[1], lines, tail)
+        if follow and result[0] == 1:
+            if not _open_stream():
+                self.logger.warn('Too many streams open. Refusing to follow '
+                                 'output of job %d.' % job_id)
+                return 'Too many streams open'
+            # Run once the stream ends, including when the client disconnects.
+            cherrypy.request.hooks.attach('on_end_request', _close_stream)
+            cherrypy.response.headers['Content-Type'] = 'text/plain'
+            return follow_job_output(job_id, offset=offset, element=element)
+        return serve_file(result[1], 'text/plain')
+
+
+class Events:
+    """Stream changes to jobs as Server-Sent Events, mapped to /events.
+
+    Methods:
+        GET: Stream job changes.
+    """
+    exposed = True
+    _cp_config = {
+        'tools.json_out.on': False,
+        'tools.json_in.on': False,
+        'response.stream': True
+    }
+
+    def __init__(self, conf, log_name):
+        """Initialize Events dispatcher.
+
+        Args:
+            conf (ConfigObj): Application/server configuration object.
+            log_name (str): Name of an initialized logger to use.
+        """
+        self.conf = conf
+        self.logger = logging.getLogger(log_name)
+
+    def GET(self, since=None, state=None, username=None, mod_id=None,
+            **kwargs):
+        """Stream changes to jobs as they are stored.
+
+        Each changed job is sent as a 'job' event with the job as its JSON
+        data, and each deleted job as a 'job_deleted' event with data
+        {"job_id": ID}. The last event of each batch of changes has the change
+        journal sequence number as its id, so EventSource clients resume
+        where they left off, via Last-Event-ID, when they reconnect. A comment
+        is sent every 15 seconds without changes, and the stream ends after an
+        hour. The stream is refused (HTTP 503) if max_streams event streams,
+        output follows, and job watches are already open.
+
+        Kwargs:
+            since (str): Sequence number of the last change already seen,
+                overridden by the Last-Event-ID header. 0 starts with all
+                jobs. If neither is given, the stream starts with the next
+                change.
+            state (str): Only send jobs changed to this state.
+            username (str): Only send jobs of this user.
+            mod_id (str): Only send jobs of this module.
+            **kwargs: Unused
+
+        Returns:
+            Generator of the event stream, or a string indicating error.
+        """
+        since = cherrypy.request.headers.get('Last-Event-ID', since)
+        try:
+            if since is not None:
+                since = int(since)
+                if since < 0:
+                    raise ValueError
+            if mod_id is not None:
+                mod_id = int(mod_id)
+        except ValueError:
+            cherrypy.response.status = 400
+            return 'Invalid sequence number or module id'
+
+        if not _open_stream():
+            self.logger.warn('Too many streams open. Refusing event stream.')
+            return 'Too many streams open'
+        # Run once the stream ends, including when the client disconnects.
+        cherrypy.request.hooks.attach('on_end_request', _close_stream)
+
+        self.logger.debug('Streaming job changes since %s' % since)
+        cherrypy.response.headers['Content-Type'] = 'text/event-stream'
+        cherrypy.response.headers['Cache-Control'] = 'no-cache'
+        changes = follow_job_changes(since, state=state, username=username,
+                                     mod_id=mod_id)
+        return self._format_events(changes)
+
+    def _format_events(self, changes):
+        """Yield changes from follow_job_changes() as Server-Sent Events."""
+        # Sent at once so that clients see the stream open.
+        yield ': connected\n\n'
+        for change in changes:
+            if change is None:
+                yield ': keepalive\n\n'
+                continue
+            seq, changed, deleted = change
+            events = ['event: job\ndata: %s\n' % json.dumps(job)
+                      for job in changed]
+            events += ['event: job_deleted\ndata: %s\n'
+                       % json.dumps({'job_id': id}) for id in deleted]
+            events[-1] += 'id: %d\n' % seq
+            yield ''.join(event + '\n' for event in events)
+
+
 class _OnRampDispatcher:
     """Base class for OnRamp PCE dispatchers."""
     exposed = True
@@ -108,6 +366,35 @@ class _OnRampDispatcher:
         response.update(kwargs)
         return response
 
+    def check_etag(self, etag):
+        """Set the ETag of the response, ending the request with 304 Not
+        Modified if the client's copy, named in If-None-Match, is current.
+
+        Args:
+            etag (str): Quoted entity tag of the requested resource.
+
+        Raises:
+            cherrypy.HTTPRedirect: 304 response.
+        """
+        cherrypy.response.headers['ETag'] = etag
+        conditions = [str(x) for x in
+                      cherrypy.request.headers.elements('If-None-Match')]
+        if conditions == ['*'] or etag in conditions:
+            self.logger.debug('%s not modified' % cherrypy.request.path_info)
+            raise cherrypy.HTTPRedirect([], 304)
+
+    def get_content_etag(self, data):
+        """Return an entity tag computed from the content of a resource.
+
+        Args:
+            data: JSON serializable resource.
+
+        Returns:
+            Quoted entity tag.
+        """
+        content = json.dumps(data, sort_keys=True)
+        return '"%s"' % hashlib.sha1(content).hexdigest()
+
     def log_call(self, func_name):
         """Log entry into the given dispatcher.
         
@@ -148,8 +435,8 @@ class _OnRampDispatcher:
                       % (self.__class__.__name__, func_name))
     
         try:
-            conf = ConfigObj(data, configspec=configspec)
-            result = conf.validate(Validator(), preserve_errors=True)
+            conf = ConfigObj(data, configspec=get_configspec(configspec))
+            result = conf.validate(get_validator(), preserve_errors=True)
             self.logger.debug('Result: %s' % str(result))
         except IOError as ie:
             self.logger.error(str(ie))
@@ -172,6 +459,62 @@ class _OnRampDispatcher:
     
         return None
 
+    def queue_work(self, func, args, status_msg, interrupt_func=None):
+        """Queue a task on the work queue and return the response for it.
+
+        Args:
+            func (function): PCE function to run.
+            args (tuple): Args to call func with.
+            status_msg (str): Status message for the response if queued.
+
+        Kwargs:
+            interrupt_func (function/None): PCE function to call with args if
+                the task is cut off by the service stopping.
+
+        Returns:
+            OnRamp formatted response dict. The HTTP status is set to 202 with
+            the task's queue position if queued, or 429 if the queue is full.
+        """
+        queue = get_work_queue()
+        try:
+            position = queue.submit(func, args, interrupt_func=interrupt_func)
+        except QueueFull as e:
+            msg = 'Work queue full: %s' % str(e)
+            self.logger.warn(msg)
+            cherrypy.response.status = 429
+            cherrypy.response.headers['Retry-After'] = '30'
+            return self.get_response(status_code=-10, status_msg=msg,
+                                     queue_depth=queue.get_stats()['queued'])
+
+        cherrypy.response.status = 202
+        return self.get_response(status_msg=status_msg,
+                                 queue_position=position)
+
+    def get_since(self, kwargs):
+        """Parse the 'since' query-string parameter of a list get.
+
+        Args:
+            kwargs (dict): HTTP query-string parameters.
+
+        Returns:
+            Tuple with 0th position being the parsed sequence number (None if
+            not given) and 1st position being an error response (None if no
+            error).
+        """
+        since = kwargs.get('since')
+        if since is None:
+            return (None, None)
+        try:
+            since = int(since)
+            if since < 0:
+                raise ValueError
+        except ValueError:
+            cherrypy.response.status = 400
+            msg = 'Invalid sequence number in query: %s' % since
+            self.logger.warn(msg)
+            return (None, self.get_response(status_code=-8, status_msg=msg))
+        return (since, None)
+
 
 class APIMap(_OnRampDispatcher):
     """Provide an index of PCE API endpoints.
@@ -206,21 +549,43 @@ class Modules(_OnRampDispatcher):
         Kwargs:
             id (str): None signals list get, if not None, return specific
                 module.
-            **kwargs (dict): HTTP query-string parameters. Not currently used.
+            **kwargs (dict): HTTP query-string parameters. 'state' limits a
+                list get to modules in the given state. The 'Available' state
+                lists modules shipped with OnRamp. 'since' limits a list get to
+                modules changed since the given change journal sequence number.
 
         Returns:
-            OnRamp formatted dict containing requested module data.
+            OnRamp formatted dict containing requested module data. A get for a
+            specific module has an ETag, and returns 304 if it matches
+            If-None-Match.
         """
         self.log_call('GET')
 
-        if 'state' in kwargs.keys() and kwargs['state'] == 'Available':
+        state = kwargs.get('state')
+        if state == 'Available':
             return self.get_response(modules=get_available_modules())
 
         # Return the resource.
         if id:
-            return self.get_response(module=get_modules(mod_id=int(id)))
-        else:
-            return self.get_response(modules=get_modules())
+            try:
+                mod_id = int(id)
+            except ValueError:
+                cherrypy.response.status = 400
+                msg = 'Invalid module id in url: %s' % id
+                self.logger.warn(msg)
+                return self.get_response(status_code=-8, status_msg=msg)
+            etag = get_module_etag(mod_id)
+            if etag is not None:
+                self.check_etag(etag)
+            return self.get_response(module=get_modules(mod_id=mod_id))
+
+        since, error = self.get_since(kwargs)
+        if error:
+            return error
+        if since is not None:
+            seq, modules, deleted = get_module_changes(since, state=state)
+            return self.get_response(modules=modules, deleted=deleted, seq=seq)
+        return self.get_response(modules=get_modules(state=state))
 
     def POST(self, id=None, **kwargs):
         """Clone/copy a new module or deploy a previously cloned/copied module.
@@ -231,7 +596,9 @@ class Modules(_OnRampDispatcher):
             **kwargs (dict): HTTP query-string parameters. Not currently used.
 
         Returns:
-            OnRamp formatted dict containing request results.
+            OnRamp formatted dict containing request results. The install or
+            deploy is queued on the work queue (HTTP 202), or rejected if the
+            queue is full (HTTP 429).
         """
         self.log_call('POST')
 
@@ -245,15 +612,14 @@ class Modules(_OnRampDispatcher):
                 self.logger.warn(msg)
                 return self.get_response(status_code=-8, status_msg=msg)
                 
-            state_file = os.path.join(pce_root, 'src/state/modules/%d' % mod_id)
-            if not os.path.isfile(state_file):
+            if get_modules(mod_id=mod_id)['state'] == 'Does not exist':
                 msg = 'Module %d not installed' % mod_id
                 self.logger.warn(msg)
                 return self.get_response(status_code=-2, status_msg=msg)
 
-            p = Process(target=deploy_module, args=(mod_id,))
-            p.start()
-            return self.get_response(status_msg='Deployment initiated')
+            return self.queue_work(deploy_module, (mod_id,),
+                                   'Deployment initiated',
+                                   interrupt_func=deploy_interrupted)
 
         # Check params and initiate install.
         data = cherrypy.request.json
@@ -270,10 +636,9 @@ class Modules(_OnRampDispatcher):
             data['mod_name']
         )
 
-        p = Process(target=install_module, args=install_args)
-        p.start()
-
-        return self.get_response(status_msg='Checkout initiated')
+        return self.queue_work(install_module, install_args,
+                               'Checkout initiated',
+                               interrupt_func=install_interrupted)
 
     def PUT(self, id, **kwargs):
         """Update a specific module.
@@ -320,6 +685,115 @@ class Modules(_OnRampDispatcher):
         return self.get_response(status_msg=result[1])
 
 
+class JobEvents(_OnRampDispatcher):
+    """Receive run events of jobs, mapped to /jobs/:id/events.
+
+    Methods:
+        POST: Report the end of the run of a job.
+    """
+
+    def POST(self, id, **kwargs):
+        """Report that bin/onramp_run.py of a job or array element has exited.
+
+        The JSON body gives its 'exit_status', 'started' and 'finished' times
+        in seconds since the epoch, if known, and 'element', the index of the
+        array element, for array jobs. Postprocessing is initiated at once.
+        Events for jobs no longer running are ignored.
+
+        Args:
+            id (str): Id of the job.
+
+        Kwargs:
+            **kwargs (dict): HTTP query-string parameters. Not currently used.
+
+        Returns:
+            OnRamp formatted dict containing request results.
+        """
+        self.log_call('POST')
+        data = cherrypy.request.json
+        result = self.validate_json(data, 'POST')
+        if result:
+            return result
+
+        try:
+            job_id = int(id)
+            element = data.get('element')
+            if element is not None:
+                element = int(element)
+        except (TypeError, ValueError):
+            cherrypy.response.status = 400
+            msg = 'Invalid job id in url or element: %s' % id
+            self.logger.warn(msg)
+            return self.get_response(status_code=-8, status_msg=msg)
+
+        result = apply_run_event(job_id, data, element=element)
+        if result[0] == -8:
+            cherrypy.response.status = 400
+            self.logger.warn(result[1])
+        elif result[0] != 0:
+            cherrypy.response.status = 404
+        return self.get_response(status_code=result[0], status_msg=result[1])
+
+
+class JobWatch(_OnRampDispatcher):
+    """Long-poll for changes to jobs, mapped to /jobs/:id/watch.
+
+    Methods:
+        GET: Wait for a job to change.
+    """
+
+    def GET(self, id, since=None, timeout=None, **kwargs):
+        """Return a job once it changes.
+
+        Returns at once if the job has changed since the given sequence number,
+        and otherwise as soon as it does, or after timeout seconds.
+
+        Args:
+            id (str): Id of the job.
+
+        Kwargs:
+            since (str): Sequence number returned as seq by the previous
+                request. If not given, return the job at once.
+            timeout (str): Max seconds to wait, at most _max_watch_timeout.
+                Defaults to _watch_timeout.
+            **kwargs (dict): HTTP query-string parameters. Not currently used.
+
+        Returns:
+            OnRamp formatted dict containing the job and the seq to pass as
+            since on the next request. The watch is refused (HTTP 503) if
+            max_streams event streams, output follows, and job watches are
+            already open.
+        """
+        self.log_call('GET')
+        try:
+            job_id = int(id)
+            if since is not None:
+                since = int(since)
+            timeout = float(timeout) if timeout else _watch_timeout
+            if timeout < 0:
+                raise ValueError
+        except ValueError:
+            cherrypy.response.status = 400
+            msg = 'Invalid job id, since, or timeout: %s' % id
+            self.logger.warn(msg)
+            return self.get_response(status_code=-8, status_msg=msg)
+
+        if not _open_stream():
+            msg = 'Too many streams open'
+            self.logger.warn('%s. Refusing watch of job %d.' % (msg, job_id))
+            return self.get_response(status_code=-11, status_msg=msg)
+        try:
+            seq, job = watch_job(job_id, since=since,
+                                 timeout=min(timeout, _max_watch_timeout))
+        finally:
+            _close_stream()
+        if not job:
+            cherrypy.response.status = 404
+            return self.get_response(status_code=-1,
+                                     status_msg='Job %d does not exist' % job_id)
+        return self.get_response(job=job, seq=seq)
+
+
 class Jobs(_OnRampDispatcher):
     """Provide API for OnRamp jobs resource.
 
@@ -329,34 +803,101 @@ class Jobs(_OnRampDispatcher):
         PUT: Update a specific job.
         DELETE: Delete a specific job.
     """
-    def GET(self, id, **kwargs):
-        """Get status/results for specific job.
+    def __init__(self, conf, log_name):
+        """Initialize Jobs dispatcher and its output, events, and watch
+        sub-resources.
 
         Args:
-            id (str): Id of the job to inspect.
+            conf (ConfigObj): Application/server configuration object.
+            log_name (str): Name of an initialized logger to use.
+        """
+        _OnRampDispatcher.__init__(self, conf, log_name)
+        self.output = JobOutput(conf, log_name)
+        self.events = JobEvents(conf, log_name)
+        self.watch = JobWatch(conf, log_name)
+
+    def _cp_dispatch(self, vpath):
+        """Map /jobs/:id/output, /jobs/:id/events, and /jobs/:id/watch to
+        the JobOutput, JobEvents, and JobWatch dispatchers.
+        """
+        if len(vpath) == 2 and vpath[1] in ('output', 'events', 'watch'):
+            cherrypy.request.params['id'] = vpath.pop(0)
+            return getattr(self, vpath.pop(0))
+        return None
+
+    def GET(self, id=None, **kwargs):
+        """Get status/results for specific job or list of jobs.
 
         Kwargs:
-            **kwargs (dict): HTTP query-string parameters. Not currently used.
+            id (str): Id of the job to inspect. None signals list get.
+            **kwargs (dict): HTTP query-string parameters. 'state', 'username'
+                and 'mod_id' limit a list get to matching jobs. 'since' limits a
+                list get to jobs changed since the given change journal
+                sequence number.
 
         Returns:
-            OnRamp formatted dict containing requested job data.
+            OnRamp formatted dict containing requested job data. A get for a
+            specific job has an ETag, and returns 304 if it matches
+            If-None-Match.
         """
         self.log_call('GET')
 
-        # Return the resource.
+        # Return the resource. Settled jobs are checked against If-None-Match
+        # from their state alone, and other jobs once built.
         if id:
-            return self.get_response(job=get_jobs(job_id=id))
-        else:
-            return self.get_response(jobs=get_jobs())
+            try:
+                job_id = int(id)
+            except ValueError:
+                cherrypy.response.status = 400
+                msg = 'Invalid job id in url: %s' % id
+                self.logger.warn(msg)
+                return self.get_response(status_code=-8, status_msg=msg)
+            etag = get_job_etag(job_id)
+            if etag is not None:
+                self.check_etag(etag)
+            job = get_jobs(job_id=job_id)
+            if etag is None and job:
+                self.check_etag(self.get_content_etag(job))
+            return self.get_response(job=job)
+
+        mod_id = kwargs.get('mod_id')
+        if mod_id is not None:
+            try:
+                mod_id = int(mod_id)
+            except ValueError:
+                cherrypy.response.status = 400
+                msg = 'Invalid module id in query: %s' % mod_id
+                self.logger.warn(msg)
+                return self.get_response(status_code=-8, status_msg=msg)
+
+        since, error = self.get_since(kwargs)
+        if error:
+            return error
+        if since is not None:
+            seq, jobs, deleted = get_job_changes(
+                since, state=kwargs.get('state'),
+                username=kwargs.get('username'), mod_id=mod_id
+            )
+            return self.get_response(jobs=jobs, deleted=deleted, seq=seq)
+        return self.get_response(jobs=get_jobs(state=kwargs.get('state'),
+                                               username=kwargs.get('username'),
+                                               mod_id=mod_id))
 
     def POST(self, **kwargs):
         """Launch a new job.
 
+        The JSON body may include 'sweep', giving lists of values of run
+        params to sweep in the same form as 'cfg_params', e.g.
+        {"AUC": {"rectangles": ["1000", "10000"]}}, to launch an array job
+        with an element for each combination of values.
+
         Kwargs:
             **kwargs (dict): HTTP query-string parameters. Not currently used.
 
         Returns:
-            OnRamp formatted dict containing request results.
+            OnRamp formatted dict containing request results. The launch is
+            queued on the work queue (HTTP 202), or rejected if the queue is
+            full (HTTP 429).
         """
         self.log_call('POST')
         data = cherrypy.request.json
@@ -377,9 +918,18 @@ class Jobs(_OnRampDispatcher):
         else:
             args += (None,)
 
-        p = Process(target=launch_job, args=args)
-        p.start()
-        return self.get_response(status_msg='Job launched')
+        if 'sweep' in data.keys():
+            try:
+                expand_sweep(args[4], data['sweep'])
+            except ValueError as e:
+                cherrypy.response.status = 400
+                msg = 'Invalid sweep: %s' % str(e)
+                self.logger.warn(msg)
+                return self.get_response(status_code=-8, status_msg=msg)
+            args += (data['sweep'],)
+
+        return self.queue_work(launch_job, args, 'Job launched',
+                               interrupt_func=launch_interrupted)
 
     def PUT(self, id, **kwargs):
         """Update a specific job.
@@ -44,9 +44,15 @@ def get_visible_file(dirs):
 
     run_dir = os.path.join(os.path.join(pce_root, 'users'),
                            '/'.join(dirs[:num_parent_dirs]))
+    cfg_file = os.path.join(run_dir, 'config/onramp_metadata.cfg')
+    if (not os.path.isfile(cfg_file) and len(dirs) > num_parent_dirs + 1
+        and dirs[num_parent_dirs].isdigit()):
+        # Run dir of an array job element, in a folder per element.
+        num_parent_dirs += 1
+        run_dir = os.path.join(run_dir, dirs[num_parent_dirs - 1])
+        cfg_file = os.path.join(run_dir, 'config/onramp_metadata.cfg')
     filename = os.path.join(run_dir, '/'.join(dirs[num_parent_dirs:]))
 
-    cfg_file = os.path.join(run_dir, 'config/onramp_metadata.cfg')
     try:
         conf = ConfigObj(cfg_file, file_error=True)
     except (IOError, SyntaxError):
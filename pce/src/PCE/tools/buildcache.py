@@ -0,0 +1,248 @@
+"""Content-addressed cache of files built by module preprocess scripts.
+
+Modules that compile in bin/onramp_preprocess.py declare the files their build
+reads and produces in a [[build_cache]] subsection of the [onramp] section of
+config/onramp_metadata.cfg:
+
+    [onramp]
+    [[build_cache]]
+    inputs = src/*.c, src/Makefile
+    outputs = src/ring
+    runparams = ring.iters
+
+The cache key is a hash of the contents of the input files, the declared
+outputs, and the values of the listed runparams (SECTION.KEY in
+onramp_runparams.cfg). Before preprocess, the outputs stored under the run's
+key are restored into the run folder with their original timestamps, so that
+make finds them up to date. After a preprocess that missed, the outputs are
+stored under the key.
+
+Exports:
+    BuildCache: Cache of build outputs stored under a folder.
+    get_build_spec: Return the build cache declaration of a module.
+    get_build_cache: Return the build cache configured for the PCE.
+"""
+import errno
+import glob
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+
+from configobj import ConfigObj
+
+from PCE.tools.config import get_pce_config
+from PCE.tools.rundirs import share_file
+from PCEHelper import pce_root
+
+_cache_dir = os.path.join(pce_root, 'src/build_cache')
+_logger = logging.getLogger('onramp')
+
+def _as_list(value):
+    """Return a configobj value that may be a single string as a list."""
+    if isinstance(value, basestring):
+        return [value]
+    return list(value)
+
+def get_build_spec(mod_dir):
+    """Return the build cache declaration of a module or run folder.
+
+    Args:
+        mod_dir (str): Root folder of the module or run.
+
+    Returns:
+        Dict with 'inputs', 'outputs', and 'runparams' lists, or None if the
+        module does not declare a build cache.
+    """
+    cfg_file = os.path.join(mod_dir, 'config/onramp_metadata.cfg')
+    try:
+        conf = ConfigObj(cfg_file, file_error=True)
+    except (IOError, SyntaxError):
+        return None
+
+    if ('onramp' not in conf.keys()
+        or 'build_cache' not in conf['onramp'].keys()):
+        return None
+    section = conf['onramp']['build_cache']
+    if 'outputs' not in section.keys():
+        return None
+    return {
+        'inputs': _as_list(section.get('inputs', [])),
+        'outputs': _as_list(section['outputs']),
+        'runparams': _as_list(section.get('runparams', []))
+    }
+
+def _glob_files(run_dir, patterns):
+    """Return sorted paths, relative to run_dir, of files matching patterns."""
+    paths = set()
+    for pattern in patterns:
+        for path in glob.glob(os.path.join(run_dir, pattern)):
+            if os.path.isfile(path):
+                paths.add(os.path.relpath(path, run_dir))
+    return sorted(paths)
+
+def _hash_file(path, digest):
+    """Add the contents of the file at path to digest."""
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(64 * 1024), ''):
+            digest.update(chunk)
+
+
+class BuildCache(object):
+    """Cache of build outputs, stored as one folder per key under cache_dir.
+
+    Entries are written to a temporary folder and renamed into place, so
+    concurrent stores of the same key are safe and readers never see a partial
+    entry. The least recently used entries are removed once there are more
+    than max_entries.
+    """
+
+    def __init__(self, cache_dir=None, max_entries=50):
+        """Return a BuildCache.
+
+        Kwargs:
+            cache_dir (str): Folder to store entries in. Defaults to
+                src/build_cache under the PCE root.
+            max_entries (int): Max number of entries to keep.
+        """
+        if cache_dir is None:
+            cache_dir = _cache_dir
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+
+    def get_key(self, run_dir, spec):
+        """Return the cache key for a run.
+
+        Args:
+            run_dir (str): Run folder, with onramp_runparams.cfg written.
+            spec (dict): Build cache declaration from get_build_spec().
+
+        Returns:
+            Hex string key.
+        """
+        digest = hashlib.sha256()
+        for rel in _glob_files(run_dir, spec['inputs']):
+            file_digest = hashlib.sha256()
+            _hash_file(os.path.join(run_dir, rel), file_digest)
+            digest.update('input %s %s\n' % (rel, file_digest.hexdigest()))
+        for pattern in spec['outputs']:
+            digest.update('output %s\n' % pattern)
+
+        params = ConfigObj(os.path.join(run_dir, 'onramp_runparams.cfg'))
+        for name in spec['runparams']:
+            section, _, key = name.rpartition('.')
+            value = params.get(section, {}).get(key) if section else \
+                    params.get(key)
+            digest.update('runparam %s %r\n' % (name, value))
+        return digest.hexdigest()
+
+    def _entry_dir(self, key):
+        """Return the folder of the entry for key."""
+        return os.path.join(self.cache_dir, key)
+
+    def restore(self, run_dir, key):
+        """Restore the outputs stored under key into a run folder.
+
+        Args:
+            run_dir (str): Run folder.
+            key (str): Key as returned by get_key().
+
+        Returns:
+            True if the key was found and its outputs restored, else False.
+        """
+        entry_dir = self._entry_dir(key)
+        if not os.path.isdir(entry_dir):
+            return False
+
+        for root, dirs, files in os.walk(entry_dir):
+            for name in files:
+                src = os.path.join(root, name)
+                rel = os.path.relpath(src, entry_dir)
+                dst = os.path.join(run_dir, rel)
+                try:
+                    os.makedirs(os.path.dirname(dst))
+                except OSError as e:
+                    if e.errno != errno.EEXIST:
+                        raise
+                if os.path.lexists(dst):
+                    os.remove(dst)
+                # Reflinked or copied, never hardlinked, so that a rebuild in
+                # the run folder cannot change the entry.
+                share_file(src, dst, link_mode='reflink')
+        # Mark as recently used.
+        os.utime(entry_dir, None)
+        return True
+
+    def store(self, run_dir, spec, key):
+        """Store the outputs of a run under key.
+
+        Args:
+            run_dir (str): Run folder, after a successful build.
+            spec (dict): Build cache declaration from get_build_spec().
+            key (str): Key as returned by get_key() before the build.
+
+        Returns:
+            Number of files stored, 0 if the key was already stored or there
+            were no outputs.
+        """
+        outputs = _glob_files(run_dir, spec['outputs'])
+        if not outputs or os.path.isdir(self._entry_dir(key)):
+            return 0
+
+        try:
+            os.makedirs(self.cache_dir)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        tmp_dir = tempfile.mkdtemp(prefix='.tmp', dir=self.cache_dir)
+        try:
+            for rel in outputs:
+                dst = os.path.join(tmp_dir, rel)
+                try:
+                    os.makedirs(os.path.dirname(dst))
+                except OSError as e:
+                    if e.errno != errno.EEXIST:
+                        raise
+                # Copied, so the entry is never changed through the run folder.
+                shutil.copy2(os.path.join(run_dir, rel), dst)
+            try:
+                os.rename(tmp_dir, self._entry_dir(key))
+            except OSError as e:
+                if e.errno not in (errno.EEXIST, errno.ENOTEMPTY):
+                    raise
+                # Stored by a concurrent build.
+                return 0
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+        self.prune()
+        return len(outputs)
+
+    def prune(self):
+        """Remove least recently used entries beyond max_entries."""
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if name.startswith('.'):
+                continue
+            path = os.path.join(self.cache_dir, name)
+            try:
+                entries.append((os.stat(path).st_mtime, path))
+            except OSError:
+                # Removed by a concurrent prune.
+                pass
+        entries.sort()
+        for mtime, path in entries[:max(0, len(entries) - self.max_entries)]:
+            _logger.debug('Removing build cache entry %s' % path)
+            shutil.rmtree(path, ignore_errors=True)
+
+def get_build_cache():
+    """Return the build cache configured in onramp_pce_config.cfg.
+
+    Returns:
+        BuildCache instance, or None if the build cache is disabled.
+    """
+    cfg = get_pce_config()['cluster']
+    if not cfg['build_cache_entries']:
+        return None
+    return BuildCache(max_entries=cfg['build_cache_entries'])
@@ -0,0 +1,157 @@
+"""Process-wide registry of parsed PCE configuration.
+
+onramp_pce_config.cfg is parsed and validated once per process, and the batch
+scheduler it selects is instantiated once. Both are shared by all callers and
+must not be modified. reload_config() replaces them atomically, so a caller
+never sees a config and scheduler from different versions of the file.
+
+Exports:
+    get_pce_config: Return the validated onramp_pce_config.cfg.
+    get_scheduler: Return the configured batch scheduler.
+    get_configspec: Return a parsed configspec file.
+    get_validator: Return the shared configobj Validator.
+    reload_config: Re-read onramp_pce_config.cfg and configspecs.
+"""
+import logging
+import os
+import threading
+
+from configobj import ConfigObj, ConfigObjError, ConfigspecError, \
+                      flatten_errors
+from validate import Validator
+
+from PCE.tools.schedulers import Scheduler
+from PCEHelper import pce_root
+
+_cfg_file = os.path.join(pce_root, 'bin', 'onramp_pce_config.cfg')
+_cfgspec_file = os.path.join(pce_root, 'src', 'configspecs',
+                             'onramp_pce_config.cfgspec')
+_logger = logging.getLogger('onramp')
+_validator = Validator()
+_lock = threading.Lock()
+# (config, scheduler) tuple, replaced as a whole on reload.
+_current = None
+# Parsed configspecs by path, as (mtime, ConfigObj) tuples.
+_configspecs = {}
+
+def _load():
+    """Parse and validate onramp_pce_config.cfg and instantiate its scheduler.
+
+    Returns:
+        Tuple of the validated ConfigObj, the scheduler instance (None if the
+        configured scheduler is not implemented), and a list of strings
+        describing validation errors.
+    """
+    cfg = ConfigObj(_cfg_file, configspec=get_configspec(_cfgspec_file))
+    result = cfg.validate(_validator, preserve_errors=True)
+    errors = []
+    if result is not True:
+        for sections, key, error in flatten_errors(cfg, result):
+            name = '/'.join(sections + ([key] if key else []))
+            errors.append('%s: %s' % (name, error or 'missing value'))
+
+    scheduler = None
+    if 'cluster' in cfg.keys() and 'batch_scheduler' in cfg['cluster'].keys():
+        try:
+            scheduler = Scheduler(cfg['cluster']['batch_scheduler'])
+        except ValueError:
+            # Raised again by get_scheduler() if used.
+            pass
+    return (cfg, scheduler, errors)
+
+def _get_current():
+    """Return the current (config, scheduler) tuple, loading it if needed."""
+    global _current
+    current = _current
+    if current is None:
+        with _lock:
+            if _current is None:
+                cfg, scheduler, errors = _load()
+                for error in errors:
+                    _logger.warn('onramp_pce_config.cfg: %s' % error)
+                _current = (cfg, scheduler)
+            current = _current
+    return current
+
+def get_pce_config():
+    """Return the validated onramp_pce_config.cfg.
+
+    Returns:
+        Shared ConfigObj instance. Must not be modified.
+    """
+    return _get_current()[0]
+
+def get_scheduler():
+    """Return the batch scheduler configured in onramp_pce_config.cfg.
+
+    Returns:
+        Shared instance of a PCE.tools.schedulers._BatchScheduler.
+
+    Raises:
+        ValueError: The configured scheduler is not implemented.
+    """
+    cfg, scheduler = _get_current()
+    if scheduler is None:
+        return Scheduler(cfg['cluster']['batch_scheduler'])
+    return scheduler
+
+def get_configspec(filename):
+    """Return the parsed configspec file, reparsing only if it has changed.
+
+    The result can be given as the configspec arg to ConfigObj() in place of
+    the filename.
+
+    Args:
+        filename (str): Path of the configspec file.
+
+    Returns:
+        Shared ConfigObj instance. Must not be modified.
+
+    Raises:
+        IOError: The file does not exist or could not be read.
+        configobj.ConfigspecError: The file could not be parsed.
+    """
+    try:
+        mtime = os.stat(filename).st_mtime
+    except OSError as e:
+        raise IOError('Reading configspec failed: %s' % str(e))
+
+    entry = _configspecs.get(filename)
+    if entry is not None and entry[0] == mtime:
+        return entry[1]
+
+    try:
+        spec = ConfigObj(filename, raise_errors=True, file_error=True,
+                         _inspec=True)
+    except ConfigObjError as e:
+        raise ConfigspecError('Parsing configspec failed: %s' % e)
+    _configspecs[filename] = (mtime, spec)
+    return spec
+
+def get_validator():
+    """Return the shared configobj Validator."""
+    return _validator
+
+def reload_config():
+    """Re-read onramp_pce_config.cfg and replace the shared config and
+    scheduler.
+
+    If the file cannot be parsed or does not validate, the current config is
+    kept.
+
+    Returns:
+        Tuple with 0th position being error code and 1st position being string
+        indication of status.
+    """
+    global _current
+    _configspecs.clear()
+    try:
+        cfg, scheduler, errors = _load()
+    except (ConfigObjError, IOError) as e:
+        return (-1, 'Config reload failed: %s' % str(e))
+    if errors:
+        return (-1, 'Config reload failed: %s' % '; '.join(errors))
+
+    with _lock:
+        _current = (cfg, scheduler)
+    return (0, 'Config reloaded')
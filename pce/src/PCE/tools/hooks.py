@@ -0,0 +1,218 @@
+"""Run module hook scripts and other commands in a given folder.
+
+Hooks (bin/onramp_deploy.py, bin/onramp_preprocess.py, etc.) are run with the
+module or run folder as the child's working dir instead of changing the
+working dir of the PCE process, so hooks for different modules and jobs can
+run at the same time from different threads.
+
+The wall time, CPU time, and max resident set size of each command are
+collected when it is reaped with wait4(), and can be accumulated per hook
+phase in module and job state with add_usage().
+
+Exports:
+    HookTimeout: Raised when a command runs longer than its timeout.
+    run_command: Run a command in a given folder and return its output.
+    run_hook: Run a module hook script and log its output.
+    add_usage: Add the resource usage of a run to per-phase totals.
+"""
+import errno
+import logging
+import os
+import signal
+import threading
+import time
+from datetime import datetime
+from subprocess import PIPE, Popen, STDOUT
+
+from PCEHelper import pce_root
+
+_local_python = os.path.join(pce_root, 'src/env/bin/python')
+_logger = logging.getLogger('onramp')
+
+class HookTimeout(Exception):
+    """Raised by run_command() when the command is killed for running longer
+    than its timeout.
+
+    Attributes:
+        timeout (int): The timeout, in seconds.
+        output (str): Output of the command up to when it was killed.
+    """
+
+    def __init__(self, timeout, output):
+        Exception.__init__(self, 'Timed out after %d seconds' % timeout)
+        self.timeout = timeout
+        self.output = output
+
+
+def _kill_group(p, killed):
+    """Kill the process group led by the given child, ignoring if gone."""
+    killed.set()
+    try:
+        os.killpg(p.pid, signal.SIGKILL)
+    except OSError:
+        pass
+
+def _wait(p):
+    """Reap the child and return its exit status and resource usage.
+
+    Returns:
+        Tuple of the exit status, as for Popen.wait(), and the
+        resource.struct_rusage of the child and its reaped descendants, or
+        None if it was reaped elsewhere.
+    """
+    while True:
+        try:
+            pid, status, rusage = os.wait4(p.pid, 0)
+            break
+        except OSError as e:
+            if e.errno == errno.EINTR:
+                continue
+            if e.errno == errno.ECHILD:
+                return (p.wait(), None)
+            raise
+    if os.WIFSIGNALED(status):
+        p.returncode = -os.WTERMSIG(status)
+    else:
+        p.returncode = os.WEXITSTATUS(status)
+    return (p.returncode, rusage)
+
+def _get_usage(rusage, wall):
+    """Return the usage dict for a command from its rusage and wall time."""
+    usage = {'wall': round(wall, 3), 'user': None, 'sys': None,
+             'max_rss': None}
+    if rusage is not None:
+        usage['user'] = round(rusage.ru_utime, 3)
+        usage['sys'] = round(rusage.ru_stime, 3)
+        # Kilobytes on Linux.
+        usage['max_rss'] = rusage.ru_maxrss
+    return usage
+
+def add_usage(totals, phase, usage):
+    """Add the resource usage of a run to the totals for its phase.
+
+    The totals for a phase give the number of runs as 'count', the sums of
+    their 'wall', 'user', and 'sys' seconds, and the largest 'max_rss' in KB.
+
+    Args:
+        totals (dict): Totals by phase, as stored in the hook_usage attr of
+            module and job state. Updated in place.
+        phase (str): Phase of the run, e.g. 'deploy' or 'status'.
+        usage (dict): Usage of the run, as filled in by run_command().
+    """
+    total = totals.setdefault(phase, {'count': 0, 'wall': 0.0, 'user': 0.0,
+                                      'sys': 0.0, 'max_rss': 0})
+    total['count'] += 1
+    for key in ['wall', 'user', 'sys']:
+        total[key] = round(total[key] + (usage.get(key) or 0.0), 3)
+    total['max_rss'] = max(total['max_rss'], usage.get('max_rss') or 0)
+
+def run_command(args, cwd, log_file=None, timeout=None, usage=None):
+    """Run a command in the given folder and return its exit status and output.
+
+    Output to stdout and stderr is read as it is written, and is also written
+    to log_file if given, so the log of a long-running command can be followed
+    while it runs.
+
+    Args:
+        args (list of str): Command and its args.
+        cwd (str): Folder to run the command in.
+
+    Kwargs:
+        log_file (file): Open file to copy output to.
+        timeout (int/None): If given, kill the command, along with any
+            processes it started, after this many seconds.
+        usage (dict): If given, filled in with the resource usage of the
+            command, even if it times out: 'wall', 'user', and 'sys' seconds,
+            and 'max_rss' in KB. CPU time and max RSS include any processes it
+            started and waited for.
+
+    Returns:
+        Tuple with 0th position being the exit status of the command, mapped to
+        the range -128 to 127, and 1st position being its combined output to
+        stdout and stderr.
+
+    Raises:
+        OSError: The command could not be run.
+        HookTimeout: The command ran longer than timeout.
+    """
+    # close_fds keeps children started from other threads at the same time
+    # from inheriting this child's pipe. With a timeout, the command is run in
+    # its own process group so that everything holding the pipe can be killed.
+    preexec_fn = os.setsid if timeout is not None else None
+    start = time.time()
+    p = Popen(args, cwd=cwd, stdout=PIPE, stderr=STDOUT, close_fds=True,
+              preexec_fn=preexec_fn)
+    timer = None
+    killed = threading.Event()
+    if timeout is not None:
+        timer = threading.Timer(timeout, _kill_group, args=(p, killed))
+        timer.daemon = True
+        timer.start()
+
+    chunks = []
+    try:
+        for line in iter(p.stdout.readline, ''):
+            chunks.append(line)
+            if log_file is not None:
+                log_file.write(line)
+                log_file.flush()
+        p.stdout.close()
+        code, rusage = _wait(p)
+    finally:
+        if timer is not None:
+            timer.cancel()
+
+    if usage is not None:
+        usage.update(_get_usage(rusage, time.time() - start))
+    output = ''.join(chunks)
+    if killed.is_set() and code == -signal.SIGKILL:
+        raise HookTimeout(timeout, output)
+    if code > 127:
+        code -= 256
+    return (code, output)
+
+def run_hook(mod_dir, hook, log_id=None, timeout=None, usage=None):
+    """Run a module hook script with the PCE python in the module folder.
+
+    If log_id is given, output is written to log/onramp_{log_id}.log in the
+    module as it is produced, in the format used by PCE.tools.module_log().
+
+    Args:
+        mod_dir (str): Absolute path of module or job run folder.
+        hook (str): Path of the hook script relative to mod_dir.
+
+    Kwargs:
+        log_id (str): Determines logfile to use: log/onramp_{log_id}.log.
+        timeout (int/None): As for run_command().
+        usage (dict): As for run_command().
+
+    Returns:
+        Tuple with 0th position being the exit status of the hook, mapped to
+        the range -128 to 127, and 1st position being its combined output to
+        stdout and stderr.
+
+    Raises:
+        OSError: The hook could not be run.
+        HookTimeout: The hook ran longer than timeout.
+    """
+    _logger.debug('Calling %s in %s' % (hook, mod_dir))
+    args = [_local_python, hook]
+    if usage is None:
+        usage = {}
+    try:
+        if log_id is None:
+            return run_command(args, mod_dir, timeout=timeout, usage=usage)
+
+        logname = os.path.join(mod_dir, 'log/onramp_%s.log' % log_id)
+        with open(logname, 'w') as f:
+            f.write('The following output was logged %s:\n\n'
+                    % str(datetime.now()))
+            f.flush()
+            return run_command(args, mod_dir, log_file=f, timeout=timeout,
+                               usage=usage)
+    finally:
+        if usage:
+            _logger.debug('%s in %s used %.3fs wall, %ss user, %ss sys, '
+                          'max RSS %s KB' % (hook, mod_dir, usage['wall'],
+                                             usage['user'], usage['sys'],
+                                             usage['max_rss']))
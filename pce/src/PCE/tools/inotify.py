@@ -0,0 +1,117 @@
+"""Minimal Linux inotify support for watching PCE state folders.
+
+Exports:
+    InotifyWatcher: Background thread reporting changes in watched folders.
+"""
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import select
+import struct
+import threading
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_CLOEXEC = 0x00080000
+
+_watch_mask = (IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO
+               | IN_CREATE | IN_DELETE | IN_DELETE_SELF)
+_event_header = struct.Struct('iIII')
+_logger = logging.getLogger('onramp')
+
+class InotifyWatcher(object):
+    """Report changes to files in a set of folders from a daemon thread.
+
+    The callback is called from the watcher thread as callback(path, name) for
+    each change, where path is the watched folder and name is the changed
+    file's name. It is called as callback(None, None) if events were lost and
+    everything watched should be considered changed.
+    """
+
+    def __init__(self, paths, callback):
+        """Set up inotify watches and return the unstarted watcher.
+
+        Args:
+            paths (list of str): Folders to watch.
+            callback (callable): Called for each change as described above.
+
+        Raises:
+            OSError: inotify is not available or a watch could not be added.
+        """
+        libc_name = ctypes.util.find_library('c')
+        if libc_name is None:
+            raise OSError(errno.ENOSYS, 'libc not found')
+        libc = ctypes.CDLL(libc_name, use_errno=True)
+        if not hasattr(libc, 'inotify_init1'):
+            raise OSError(errno.ENOSYS, 'inotify not available')
+
+        self._fd = libc.inotify_init1(IN_CLOEXEC)
+        if self._fd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e))
+
+        self._paths = {}
+        for path in paths:
+            wd = libc.inotify_add_watch(self._fd, path, _watch_mask)
+            if wd < 0:
+                e = ctypes.get_errno()
+                os.close(self._fd)
+                raise OSError(e, '%s: %s' % (os.strerror(e), path))
+            self._paths[wd] = path
+
+        self._callback = callback
+        self._stopping = threading.Event()
+        self._thread = threading.Thread(target=self._run,
+                                        name='InotifyWatcher')
+        self._thread.daemon = True
+
+    def start(self):
+        """Start watching."""
+        self._thread.start()
+
+    def stop(self):
+        """Stop watching and release the inotify instance."""
+        self._stopping.set()
+        self._thread.join()
+        os.close(self._fd)
+
+    def _run(self):
+        """Read and dispatch events until stopped."""
+        while not self._stopping.is_set():
+            # Time out periodically to check for stop requests.
+            readable = select.select([self._fd], [], [], 1.0)[0]
+            if not readable:
+                continue
+            try:
+                data = os.read(self._fd, 64 * 1024)
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+            self._dispatch(data)
+
+    def _dispatch(self, data):
+        """Parse a buffer of inotify events and call the callback for each."""
+        offset = 0
+        while offset + _event_header.size <= len(data):
+            wd, mask, cookie, length = _event_header.unpack_from(data, offset)
+            offset += _event_header.size
+            name = data[offset:offset + length].rstrip('\0')
+            offset += length
+
+            try:
+                if mask & IN_Q_OVERFLOW:
+                    _logger.warn('inotify event queue overflowed')
+                    self._callback(None, None)
+                elif wd in self._paths:
+                    self._callback(self._paths[wd], name)
+            except Exception as e:
+                _logger.error('Error handling inotify event: %s' % str(e))
@@ -5,35 +5,79 @@ Exports:
     JobState: Encapsulation of job state that avoids race conditions.
     launch_job: Schedules job launch using system batch scheduler as configured
         in onramp_pce_config.cfg.
+    launch_interrupted: Records a job launch cut off by the PCE service
+        stopping.
+    expand_sweep: Returns the run params of each element of a parameter sweep.
     get_jobs: Returns list of tracked jobs or single job.
+    get_job_etag: Returns an entity tag for a settled job's resource.
+    get_job_changes: Returns jobs changed since a change journal sequence
+        number.
+    get_job_output_file: Returns path of a job's output file.
+    apply_run_event: Records the end of a job's run, as reported by its
+        batch script.
+    check_run_events: Applies run events written by finished batch scripts.
+    follow_job_output: Yields a job's output as it is written.
+    watch_job: Waits for a job to change, for long-polling clients.
+    follow_job_changes: Yields changes to jobs as they are stored.
+    poll_jobs: Updates state of all active jobs from the batch scheduler.
+    enable_job_poller: Leaves scheduler status checks to poll_jobs().
     init_job_delete: Initiate the deletion of a job.
 """
 import argparse
+import collections
 import copy
 import errno
 import fcntl
 import json
 import glob
+import hashlib
 import logging
 import os
-import shutil
 import sys
+import threading
 import time
-from itertools import chain
-from multiprocessing import Process
-from subprocess import CalledProcessError, call, check_output, STDOUT
+from itertools import chain, product
+from multiprocessing import Process, active_children
+from subprocess import call
 
 from configobj import ConfigObj
 from validate import Validator
 
-from PCE.tools import module_log
+from PCE.tools.buildcache import get_build_cache, get_build_spec
+from PCE.tools.config import get_pce_config, get_scheduler
+from PCE.tools.hooks import HookTimeout, add_usage, run_hook
+from PCE.tools.locks import StateLock
+from PCE.tools.state import delete_state, get_changes, get_state_backend, \
+                            load_state, load_state_file, remove_state_file, \
+                            store_state, store_state_file, wait_for_changes
 from PCE.tools.modules import ModState
-from PCE.tools.schedulers import Scheduler
+from PCE.tools.rundirs import get_mutable_globs, materialize_run_dir
+from PCE.tools.trash import trash_tree
 from PCEHelper import pce_root
 
 _job_state_dir = os.path.join(pce_root, 'src/state/jobs')
 _mod_install_dir = os.path.join(pce_root, 'modules')
+_status_check_states = ['Scheduled', 'Queued', 'Running']
+# States in which the job's output file may still be written.
+_output_states = ['Setting up launch', 'Preprocessing'] + _status_check_states
+# States in which neither the job's state nor its run folder change further.
+_settled_states = ['Launch failed', 'Schedule failed', 'Preprocess failed',
+                   'Run failed', 'Postprocess failed', 'Done']
+_output_chunk_size = 64 * 1024
+# Max number of elements of an array job.
+_max_array_size = 1000
+# Written by the batch script once bin/onramp_run.py exits. See
+# _BatchScheduler.get_run_commands().
+_run_event_file = '.onramp_done'
+# Resources requested for runs whose run params and module give none.
+_default_allocation = {'numtasks': 4, 'num_nodes': 1, 'threads': 1,
+                       'walltime': None}
 _logger = logging.getLogger('onramp')
+_polling = False
+# Max seconds between scheduler status checks of a watched job.
+_watch_check_interval = 5
+# Seconds to wait for a journaled change to be applied before checking again.
+_applying_wait = .05
 
 class JobState(dict):
     """Provide access to job state in a way that race conditions are avoided.
@@ -46,44 +90,46 @@ class JobState(dict):
             job_state['key2'] = 'val2'
     """
 
-    def __init__(self, id, job_state_file=None):
+    def __init__(self, id, job_state_file=None, timeout=None,
+                 readonly=False):
         """Return initialized JobState instance.
         Method works in get-or-create fashion, that is, if state exists for
         job id, open and return it, else create and return it.
         Args:
             id (int): Id of the job to get/create state for.
+        Kwargs:
+            job_state_file (str): Path of the state file to use instead of the
+                default location in the state dir.
+            timeout (float/None): Seconds to wait for the state lock before
+                raising PCE.tools.locks.LockTimeout. If None, block until
+                the lock is available.
+            readonly (bool): If True, return a snapshot of the stored state
+                without taking the state lock. Snapshots never block or are
+                blocked by other instances, and changes made to them are
+                discarded.
         """
-        if job_state_file is None:
-            job_state_file = os.path.join(_job_state_dir, str(id))
-
         self.job_id = id
-        self._lock_filename = os.path.join(_job_state_dir, '%s.lock' % str(id))
+        self._lock_filename = os.path.join(_job_state_dir, '.%s.lock' % str(id))
         self._job_state_filename = job_state_file
 
-        while(True):
-            try:
-                # Raises OSError if file cannot be opened in create mode.
-                os.open(self._lock_filename,
-                        os.O_CREAT | os.O_EXCL | os.O_WRONLY)
-                break
-            except OSError as e:
-                if e.errno != errno.EEXIST:
-                    raise
-                time.sleep(.001)
+        self._readonly = readonly
+        self._lock = StateLock(self._lock_filename, timeout=timeout)
+        if not readonly:
+            self._lock.acquire()
 
         try:
-            self._state_file = open(job_state_file, 'r+')
-            data = json.load(self._state_file)
+            if self._job_state_filename is None:
+                data = load_state('jobs', id, snapshot=readonly)
+            else:
+                data = load_state_file(self._job_state_filename)
+        except:
+            self._lock.release()
+            raise
+        if data is not None:
             self.update(data)
-            self._state_file.seek(0)
-        except IOError as e1:
-            if e1.errno != errno.ENOENT:
-                raise
-            self._state_file = open(job_state_file, 'w')
-        except ValueError as e2:
-            #_logger.debug('BAD JSON: %s' % file_contents)
-            # Invalid json. Ignore (will be overwritten by _close().
-            pass
+        # Kept to skip storing unchanged state on close. Copied, as nested
+        # values are shared with the instance.
+        self._stored = None if readonly else copy.deepcopy(data)
 
     def __enter__(self):
         """Provide entry for use in 'with' statements."""
@@ -101,34 +147,46 @@ class JobState(dict):
         """Serialize and store state parameters.
         If stored state exists, overwrite it with current instance keys/vals.
         """
-        if 'state' in self.keys() and self['state'] != 'Does not exist':
-            json.dump(self, self._state_file)
-            self._state_file.truncate()
-            self._state_file.close()
-        else:
-            _logger.debug("REMOVING STATE FILE with state: %s" % str(self))
-            try:
-                self._state_file.close()
-                os.remove(self._job_state_filename)
-            except OSError as e:
-                if e.errno != errno.ENOENT:
-                    raise e
+        if self._readonly:
+            return
 
         try:
-            os.remove(self._lock_filename)
-        except OSError as e:
-            if e.errno != errno.ENOENT:
-                raise e
+            if 'state' in self.keys() and self['state'] != 'Does not exist':
+                if self == self._stored:
+                    # Unchanged. Nothing to store.
+                    return
+                self['_version'] = self.get('_version', 0) + 1
+                if self._job_state_filename is None:
+                    store_state('jobs', self.job_id, self)
+                else:
+                    store_state_file(self._job_state_filename, self)
+            elif self._stored is not None:
+                _logger.debug("REMOVING STATE FILE with state: %s" % str(self))
+                if self._job_state_filename is None:
+                    delete_state('jobs', self.job_id)
+                else:
+                    remove_state_file(self._job_state_filename)
+        finally:
+            self._lock.release()
 
 
-def launch_job(job_id, mod_id, username, run_name, run_params):
+def launch_job(job_id, mod_id, username, run_name, run_params, sweep=None):
     """Schedule job launch using system batch scheduler as configured in
     onramp_pce_config.cfg.
+    If sweep is given, the job is launched as an array job with an element for
+    each combination of swept values, as given by expand_sweep(). Elements
+    run in folders 0, 1, ... under the job's run dir, are scheduled with a
+    single array submission, and are tracked in the 'array' list of the job's
+    state.
     Args:
         job_id (int): Unique identifier for job.
         mod_id (int): Id for OnRamp educational module to run in this job.
         username (str): Username of user running the job.
         run_name (str): Human-readable label for this job run.
+        run_params (dict/None): Run params for onramp_runparams.cfg.
+    Kwargs:
+        sweep (dict/None): Values of run params to sweep, as for
+            expand_sweep().
     Returns:
         Tuple with 0th position being error code and 1st position being string
         indication of status.
@@ -146,6 +204,18 @@ def launch_job(job_id, mod_id, username, run_name, run_params):
             _logger.warn(msg)
             return (-1, msg)
 
+    if sweep:
+        elements = expand_sweep(run_params, sweep)
+        ret = job_init_state(job_id, mod_id, username, run_name, None,
+                             array=[swept for params, swept in elements])
+        if ret[0] != 0:
+            return ret
+        ret = job_preprocess_array(job_id,
+                                   [params for params, swept in elements])
+        if ret[0] != 0:
+            return ret
+        return job_run(job_id)
+
     ret = job_init_state(job_id, mod_id, username, run_name, run_params)
     if ret[0] != 0:
         return ret
@@ -154,9 +224,86 @@ def launch_job(job_id, mod_id, username, run_name, run_params):
         return ret
     return job_run(job_id)
 
+def launch_interrupted(job_id, mod_id, username, run_name, run_params,
+                       sweep=None):
+    """Record the failure of a launch_job() call that was cut off by the PCE
+    service stopping, so that the job can be relaunched.
+    Takes the same args as launch_job().
+    Returns:
+        Tuple with 0th position being error code and 1st position being string
+        indication of status.
+    """
+    failed_states = {
+        'Setting up launch': 'Launch failed',
+        'Preprocessing': 'Preprocess failed'
+    }
+    with JobState(job_id) as job_state:
+        if job_state.get('state') not in failed_states:
+            return (0, 'Job %d launch not interrupted' % job_id)
+        msg = ('Launch interrupted by PCE service stop in state %s'
+               % job_state['state'])
+        _logger.warn('Job %d: %s' % (job_id, msg))
+        job_state['state'] = failed_states[job_state['state']]
+        job_state['error'] = msg
+        for element in job_state.get('array') or []:
+            element['state'] = job_state['state']
+        if job_state['_marked_for_del']:
+            _delete_job(job_state)
+            return (-2, 'Job %d deleted' % job_id)
+    return (-1, msg)
+
+def expand_sweep(run_params, sweep):
+    """Return the run params of each element of a parameter sweep.
+    Elements are all combinations of the swept values, in order of the swept
+    keys sorted by section and key, with the last key varying fastest.
+    Args:
+        run_params (dict/None): Run params common to all elements.
+        sweep (dict): List of values for each swept key, by section and key,
+            e.g. {'AUC': {'rectangles': ['1000', '10000']}}.
+    Returns:
+        List with a tuple for each element, of its run params and a dict of its
+        swept values keyed by SECTION.KEY.
+    Raises:
+        ValueError: sweep is malformed, or gives fewer than 2 or more than
+            _max_array_size elements.
+    """
+    if not isinstance(sweep, dict) or not sweep:
+        raise ValueError('Sweep must map sections to keys to swept values')
+    names = []
+    values = []
+    for section in sorted(sweep.keys()):
+        if not isinstance(sweep[section], dict) or not sweep[section]:
+            raise ValueError('Sweep must map sections to keys to swept values')
+        for key in sorted(sweep[section].keys()):
+            vals = sweep[section][key]
+            if not isinstance(vals, list) or not vals:
+                raise ValueError('Swept values of %s.%s must be a non-empty '
+                                 'list' % (section, key))
+            names.append((section, key))
+            # Run params are given as strings.
+            values.append([val if isinstance(val, basestring) else str(val)
+                           for val in vals])
+
+    count = 1
+    for vals in values:
+        count *= len(vals)
+    if count < 2 or count > _max_array_size:
+        raise ValueError('Sweep gives %d runs. Must give 2 to %d.'
+                         % (count, _max_array_size))
+
+    elements = []
+    for combination in product(*values):
+        params = copy.deepcopy(run_params) if run_params else {}
+        swept = {}
+        for (section, key), val in zip(names, combination):
+            params.setdefault(section, {})[key] = val
+            swept['%s.%s' % (section, key)] = val
+        elements.append((params, swept))
+    return elements
+
 def job_init_state(job_id, mod_id, username, run_name, run_params,
                    job_state_file=None, mod_state_file=None,
-                   run_dir=None):
+                   run_dir=None, array=None):
 
     _logger.debug('Want JobState (init) at: %s' % time.time())
     with JobState(job_id, job_state_file) as job_state:
@@ -170,12 +317,17 @@ def job_init_state(job_id, mod_id, username, run_name, run_params,
         job_state['state'] = 'Setting up launch'
         job_state['error'] = None
         job_state['mod_status_output'] = None
+        job_state['mod_status_time'] = None
         job_state['output'] = None
+        job_state['output_file'] = None
         job_state['visible_files'] = None
         job_state['mod_name'] = None
+        job_state['array'] = None
+        job_state['hook_usage'] = {}
+        job_state['run_event'] = None
         job_state['_marked_for_del'] = False
         _logger.debug('Waiting on ModState at: %s' % time.time())
-        with ModState(mod_id, mod_state_file) as mod_state:
+        with ModState(mod_id, mod_state_file, readonly=True) as mod_state:
             _logger.debug('Done waiting on ModState at: %s' % time.time())
             if ('state' not in mod_state.keys()
                 or mod_state['state'] != 'Module ready'):
@@ -224,30 +376,196 @@ def job_init_state(job_id, mod_id, username, run_name, run_params,
         _logger.debug('state vals: %s' % str(job_state))
     _logger.debug('Run dir set')
 
+    if array is not None:
+        # Element run dirs are created by job_preprocess_array().
+        with JobState(job_id, job_state_file) as job_state:
+            job_state['array'] = [{
+                    'index': index,
+                    'params': swept,
+                    'state': 'Setting up launch',
+                    'error': None,
+                    'output_file': None,
+                    'run_event': None
+                } for index, swept in enumerate(array)
+            ]
+        try:
+            os.mkdir(run_dir)
+        except OSError:
+            # Thrown if dir already exists.
+            pass
+        return (0, 'Job state initialized')
+
     # The way the following is setup, if a run_dir has already been setup with
     # this run_name, it will be used (that is, not overwritten) for this launch.
-    try:
-        shutil.copytree(proj_loc, run_dir)
-    except (shutil.Error, OSError) as e:
-        pass
+    if not os.path.exists(run_dir):
+        link_mode = get_pce_config()['cluster']['run_dir_link']
+        try:
+            stats = materialize_run_dir(proj_loc, run_dir,
+                                        mutable=get_mutable_globs(proj_loc),
+                                        link_mode=link_mode)
+            _logger.debug('Run dir created: %d reflinked, %d linked, %d copied'
+                          % (stats['reflinked'], stats['linked'],
+                             stats['copied']))
+        except (IOError, OSError) as e:
+            _logger.warn('Creating run dir failed: %s' % str(e))
     if run_params:
-        _logger.debug('Handling run_params')
-        spec = os.path.join(run_dir, 'config/onramp_uioptions.cfgspec')
-        params = ConfigObj(run_params, configspec=spec)
-        result = params.validate(Validator())
-        if result:
-            with open(os.path.join(run_dir, 'onramp_runparams.cfg'), 'w') as f:
-                params.write(f)
-        else:
-            msg = 'Runparams failed validation'
-            _logger.warn(msg)
-            return (-1, msg)
+        ret = _write_run_params(run_dir, run_params)
+        if ret[0] != 0:
+            return ret
 
     return (0, 'Job state initialized')
 
+def _write_run_params(run_dir, run_params):
+    """Validate run params and write them to onramp_runparams.cfg in run_dir.
+    Args:
+        run_dir (str): Run dir of the job or array element.
+        run_params (dict): Run params to write.
+    Returns:
+        Tuple with 0th position being error code and 1st position being string
+        indication of status.
+    """
+    _logger.debug('Handling run_params')
+    spec = os.path.join(run_dir, 'config/onramp_uioptions.cfgspec')
+    params = ConfigObj(run_params, configspec=spec)
+    result = params.validate(Validator())
+    if result:
+        with open(os.path.join(run_dir, 'onramp_runparams.cfg'), 'w') as f:
+            params.write(f)
+    else:
+        msg = 'Runparams failed validation'
+        _logger.warn(msg)
+        return (-1, msg)
+    return (0, 'Runparams written')
+
+def _get_preprocess_params(mod_dir):
+    """Return the run params bin/onramp_preprocess.py of a module depends on.
+    Args:
+        mod_dir (str): Root folder of the installed module.
+    Returns:
+        List of SECTION.KEY names from the 'preprocess_params' key of the
+        [onramp] section of config/onramp_metadata.cfg, which is empty if the
+        key is given with no value. None if the key is not given or the file is
+        missing or badly formed, in which case preprocess may depend on any run
+        param.
+    """
+    cfg_file = os.path.join(mod_dir, 'config/onramp_metadata.cfg')
+    try:
+        conf = ConfigObj(cfg_file, file_error=True)
+    except (IOError, SyntaxError):
+        return None
+
+    if ('onramp' not in conf.keys()
+        or 'preprocess_params' not in conf['onramp'].keys()):
+        return None
+    names = conf['onramp']['preprocess_params']
+    if isinstance(names, basestring):
+        # Names is only a single string. Convert to list.
+        names = [names] if names else []
+    return names
+
+def _parse_walltime(value):
+    """Return a time limit given as minutes, MM:SS, or HH:MM:SS in seconds.
+
+    Raises:
+        ValueError: value is not a valid time limit.
+    """
+    try:
+        fields = [int(field) for field in str(value).split(':')]
+    except ValueError:
+        raise ValueError('Bad walltime: %s' % value)
+    if len(fields) > 3 or any(field < 0 for field in fields):
+        raise ValueError('Bad walltime: %s' % value)
+    if len(fields) == 1:
+        seconds = fields[0] * 60
+    else:
+        seconds = 0
+        for field in fields:
+            seconds = seconds * 60 + field
+    if seconds < 1:
+        raise ValueError('Bad walltime: %s' % value)
+    return seconds
+
+def _get_allocation(run_dir):
+    """Return the resources to request from the scheduler for a run.
+    np and nodes in the [onramp] section of onramp_runparams.cfg give the
+    number of tasks and nodes, and threads and walltime there, if given, the
+    cores per task and time limit. Keys of the same names in the [onramp_run]
+    section of the module's config/onramp.cfg give values for those not set by
+    the run params. threads_param there may name a run param (SECTION.KEY)
+    giving the cores per task, e.g. AUC.threads. Values not given either way
+    are taken from _default_allocation.
+    Args:
+        run_dir (str): Run dir of the job or array element.
+    Returns:
+        Dict with 'numtasks', 'num_nodes', 'threads', and 'walltime' (seconds,
+        or None for the scheduler's default) as for get_batch_script().
+    Raises:
+        ValueError: A value is not valid.
+    """
+    params = ConfigObj(os.path.join(run_dir, 'onramp_runparams.cfg'))
+    conf = ConfigObj(os.path.join(run_dir, 'config/onramp.cfg'))
+    run_params = params.get('onramp', {})
+    requirements = conf.get('onramp_run', {})
+
+    def lookup(key, param=None):
+        for value in [run_params.get(key), param,
+                      requirements.get(key)]:
+            if value not in (None, ''):
+                return value
+        return None
+
+    threads_param = None
+    if requirements.get('threads_param'):
+        section, _, key = requirements['threads_param'].rpartition('.')
+        threads_param = params.get(section, {}).get(key)
+
+    allocation = dict(_default_allocation)
+    for name, key, param in [('numtasks', 'np', None),
+                             ('num_nodes', 'nodes', None),
+                             ('threads', 'threads', threads_param)]:
+        value = lookup(key, param)
+        if value is None:
+            continue
+        try:
+            allocation[name] = int(value)
+        except (TypeError, ValueError):
+            raise ValueError('Bad %s: %s' % (key, value))
+        if allocation[name] < 1:
+            raise ValueError('Bad %s: %s' % (key, value))
+    if allocation['num_nodes'] > allocation['numtasks']:
+        raise ValueError('nodes (%d) exceeds np (%d)'
+                         % (allocation['num_nodes'], allocation['numtasks']))
+    walltime = lookup('walltime')
+    if walltime is not None:
+        allocation['walltime'] = _parse_walltime(walltime)
+    return allocation
+
+def _get_array_allocation(run_dir, count):
+    """Return the resources to request for each element of an array job,
+    large enough for every element.
+    Args:
+        run_dir (str): Run dir of the array job.
+        count (int): Number of array elements.
+    Returns:
+        Dict as returned by _get_allocation().
+    Raises:
+        ValueError: A value is not valid for some element.
+    """
+    allocation = None
+    for index in range(count):
+        element = _get_allocation(os.path.join(run_dir, str(index)))
+        if allocation is None:
+            allocation = element
+            continue
+        for name in ['numtasks', 'num_nodes', 'threads']:
+            allocation[name] = max(allocation[name], element[name])
+        if element['walltime'] is not None:
+            allocation['walltime'] = max(allocation['walltime'] or 0,
+                                         element['walltime'])
+    return allocation
+
 
 def job_preprocess(job_id, job_state_file=None):
-    ret_dir = os.getcwd()
     _logger.info('Calling bin/onramp_preprocess.py')
     _logger.debug('Want JobState (preprocess) at: %s' % time.time())
     with JobState(job_id, job_state_file) as job_state:
@@ -256,17 +574,10 @@ def job_preprocess(job_id, job_state_file=None):
         job_state['state'] = 'Preprocessing'
         job_state['error'] = None
         run_dir = job_state['run_dir']
-    os.chdir(run_dir)
     _logger.debug('Done with JobState (preprocess) at: %s' % time.time())
 
-    try:
-        result = check_output([os.path.join(pce_root, 'src/env/bin/python'),
-                               'bin/onramp_preprocess.py'], stderr=STDOUT)
-    except CalledProcessError as e:
-        code = e.returncode
-        if code > 127:
-            code -= 256
-        result = e.output
+    code, result = _preprocess_run_dir(job_id, run_dir, job_state_file)
+    if code != 0:
         msg = ('Preprocess exited with return status %d and output: %s'
                % (code, result))
         with JobState(job_id, job_state_file) as job_state:
@@ -277,49 +588,226 @@ def job_preprocess(job_id, job_state_file=None):
                 _delete_job(job_state)
                 return (-2, 'Job %d deleted' % job_id)
         return (-1, msg)
+
+    return (0, 'Job preprocess complete')
+
+def _preprocess_run_dir(job_id, run_dir, job_state_file=None):
+    """Run bin/onramp_preprocess.py in a run dir, using the build cache.
+    Build outputs cached from an earlier run with identical build inputs are
+    restored before the script runs, so the module's build finds them up to
+    date, and the outputs of a build that missed are cached after it. The
+    script's resource usage is added to the job's hook_usage.
+    Args:
+        job_id (int): Id of the job.
+        run_dir (str): Run dir of the job or array element.
+    Kwargs:
+        job_state_file (str): As for JobState.
+    Returns:
+        Tuple of the exit status and output of the script, as for run_hook().
+    """
+    cache = get_build_cache()
+    spec = get_build_spec(run_dir) if cache else None
+    key = None
+    if spec:
+        try:
+            key = cache.get_key(run_dir, spec)
+            if cache.restore(run_dir, key):
+                _logger.debug('Build cache hit for job %s: %s' % (job_id, key))
+                key = None
+        except (IOError, OSError) as e:
+            _logger.warn('Build cache restore failed: %s' % str(e))
+            key = None
+
+    usage = {}
+    try:
+        code, result = run_hook(run_dir, 'bin/onramp_preprocess.py',
+                                log_id='preprocess', usage=usage)
     finally:
-        module_log(run_dir, 'preprocess', result)
-        os.chdir(ret_dir)
+        _record_hook_usage(job_id, 'preprocess', usage, job_state_file)
+    if code == 0 and key:
+        try:
+            cache.store(run_dir, spec, key)
+        except (IOError, OSError) as e:
+            _logger.warn('Build cache store failed: %s' % str(e))
+    return (code, result)
+
+def _record_hook_usage(job_id, phase, usage, job_state_file=None):
+    """Add the resource usage of a hook run to the job's hook_usage.
+    Args:
+        job_id (int): Id of the job.
+        phase (str): Hook phase, e.g. 'preprocess'.
+        usage (dict): Usage filled in by run_hook(). Nothing is recorded if
+            empty, i.e. the hook could not be run.
+    Kwargs:
+        job_state_file (str): As for JobState.
+    """
+    if not usage:
+        return
+    with JobState(job_id, job_state_file) as job_state:
+        if 'state' in job_state.keys():
+            add_usage(job_state.setdefault('hook_usage', {}), phase, usage)
 
+def job_preprocess_array(job_id, elements, job_state_file=None,
+                         mod_state_file=None):
+    """Create the run dirs of the elements of an array job and preprocess them.
+    If the module lists the run params its preprocess depends on (see
+    _get_preprocess_params()), elements are grouped by the values of those
+    params, bin/onramp_preprocess.py is run once per group, and the run dirs
+    of the other elements of the group are created from the preprocessed one.
+    Otherwise each element is preprocessed in its own run dir.
+    Args:
+        job_id (int): Id of the array job.
+        elements (list of dict): Run params of each element, as given by
+            expand_sweep().
+    Kwargs:
+        job_state_file (str): As for JobState.
+        mod_state_file (str): As for ModState.
+    Returns:
+        Tuple with 0th position being error code and 1st position being string
+        indication of status.
+    """
+    _logger.info('Preprocessing array job %s' % job_id)
+    with JobState(job_id, job_state_file) as job_state:
+        job_state['state'] = 'Preprocessing'
+        job_state['error'] = None
+        for element in job_state['array']:
+            element['state'] = 'Preprocessing'
+        run_dir = job_state['run_dir']
+        mod_id = job_state['mod_id']
+    with ModState(mod_id, mod_state_file, readonly=True) as mod_state:
+        proj_loc = mod_state.get('installed_path')
+
+    shared = _get_preprocess_params(proj_loc) if proj_loc else None
+    groups = collections.OrderedDict()
+    for index, params in enumerate(elements):
+        if shared is None:
+            groups[index] = [index]
+            continue
+        key = []
+        for name in shared:
+            section, _, param = name.rpartition('.')
+            key.append(params.get(section, {}).get(param))
+        groups.setdefault(tuple(key), []).append(index)
+
+    msg = None
+    preprocessed = 0
+    try:
+        if proj_loc is None:
+            raise OSError('Module not installed')
+        link_mode = get_pce_config()['cluster']['run_dir_link']
+        mutable = get_mutable_globs(proj_loc)
+        for indices in groups.values():
+            src = proj_loc
+            for index in indices:
+                elem_dir = os.path.join(run_dir, str(index))
+                if not os.path.exists(elem_dir):
+                    materialize_run_dir(src, elem_dir, mutable=mutable,
+                                        link_mode=link_mode)
+                ret = _write_run_params(elem_dir, elements[index])
+                if ret[0] != 0:
+                    msg = 'Element %d: %s' % (index, ret[1])
+                    break
+                if src != proj_loc:
+                    continue
+                code, result = _preprocess_run_dir(job_id, elem_dir,
+                                                   job_state_file)
+                preprocessed += 1
+                if code != 0:
+                    msg = ('Preprocess of element %d exited with return '
+                           'status %d and output: %s' % (index, code, result))
+                    break
+                # Remaining elements of the group share this preprocess.
+                src = elem_dir
+            if msg:
+                break
+    except (IOError, OSError) as e:
+        msg = 'Creating run dirs failed: %s' % str(e)
+
+    if msg:
+        with JobState(job_id, job_state_file) as job_state:
+            job_state['state'] = 'Preprocess failed'
+            job_state['error'] = msg
+            for element in job_state['array']:
+                element['state'] = 'Preprocess failed'
+            _logger.error(msg)
+            if job_state['_marked_for_del']:
+                _delete_job(job_state)
+                return (-2, 'Job %d deleted' % job_id)
+        return (-1, msg)
+
+    _logger.debug('Array job %s: %d preprocess runs for %d elements'
+                  % (job_id, preprocessed, len(elements)))
     return (0, 'Job preprocess complete')
 
 def job_run(job_id, job_state_file=None):
     # Determine batch scheduler to user from config.
-    cfg = ConfigObj(os.path.join(pce_root, 'bin', 'onramp_pce_config.cfg'),
-                    configspec=os.path.join(pce_root, 'src', 'configspecs',
-                                            'onramp_pce_config.cfgspec'))
-    cfg.validate(Validator())
-    scheduler = Scheduler(cfg['cluster']['batch_scheduler'])
+    scheduler = get_scheduler()
 
-    ret_dir = os.getcwd()
     with JobState(job_id, job_state_file) as job_state:
         run_dir = job_state['run_dir']
         run_name = job_state['run_name']
-    os.chdir(run_dir)
+        array = job_state.get('array')
+
+    # Size the allocation from run params and module requirements.
+    try:
+        if array:
+            allocation = _get_array_allocation(run_dir, len(array))
+        else:
+            allocation = _get_allocation(run_dir)
+    except ValueError as e:
+        msg = 'Bad job resources: %s' % str(e)
+        _logger.error(msg)
+        with JobState(job_id, job_state_file) as job_state:
+            job_state['state'] = 'Schedule failed'
+            job_state['error'] = msg
+            for element in job_state.get('array') or []:
+                element['state'] = 'Schedule failed'
+            if job_state['_marked_for_del']:
+                _delete_job(job_state)
+                return (-2, 'Job %d deleted' % job_id)
+        return (-1, msg)
+
+    # Remove run events of earlier launches in the same run dir.
+    event_dirs = [run_dir]
+    if array:
+        event_dirs = [os.path.join(run_dir, str(index))
+                      for index in range(len(array))]
+    for event_dir in event_dirs:
+        try:
+            os.remove(os.path.join(event_dir, _run_event_file))
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
 
     # Write batch script.
-    with open('script.sh', 'w') as f:
-        f.write(scheduler.get_batch_script(run_name))
+    with open(os.path.join(run_dir, 'script.sh'), 'w') as f:
+        if array:
+            f.write(scheduler.get_array_batch_script(run_name, len(array),
+                                                     **allocation))
+        else:
+            f.write(scheduler.get_batch_script(run_name, **allocation))
 
     # Schedule job.
     result = scheduler.schedule(run_dir)
 
     if result['status_code'] != 0:
-        _logger.error(result['msg'])
+        _logger.error(result['status_msg'])
         with JobState(job_id, job_state_file) as job_state:
             job_state['state'] = 'Schedule failed'
-            job_state['error'] = result['msg']
-            os.chdir(ret_dir)
+            job_state['error'] = result['status_msg']
+            for element in job_state.get('array') or []:
+                element['state'] = 'Schedule failed'
             if job_state['_marked_for_del']:
                 _delete_job(job_state)
                 return (-2, 'Job %d deleted' % job_id)
-        return (result['returncode'], result['msg'])
+        return (result['status_code'], result['status_msg'])
     
     with JobState(job_id, job_state_file) as job_state:
         job_state['state'] = 'Scheduled'
         job_state['error'] = None
         job_state['scheduler_job_num'] = result['job_num']
-        os.chdir(ret_dir)
+        for element in job_state.get('array') or []:
+            element['state'] = 'Scheduled'
         if job_state['_marked_for_del']:
             _delete_job(job_state)
             return (-2, 'Job %d deleted' % job_id)
@@ -344,147 +832,385 @@ def job_postprocess(job_id, job_state_file=None):
         mod_name = job_state['mod_name']
         run_dir = job_state['run_dir']
     args = (username, mod_name, mod_id, run_name)
-    ret_dir = os.getcwd()
 
-    os.chdir(run_dir)
-    _logger.debug('Calling bin/onramp_postprocess.py')
-    try:
-        result = check_output([os.path.join(pce_root, 'src/env/bin/python'),
-                               'bin/onramp_postprocess.py'], stderr=STDOUT)
-    except CalledProcessError as e:
-        code = e.returncode
-        if code > 127:
-            code -= 256
-        result = e.output
+    usage = {}
+    code, result = run_hook(run_dir, 'bin/onramp_postprocess.py',
+                            log_id='postprocess', usage=usage)
+    if code != 0:
         msg = ('Postprocess exited with return status %d and output: %s'
                % (code, result))
         with JobState(job_id, job_state_file) as job_state:
             job_state['state'] = 'Postprocess failed'
             job_state['error'] = msg
+            add_usage(job_state.setdefault('hook_usage', {}), 'postprocess',
+                      usage)
             _logger.error(msg)
-            os.chdir(ret_dir)
             if job_state['_marked_for_del']:
                 _delete_job(job_state)
                 return (-2, 'Job %d deleted' % job_id)
         return (-1, msg)
-    finally:
-        module_log(run_dir, 'postprocess', result)
 
-    # Grab job output.
-    with open('output.txt', 'r') as f:
-        output = f.read()
-    os.chdir(ret_dir)
+    # Reference job output. It is served from the file, not stored in state.
+    output_file = _get_output_ref(job_id, run_dir)
 
     # Update state.
     with JobState(job_id, job_state_file) as job_state:
         job_state['state'] = 'Done'
         job_state['error'] = None
-        job_state['output'] = output
+        job_state['output_file'] = output_file
+        add_usage(job_state.setdefault('hook_usage', {}), 'postprocess',
+                  usage)
         if job_state['_marked_for_del']:
             _delete_job(job_state)
             return (-2, 'Job %d deleted' % job_id)
 
-def _get_module_status_output(run_dir):
+def _get_output_ref(job_id, run_dir, element=None):
+    """Return reference to the output file of a finished job.
+    Args:
+        job_id (int): Id of the job.
+        run_dir (str): Run dir of the job, or of the array element.
+    Kwargs:
+        element (int/None): Index of the array element, if any.
+    Returns:
+        Dict with the following fields:
+            name: Name of the file in run_dir.
+            size: Size in bytes.
+            sha256: Hex SHA-256 digest of the contents.
+            url: API endpoint serving the contents.
+    """
+    digest = hashlib.sha256()
+    size = 0
+    with open(os.path.join(run_dir, 'output.txt'), 'rb') as f:
+        for chunk in iter(lambda: f.read(_output_chunk_size), ''):
+            digest.update(chunk)
+            size += len(chunk)
+    return {
+        'name': 'output.txt',
+        'size': size,
+        'sha256': digest.hexdigest(),
+        'url': 'jobs/%s/output%s' % (job_id, '' if element is None else
+                                     '?element=%d' % element)
+    }
+
+def _get_module_status_output(run_dir, timeout=None, usage=None):
     """Run bin/onramp_status.py for job and return any output.
     Args:
         run_dir (str): run dir (as given by job state) for the module.
+    Kwargs:
+        timeout (int/None): If given, kill the script after this many seconds.
+        usage (dict): If given, filled in with the script's resource usage, as
+            for run_hook().
     Returns:
         String containint output to stdout and stderr frob job's
         bin/onramp_status.py script.
     """
-    ret_dir = os.getcwd()
-
     # Run bin/onramp_status.py and grab output.
-    os.chdir(run_dir)
-    _logger.debug('Calling bin/onramp_status.py')
     try:
-        output = check_output([os.path.join(pce_root, 'src/env/bin/python'),
-                               'bin/onramp_status.py'], stderr=STDOUT)
-    except CalledProcessError as e:
-        code = e.returncode
-        if code > 127:
-            code -= 256
+        code, output = run_hook(run_dir, 'bin/onramp_status.py',
+                                log_id='status', timeout=timeout, usage=usage)
+    except HookTimeout as e:
+        return ('Status timed out after %d seconds with output: %s'
+                % (e.timeout, e.output))
+    except OSError as e:
+        return 'Status could not be run: %s' % str(e)
+    if code != 0:
         output = ('Status exited with return status %d and output: %s'
-               % (code, e.output))
-
-    module_log(run_dir, 'status', output)
-    os.chdir(ret_dir)
+               % (code, output))
     return output
 
-def _build_job(job_id, job_state_file=None):
+def _status_hook_due(job_state):
+    """Return whether bin/onramp_status.py should be started for a running job.
+    The hook is due if it is not already running for the job and its output
+    is older than status_hook_interval seconds. A run that has not recorded
+    its output well after status_hook_timeout (e.g. because the process
+    running it exited) is ignored.
+    Args:
+        job_state (JobState): State of the running job.
+    Returns:
+        True if the hook should be started, else False.
+    """
+    cfg = get_pce_config()['cluster']
+    now = time.time()
+    started = job_state.get('_mod_status_started')
+    if started is not None and now - started < 2 * cfg['status_hook_timeout']:
+        return False
+    last = job_state.get('mod_status_time')
+    return last is None or now - last >= cfg['status_hook_interval']
+
+def _run_status_hook(job_id, run_dir, job_state_file=None):
+    """Run bin/onramp_status.py for a running job and record its output.
+    Intended to run in its own thread, started by _update_job_status(). The
+    job's state lock is only held to record the output, which is dropped if
+    the job is no longer running.
+    Args:
+        job_id (int): Id of the job.
+        run_dir (str): Run dir of the job.
+    Kwargs:
+        job_state_file (str): As for JobState.
+    """
+    timeout = get_pce_config()['cluster']['status_hook_timeout']
+    output = None
+    usage = {}
+    try:
+        output = _get_module_status_output(run_dir, timeout=timeout,
+                                           usage=usage)
+    except Exception as e:
+        _logger.error('Status hook for job %s failed: %s' % (job_id, str(e)))
+    finally:
+        with JobState(job_id, job_state_file) as job_state:
+            if 'state' not in job_state.keys():
+                return
+            job_state['_mod_status_started'] = None
+            if usage:
+                add_usage(job_state.setdefault('hook_usage', {}), 'status',
+                          usage)
+            if output is not None and job_state['state'] == 'Running':
+                job_state['mod_status_output'] = output
+                job_state['mod_status_time'] = time.time()
+
+def _update_job_status(job_state, job_status, job_state_file=None):
+    """Update state of an active job as per its scheduler status.
+    Initiates postprocessing if the job is done and starts
+    bin/onramp_status.py in the background if the job is running and its
+    status output is due for refresh. job_state must be held with its lock.
+    Args:
+        job_state (JobState): State of the job to update.
+        job_status (tuple): Scheduler status of the job as returned by
+            check_status().
+    Kwargs:
+        job_state_file (str): As for JobState.
+    Returns:
+        True if the job failed or was deleted, else False.
+    """
+    # Bad.
+    if job_status[0] != 0:
+        _logger.debug('Bad job status: %s' % job_status[1])
+        job_state['state'] = 'Run failed'
+        job_state['error'] = job_status[1]
+        if job_status[0] != -2:
+            job_state['state'] = job_status[1]
+        if job_state['_marked_for_del']:
+            _delete_job(job_state)
+        return True
+
+    # Good.
+    if job_status[1] in ['Done', 'No info']:
+        job_state['state'] = 'Postprocessing'
+        if job_state['_marked_for_del']:
+            _delete_job(job_state)
+            return True
+        job_state['error'] = None
+        job_state['mod_status_output'] = None
+        job_state['mod_status_time'] = None
+        p = Process(target=job_postprocess,
+                    args=(job_state.job_id, job_state_file))
+        p.start()
+    elif job_status[1] == 'Running':
+        job_state['state'] = 'Running'
+        job_state['error'] = None
+        if job_state['_marked_for_del']:
+            _delete_job(job_state)
+            return True
+        # Status output is refreshed in the background. Requests get the
+        # output from the latest run.
+        if _status_hook_due(job_state):
+            job_state['_mod_status_started'] = time.time()
+            t = threading.Thread(target=_run_status_hook,
+                                 name='StatusHook-%s' % job_state.job_id,
+                                 args=(job_state.job_id, job_state['run_dir'],
+                                       job_state_file))
+            t.daemon = True
+            t.start()
+    elif job_status[1] == 'Queued':
+        job_state['state'] = 'Queued'
+        job_state['error'] = None
+        if job_state['_marked_for_del']:
+            _delete_job(job_state)
+            return True
+    return False
+
+def _update_array_status(job_state, statuses, job_state_file=None):
+    """Update state of an active array job as per the scheduler status of its
+    elements.
+    Initiates postprocessing of each element found done, and sets the state of
+    the job from the states of its elements. job_state must be held with its
+    lock.
+    Args:
+        job_state (JobState): State of the array job to update.
+        statuses (dict): Scheduler status of each element as returned by
+            check_array_status().
+    Kwargs:
+        job_state_file (str): As for JobState.
+    Returns:
+        True if the job was deleted, else False.
+    """
+    if job_state['_marked_for_del']:
+        _delete_job(job_state)
+        return True
+
+    for element in job_state['array']:
+        status = statuses.get(element['index'])
+        if element['state'] not in _status_check_states or status is None:
+            continue
+        if status[0] != 0:
+            element['state'] = 'Run failed'
+            element['error'] = status[1]
+        elif status[1] in ['Done', 'No info']:
+            element['state'] = 'Postprocessing'
+            element['error'] = None
+            p = Process(target=_postprocess_array_element,
+                        args=(job_state.job_id, element['index'],
+                              job_state_file))
+            p.start()
+        elif status[1] in ['Running', 'Queued']:
+            element['state'] = status[1]
+            element['error'] = None
+    _set_array_state(job_state)
+    return False
+
+def _set_array_state(job_state):
+    """Set the state of an array job from the states of its elements.
+    The job is Running, Queued, Scheduled, or Postprocessing while any element
+    is, in that order. Once all elements are finished it is Done, with the
+    failed elements given in its error, or Run failed if all elements failed.
+    Args:
+        job_state (JobState): State of the array job.
+    """
+    states = [element['state'] for element in job_state['array']]
+    for state in ['Running', 'Queued', 'Scheduled', 'Postprocessing']:
+        if state in states:
+            job_state['state'] = state
+            return
+
+    failed = [str(element['index']) for element in job_state['array']
+              if element['state'] != 'Done']
+    if len(failed) == len(states):
+        job_state['state'] = 'Run failed'
+        job_state['error'] = 'All array elements failed'
+    else:
+        job_state['state'] = 'Done'
+        job_state['error'] = None
+        if failed:
+            job_state['error'] = ('Array elements failed: %s'
+                                  % ', '.join(failed))
+
+def _postprocess_array_element(job_id, index, job_state_file=None):
+    """Run bin/onramp_postprocess.py for an element of an array job and update
+    state to reflect.
+    Args:
+        job_id (int): Id of the array job.
+        index (int): Index of the element.
+    Kwargs:
+        job_state_file (str): As for JobState.
+    """
+    with JobState(job_id, job_state_file, readonly=True) as job_state:
+        run_dir = job_state.get('run_dir')
+    if run_dir is None:
+        return
+    elem_dir = os.path.join(run_dir, str(index))
+
+    usage = {}
+    try:
+        code, result = run_hook(elem_dir, 'bin/onramp_postprocess.py',
+                                log_id='postprocess', usage=usage)
+    except OSError as e:
+        code, result = (-1, str(e))
+    output_file = None
+    if code == 0:
+        try:
+            output_file = _get_output_ref(job_id, elem_dir, element=index)
+        except IOError:
+            # No output.
+            pass
+
+    with JobState(job_id, job_state_file) as job_state:
+        if 'state' not in job_state.keys():
+            return
+        element = job_state['array'][index]
+        if usage:
+            add_usage(job_state.setdefault('hook_usage', {}), 'postprocess',
+                      usage)
+        if code != 0:
+            element['state'] = 'Postprocess failed'
+            element['error'] = ('Postprocess exited with return status %d and '
+                                'output: %s' % (code, result))
+            _logger.error('Job %s element %d: %s'
+                          % (job_id, index, element['error']))
+        else:
+            element['state'] = 'Done'
+            element['error'] = None
+            element['output_file'] = output_file
+        _set_array_state(job_state)
+        if (job_state['_marked_for_del']
+            and job_state['state'] != 'Postprocessing'):
+            _delete_job(job_state)
+
+def _build_job(job_id, job_state_file=None, job_status=None):
     """Launch actions required to maintain job state and/or currate job results
     and return the state.
     When current job state (as a function of both PCE state tracking and
     scheduler output) warrants, initiate job postprocessing and/or status
-    checking prior to building and returning state.
+    checking prior to building and returning state. If the job poller is
+    running, scheduler status is left to it and state is only read.
     Args:
         job_id (int): Id of the job to get state for.
+    Kwargs:
+        job_status (tuple/None): Scheduler status of the job as returned by
+            check_status(), or for array jobs of its elements as returned by
+            check_array_status(), if already known. If None and the job is
+            active, the scheduler is queried for it.
     Returns:
         OnRamp formatted dictionary containing job attrs.
     """
-    status_check_states = ['Scheduled', 'Queued', 'Running']
-    with JobState(job_id, job_state_file) as job_state:
+    check_status = not _polling or job_status is not None
+
+    # Only take the state lock if scheduler state may need to be recorded.
+    job_state = JobState(job_id, job_state_file, readonly=True)
+    if check_status and job_state.get('state') in _status_check_states:
+        job_state = JobState(job_id, job_state_file)
+
+    with job_state:
         _logger.debug('Building at %s' % time.time())
         if 'state' not in job_state.keys():
             _logger.debug('No state at %s' % time.time())
             _logger.debug('job_state keys: %s' % job_state.keys())
             return {}
 
-        if job_state['state'] in status_check_states:
-            specfile = os.path.join(pce_root, 'src', 'configspecs',
-                                    'onramp_pce_config.cfgspec')
-            cfg = ConfigObj(os.path.join(pce_root, 'bin',
-                                         'onramp_pce_config.cfg'),
-                            configspec=specfile)
-            cfg.validate(Validator())
-            scheduler = Scheduler(cfg['cluster']['batch_scheduler'])
-            sched_job_num = job_state['scheduler_job_num']
-            job_status = scheduler.check_status(sched_job_num)
-
-            # Bad.
-            if job_status[0] != 0:
-                _logger.debug('Bad job status: %s' % job_status[1])
-                job_state['state'] = 'Run failed'
-                job_state['error'] = job_status[1]
-                if job_status[0] != -2:
-                    job_state['state'] = job_status[1]
-                if job_state['_marked_for_del']:
-                    _delete_job(job_state)
-                    # FIXME: This might cause trouble. About to return {}.
-                    return copy.deepcopy(job_state)
+        if (check_status and job_state['state'] in _status_check_states
+            and job_state.get('array')):
+            if job_status is None:
+                job_status = get_scheduler().check_array_status(
+                    job_state['scheduler_job_num'], len(job_state['array']))
+            if _update_array_status(job_state, job_status, job_state_file):
+                return copy.deepcopy(job_state)
+        elif check_status and job_state['state'] in _status_check_states:
+            event = None
+            if job_status is None:
+                event = _read_run_event(job_state['run_dir'])
+            if event is not None:
+                job_state['run_event'] = event
+                job_status = _get_event_status(event)
+            elif job_status is None:
+                scheduler = get_scheduler()
+                sched_job_num = job_state['scheduler_job_num']
+                job_status = scheduler.check_status(sched_job_num)
+            if _update_job_status(job_state, job_status, job_state_file):
+                # FIXME: This might cause trouble. About to return {} if the
+                # job was deleted.
                 return copy.deepcopy(job_state)
-
-            # Good.
-            if job_status[1] in ['Done', 'No info']:
-                job_state['state'] = 'Postprocessing'
-                if job_state['_marked_for_del']:
-                    _delete_job(job_state)
-                    # FIXME: This might cause trouble. About to return {}.
-                    return copy.deepcopy(job_state)
-                job_state['error'] = None
-                job_state['mod_status_output'] = None
-                p = Process(target=job_postprocess, args=(job_id, job_state_file))
-                p.start()
-            elif job_status[1] == 'Running':
-                job_state['state'] = 'Running'
-                job_state['error'] = None
-                if job_state['_marked_for_del']:
-                    _delete_job(job_state)
-                    # FIXME: This might cause trouble. About to return {}.
-                    return copy.deepcopy(job_state)
-                run_dir = job_state['run_dir']
-                mod_status_output = _get_module_status_output(run_dir)
-                job_state['mod_status_output'] = mod_status_output
-            elif job_status[1] == 'Queued':
-                job_state['state'] = 'Queued'
-                job_state['error'] = None
-                if job_state['_marked_for_del']:
-                    _delete_job(job_state)
-                    # FIXME: This might cause trouble. About to return {}.
-                    return copy.deepcopy(job_state)
 
         job = copy.deepcopy(job_state)
 
+    return _add_visible_files(job)
+
+def _add_visible_files(job):
+    """Add the visible files of a job's run folder to its state.
+    Args:
+        job (dict): State of the job. Modified in place.
+    Returns:
+        job, with 'visible_files' set on it, or on each of its array elements,
+        if the job has been launched.
+    """
     if job['state'] in ['Launch failed', 'Setting up launch']:
         return job
 
@@ -493,6 +1219,26 @@ def _build_job(job_id, job_state_file=None):
     dir_args = (job['username'], job['mod_name'], job['mod_id'],
                 job['run_name'])
     run_dir = os.path.join(pce_root, 'users/%s/%s_%d/%s' % dir_args)
+    if job.get('array'):
+        for element in job['array']:
+            element['visible_files'] = _get_visible_files(
+                os.path.join(run_dir, str(element['index'])))
+        return job
+
+    visible_files = _get_visible_files(run_dir)
+    if visible_files is not None:
+        job['visible_files'] = visible_files
+    return job
+
+def _get_visible_files(run_dir):
+    """Return the visible files of a job run.
+    Args:
+        run_dir (str): Run dir of the job or array element.
+    Returns:
+        List of dicts giving the name, size, and url of each file matching the
+        module's visible globs. None if config/onramp_metadata.cfg is missing or
+        badly formed.
+    """
     cfg_file = os.path.join(run_dir, 'config/onramp_metadata.cfg')
     try:
         conf = ConfigObj(cfg_file, file_error=True)
@@ -500,7 +1246,7 @@ def _build_job(job_id, job_state_file=None):
         # Badly formed or non-existant config/onramp_metadata.cfg.
         _logger.debug('Bad metadata')
         _logger.debug(cfg_file)
-        return job
+        return None
 
     if 'onramp' in conf.keys() and 'visible' in conf['onramp'].keys():
         globs = conf['onramp']['visible']
@@ -510,27 +1256,22 @@ def _build_job(job_id, job_state_file=None):
     else:
         globs = []
 
-    ret_dir = os.getcwd()
-    os.chdir(run_dir)
     filenames = [
-        name for name in
+        os.path.relpath(name, run_dir) for name in
         chain.from_iterable(
-            map(glob.glob, globs)
+            glob.glob(os.path.join(run_dir, entry)) for entry in globs
         )
     ]
 
     prefix = os.path.join(pce_root, 'users') + '/'
     url_prefix = run_dir.split(prefix)[1]
 
-    job['visible_files'] = [{
+    return [{
             'name': filename,
             'size': os.path.getsize(os.path.join(run_dir, filename)),
             'url': os.path.join('files', os.path.join(url_prefix, filename))
         } for filename in filenames
     ]
-    os.chdir(ret_dir)
-
-    return job
 
 def _clean_job(job):
     """Remove and key/value pairs from job where the key is prefixed by an
@@ -545,20 +1286,478 @@ def _clean_job(job):
             job.pop(key, None)
     return job
 
-def get_jobs(job_id=None, job_state_file=None):
+def get_jobs(job_id=None, job_state_file=None, state=None, username=None,
+             mod_id=None):
     """Return list of tracked jobs or single job.
     Kwargs:
         job_id (int/None): If int, return jobs resource with corresponding id.
             If None, return list of all tracked job resources.
+        state (str/list of str/None): If given, only list jobs in (one of) the
+            given state(s).
+        username (str/None): If given, only list jobs for the given user.
+        mod_id (int/None): If given, only list jobs of the given module.
     Returns:
         OnRamp formatted dict containing job attrs for each job requested.
     """
     if job_id:
         return _clean_job(_build_job(job_id, job_state_file))
 
-    return [_clean_job(_build_job(job_id)) for job_id in
-            filter(lambda x: not x.startswith('.'),
-                   os.listdir(_job_state_dir))]
+    found = get_state_backend().find('jobs', state=state, username=username,
+                                     mod_id=mod_id)
+    statuses = {} if _polling else _check_active_jobs(found)
+    jobs = []
+    for id, record in found:
+        # Only jobs whose scheduler status may need to be recorded are loaded
+        # again, under their state lock. Others are built from the listing.
+        if not _polling and record.get('state') in _status_check_states:
+            job = _build_job(id, job_status=statuses.get(id))
+        else:
+            job = _add_visible_files(record)
+        jobs.append(_clean_job(job))
+    return jobs
+
+def get_job_etag(job_id):
+    """Return an entity tag for a job resource from its state record alone.
+    The resource of a settled job, one that is in a _settled_states state
+    along with all of its array elements, only changes when its state is
+    stored, so it is identified by the change journal sequence number of the
+    record. Other jobs may have their scheduler status checked or visible files
+    written without their state being stored.
+    Args:
+        job_id (int): Id of the job.
+    Returns:
+        Quoted entity tag, or None if the job does not exist or is not
+        settled.
+    """
+    record = load_state('jobs', job_id, snapshot=True)
+    if not record or '_seq' not in record:
+        return None
+    states = [record.get('state')]
+    states += [element['state'] for element in record.get('array') or []]
+    for state in states:
+        if state not in _settled_states:
+            return None
+    return '"s%d"' % record['_seq']
+
+def get_job_output_file(job_id, element=None):
+    """Return path of the output file of a job.
+    Args:
+        job_id (int): Id of the job.
+    Kwargs:
+        element (int/None): Index of the array element to return the output
+            file of, for array jobs.
+    Returns:
+        Tuple with 0th position being error code and 1st position being the
+        absolute path of the output file on success or string indication of
+        status on error. The code is 1 if the job is still running and the
+        file may grow.
+    """
+    with JobState(job_id, readonly=True) as job_state:
+        if 'state' not in job_state.keys():
+            return (-1, 'Job %d does not exist' % job_id)
+        state = job_state['state']
+        run_dir = job_state.get('run_dir')
+        array = job_state.get('array')
+
+    if element is not None:
+        if not array or not 0 <= element < len(array):
+            return (-1, 'Job %d has no array element %d' % (job_id, element))
+        state = array[element]['state']
+        if run_dir is not None:
+            run_dir = os.path.join(run_dir, str(element))
+    if run_dir is None:
+        return (-2, 'Job %d has no output' % job_id)
+    filename = os.path.join(run_dir, 'output.txt')
+    if not os.path.isfile(filename):
+        return (-2, 'Job %d has no output' % job_id)
+    if state in _output_states:
+        return (1, filename)
+    return (0, filename)
+
+def follow_job_output(job_id, offset=0, interval=1, max_time=3600,
+                      element=None):
+    """Yield output of a job as it is written, like tail -f.
+    Output already written after offset is yielded first. The file is then
+    checked for new output every interval seconds until the job leaves the
+    states in which output is written, its remaining output has been yielded,
+    or max_time seconds pass.
+    Args:
+        job_id (int): Id of the job.
+    Kwargs:
+        offset (int): Byte offset in the output file to start from.
+        interval (float): Seconds between checks for new output.
+        max_time (float): Max seconds to follow the output for.
+        element (int/None): Index of the array element to follow the output
+            of, for array jobs.
+    Returns:
+        Generator of strings of at most 64KB of output.
+    """
+    output_name = 'output.txt'
+    if element is not None:
+        output_name = os.path.join(str(element), output_name)
+    run_dir = None
+    deadline = time.time() + max_time
+    state_checked = 0
+    f = None
+    try:
+        while True:
+            # Job state only advances when it is checked, so check it the way
+            # a client polling the job would.
+            active = True
+            if time.time() - state_checked >= 5 * interval:
+                job = _build_job(job_id)
+                state_checked = time.time()
+                state = job.get('state')
+                if element is not None and job.get('array'):
+                    state = job['array'][element]['state']
+                active = state in _output_states
+                run_dir = job.get('run_dir', run_dir)
+
+            if f is None and run_dir is not None:
+                try:
+                    f = open(os.path.join(run_dir, output_name), 'rb')
+                    f.seek(offset)
+                except IOError as e:
+                    if e.errno != errno.ENOENT:
+                        raise
+            if f is not None:
+                for chunk in iter(lambda: f.read(_output_chunk_size), ''):
+                    yield chunk
+
+            if not active or time.time() >= deadline:
+                return
+            time.sleep(interval)
+    finally:
+        if f is not None:
+            f.close()
+
+def get_job_changes(since, state=None, username=None, mod_id=None):
+    """Return jobs stored or deleted since the given change journal sequence
+    number.
+    Jobs are returned as last stored. Unlike get_jobs(), scheduler status is not
+    checked and visible files are not listed.
+    Args:
+        since (int): Sequence number returned by the previous call, 0 to return
+            all jobs.
+    Kwargs:
+        state, username, mod_id: As for get_jobs(). Only applied to changed
+            jobs.
+    Returns:
+        Tuple of the sequence number to pass as since on the next call, the list
+        of changed jobs, and the list of ids of deleted jobs.
+    """
+    seq, changed, deleted = get_changes('jobs', since, state=state,
+                                        username=username, mod_id=mod_id)
+    return (seq, [_clean_job(record) for id, record in changed], deleted)
+
+def watch_job(job_id, since=None, timeout=30):
+    """Wait for a job to change, for long-polling clients.
+    Returns at once if the job has been stored since the given change journal
+    sequence number, and otherwise as soon as it is, or after timeout seconds.
+    Unless the job poller is running, the scheduler status of an active job
+    is checked every _watch_check_interval seconds while waiting, as a client
+    polling the job would.
+    Args:
+        job_id (int): Id of the job.
+    Kwargs:
+        since (int/None): Sequence number returned by the previous call. If
+            None, return at once.
+        timeout (float): Max seconds to wait.
+    Returns:
+        Tuple of the sequence number to pass as since on the next call and the
+        job as returned by get_jobs(), which is {} if the job does not exist.
+    """
+    deadline = time.time() + timeout
+    backend = get_state_backend()
+    journal_seq = backend.last_seq()
+    while True:
+        # Read from the backend, as the state cache may not yet have seen a
+        # change the notifier has.
+        record = load_state('jobs', job_id)
+        if record is None:
+            return (journal_seq, {})
+        seq = record.get('_seq', 0)
+        remaining = deadline - time.time()
+        if since is None or seq > since or remaining <= 0:
+            break
+        check_status = (not _polling
+                        and record.get('state') in _status_check_states)
+        if check_status:
+            remaining = min(remaining, _watch_check_interval)
+        new_seq = wait_for_changes(journal_seq, remaining)
+        if new_seq is None:
+            # Shutting down.
+            break
+        if new_seq == journal_seq and check_status:
+            _build_job(job_id)
+        elif backend.is_applying('jobs', job_id):
+            # The change may be to this job, and not yet applied. Keep
+            # journal_seq so the record is read again.
+            time.sleep(_applying_wait)
+            continue
+        journal_seq = new_seq
+    return (seq, get_jobs(job_id=job_id))
+
+def follow_job_changes(since=None, state=None, username=None, mod_id=None,
+                       heartbeat=15, max_time=3600):
+    """Yield changes to jobs as they are stored, for streaming to clients.
+    Jobs are yielded as last stored, as for get_job_changes(), so their
+    scheduler status only advances if the job poller or run event checks are
+    running.
+    Kwargs:
+        since (int/None): Sequence number of the last change already seen, 0
+            to start with all jobs. If None, start with the next change.
+        state, username, mod_id: As for get_job_changes().
+        heartbeat (float): Seconds without changes after which None is
+            yielded, so the caller can keep its connection alive.
+        max_time (float): Max seconds to follow changes for.
+    Returns:
+        Generator of (seq, changed, deleted) tuples as returned by
+        get_job_changes(), or None after heartbeat seconds without changes.
+    """
+    deadline = time.time() + max_time
+    if since is None:
+        since = get_state_backend().last_seq()
+    else:
+        seq, changed, deleted = get_job_changes(since, state=state,
+                                                username=username,
+                                                mod_id=mod_id)
+        if changed or deleted:
+            yield (seq, changed, deleted)
+        since = seq
+
+    while True:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            return
+        seq = wait_for_changes(since, min(heartbeat, remaining))
+        if seq is None:
+            # Shutting down.
+            return
+        if seq == since:
+            yield None
+            continue
+        seq, changed, deleted = get_job_changes(since, state=state,
+                                                username=username,
+                                                mod_id=mod_id)
+        if seq == since:
+            # The first change after since is not yet applied. Its record,
+            # and any changed after it, are returned once it is.
+            time.sleep(_applying_wait)
+            continue
+        if changed or deleted:
+            yield (seq, changed, deleted)
+        since = seq
+
+def _read_run_event(run_dir):
+    """Return the run event written by the batch script in a run dir.
+    Args:
+        run_dir (str): Run dir of the job or array element.
+    Returns:
+        Event dict as stored in job state, or None if the run has not ended or
+        the event file is badly formed.
+    """
+    try:
+        with open(os.path.join(run_dir, _run_event_file)) as f:
+            return _clean_run_event(json.load(f), 'file')
+    except (IOError, ValueError):
+        return None
+
+def _get_event_status(event):
+    """Translate a run event to a check_status() result."""
+    if event['exit_status'] == 0:
+        return (0, 'Done')
+    return (-2, 'Run exited with status %d' % event['exit_status'])
+
+def _clean_run_event(event, source):
+    """Return the run event to store in job state.
+    Raises:
+        ValueError: event is not a dict with an integer exit_status and
+            numeric started and finished times, if given.
+    """
+    if not isinstance(event, dict):
+        raise ValueError('Event must be an object')
+    exit_status = event.get('exit_status')
+    if (isinstance(exit_status, bool)
+        or not isinstance(exit_status, (int, long))):
+        raise ValueError('exit_status must be an integer')
+    clean = {'exit_status': int(exit_status), 'source': source}
+    for key in ['started', 'finished']:
+        value = event.get(key)
+        if value is not None and (isinstance(value, bool)
+                                  or not isinstance(value,
+                                                    (int, long, float))):
+            raise ValueError('%s must be a number of seconds since the epoch'
+                             % key)
+        clean[key] = value
+    return clean
+
+def apply_run_event(job_id, event, element=None, source='api',
+                    job_state_file=None):
+    """Record the end of the run of a job or array element.
+    The event is treated as the scheduler status of the job, so that
+    postprocessing is initiated at once, without waiting for the scheduler to
+    be checked. Events for jobs or elements no longer Scheduled, Queued, or
+    Running are ignored, so the same end may be reported more than once.
+    Args:
+        job_id (int): Id of the job.
+        event (dict): 'exit_status' of bin/onramp_run.py, and 'started' and
+            'finished' times in seconds since the epoch, if known.
+    Kwargs:
+        element (int/None): Index of the array element the event is for, for
+            array jobs.
+        source (str): How the event was received, recorded with it.
+        job_state_file (str): As for JobState.
+    Returns:
+        Tuple with 0th position being error code and 1st position being string
+        indication of status. The code is -1 if the job or element does not
+        exist and -8 if the event is malformed.
+    """
+    try:
+        event = _clean_run_event(event, source)
+    except ValueError as e:
+        return (-8, 'Invalid event: %s' % str(e))
+
+    with JobState(job_id, job_state_file) as job_state:
+        if 'state' not in job_state.keys():
+            return (-1, 'Job %d does not exist' % job_id)
+        array = job_state.get('array')
+        if array:
+            if element is None or not 0 <= element < len(array):
+                return (-1, 'Job %d has no array element %s'
+                        % (job_id, element))
+            target = array[element]
+        elif element is not None:
+            return (-1, 'Job %d has no array element %s' % (job_id, element))
+        else:
+            target = job_state
+
+        if (job_state['state'] not in _status_check_states
+            or target['state'] not in _status_check_states):
+            return (0, 'Event ignored: job is %s' % target['state'])
+
+        target['run_event'] = event
+        if event['finished'] is not None:
+            _logger.debug('Job %s run ended %.1f seconds ago'
+                          % (job_id, time.time() - event['finished']))
+        status = _get_event_status(event)
+        if array:
+            _update_array_status(job_state, {element: status},
+                                 job_state_file)
+        else:
+            _update_job_status(job_state, status, job_state_file)
+    return (0, 'Event recorded')
+
+def check_run_events():
+    """Apply the run events written by the batch scripts of active jobs.
+    Checks for the event file in the run dir of each Scheduled, Queued, or
+    Running job and array element, without calling the scheduler.
+    Returns:
+        Number of events applied.
+    """
+    # Reap finished job_postprocess() (and other) child processes.
+    active_children()
+
+    applied = 0
+    found = get_state_backend().find('jobs', state=_status_check_states)
+    for id, record in found:
+        run_dir = record.get('run_dir')
+        if run_dir is None or record.get('scheduler_job_num') is None:
+            continue
+        if record.get('array'):
+            targets = [(element['index'],
+                        os.path.join(run_dir, str(element['index'])))
+                       for element in record['array']
+                       if element['state'] in _status_check_states]
+        else:
+            targets = [(None, run_dir)]
+        for element, event_dir in targets:
+            event = _read_run_event(event_dir)
+            if event is None:
+                continue
+            try:
+                result = apply_run_event(id, event, element=element,
+                                         source='file')
+            except Exception as e:
+                _logger.error('Error applying run event of job %d: %s'
+                              % (id, str(e)))
+                continue
+            if result[1] == 'Event recorded':
+                applied += 1
+            elif result[0] != 0:
+                _logger.warn('Run event of job %d: %s' % (id, result[1]))
+    return applied
+
+def _check_active_jobs(found):
+    """Check scheduler status of all active jobs with one scheduler call.
+    Array jobs are not included. Their elements are checked with
+    check_array_status().
+    Args:
+        found (list): (id, job state record) tuples as returned by
+            _StateBackend.find().
+    Returns:
+        Dict mapping the id of each active job to its scheduler status as
+        returned by check_status().
+    """
+    active = dict((id, int(record['scheduler_job_num']))
+                  for id, record in found
+                  if record.get('state') in _status_check_states
+                  and record.get('scheduler_job_num') is not None
+                  and not record.get('array'))
+    if not active:
+        return {}
+    statuses = get_scheduler().check_status_many(active.values())
+    return dict((id, statuses[num]) for id, num in active.items()
+                if num in statuses)
+
+def poll_jobs():
+    """Update state of all active jobs from the batch scheduler.
+    All Scheduled, Queued and Running jobs are checked with a single scheduler
+    call, and the elements of each active array job with one call per array
+    job. Postprocessing is initiated for jobs and elements found done, and
+    finished postprocessing processes are reaped.
+    Returns:
+        Number of jobs checked.
+    """
+    # Jobs whose batch scripts have reported their end need no scheduler call.
+    check_run_events()
+
+    found = get_state_backend().find('jobs', state=_status_check_states)
+    statuses = _check_active_jobs(found)
+    for id, job_status in statuses.items():
+        try:
+            with JobState(id) as job_state:
+                # State may have changed since found.
+                if job_state.get('state') in _status_check_states:
+                    _update_job_status(job_state, job_status)
+        except Exception as e:
+            _logger.error('Error updating status of job %d: %s'
+                          % (id, str(e)))
+
+    arrays = [(id, record) for id, record in found
+              if record.get('array')
+              and record.get('scheduler_job_num') is not None]
+    for id, record in arrays:
+        try:
+            element_statuses = get_scheduler().check_array_status(
+                record['scheduler_job_num'], len(record['array']))
+            with JobState(id) as job_state:
+                # State may have changed since found.
+                if job_state.get('state') in _status_check_states:
+                    _update_array_status(job_state, element_statuses)
+        except Exception as e:
+            _logger.error('Error updating status of array job %d: %s'
+                          % (id, str(e)))
+    return len(statuses) + len(arrays)
+
+def enable_job_poller():
+    """Leave scheduler status checks of active jobs to poll_jobs().
+    Once enabled, get_jobs() only reads job state and no longer queries the
+    scheduler. Intended to be called by the process that calls poll_jobs()
+    periodically.
+    """
+    global _polling
+    _polling = True
 
 def init_job_delete(job_id):
     """Initiate the deletion of a job.
@@ -590,24 +1789,25 @@ def init_job_delete(job_id):
         
 def _delete_job(job_state):
     """Delete given job.
-    Both state for and contents of job will be removed.
+    Both state for and contents of job will be removed. State is removed from
+    storage when job_state is closed. The run folder is moved to the trash and
+    removed in the background.
     Args:
         job_state (JobState): State object for the job to remove.
     """
     job_cancel_states = ['Scheduled', 'Queued', 'Running']
     if job_state['state'] in job_cancel_states:
-        cfgfile = os.path.join(pce_root, 'bin', 'onramp_pce_config.cfg')
-        specfile = os.path.join(pce_root, 'src', 'configspecs',
-                                'onramp_pce_config.cfgspec')
-        cfg = ConfigObj(cfgfile, configspec=specfile)
-        cfg.validate(Validator())
-        scheduler = Scheduler(cfg['cluster']['batch_scheduler'])
-        result = scheduler.cancel_job(job_state['scheduler_job_num'])
+        scheduler = get_scheduler()
+        if job_state.get('array'):
+            result = scheduler.cancel_array_job(job_state['scheduler_job_num'])
+        else:
+            result = scheduler.cancel_job(job_state['scheduler_job_num'])
         _logger.debug('Cancel job output: %s' % result[1])
-    job_state_file = os.path.join(_job_state_dir, str(job_state['job_id']))
-    os.remove(job_state_file)
     args = (job_state['username'], job_state['mod_name'], job_state['mod_id'],
             job_state['run_name'])
     run_dir = os.path.join(pce_root, 'users/%s/%s_%d/%s' % args)
-    shutil.rmtree(run_dir, ignore_errors=True)
+    try:
+        trash_tree(run_dir)
+    except OSError as e:
+        _logger.error('Could not remove %s: %s' % (run_dir, e))
     job_state.clear()
\ No newline at end of file
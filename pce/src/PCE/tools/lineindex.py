@@ -0,0 +1,173 @@
+"""Line-offset indexes for paged reads of large job files.
+
+An index records the byte offset at which each line of a file starts, so a
+range of lines can be read without reading the lines before it. Indexes are
+built by scanning the file through mmap, are cached per file, and are extended
+incrementally as the file grows, so following a growing output file only
+scans newly written data.
+
+Exports:
+    LineIndex: Line-offset index over a single file.
+    get_line_index: Return the cached LineIndex for a file.
+    read_lines: Return a range of lines from a file.
+    read_tail: Return the last lines of a file.
+"""
+import collections
+import mmap
+import os
+import threading
+from array import array
+
+# Max number of files to keep indexes for.
+_max_indexes = 64
+_indexes = collections.OrderedDict()
+_indexes_lock = threading.Lock()
+
+class LineIndex(object):
+    """Line-offset index over a single file.
+
+    offsets[i] is the byte offset of the start of line i + 1. A final line
+    without a trailing newline is counted as a line. The index is rebuilt if
+    the file is replaced or truncated, and extended if it has grown.
+    """
+
+    def __init__(self, filename):
+        """Return an empty LineIndex for the given file.
+
+        Args:
+            filename (str): Path of the file to index.
+        """
+        self.filename = filename
+        self.lock = threading.Lock()
+        self._reset(None)
+
+    def _reset(self, inode):
+        """Discard the index."""
+        self._inode = inode
+        self._offsets = array('L', [0])
+        self._scanned = 0
+
+    def update(self):
+        """Bring the index up to date with the file, scanning only new data.
+
+        Must be called with lock held.
+
+        Returns:
+            Current size of the file in bytes.
+
+        Raises:
+            OSError: The file could not be read.
+        """
+        with open(self.filename, 'rb') as f:
+            st = os.fstat(f.fileno())
+            if st.st_ino != self._inode or st.st_size < self._scanned:
+                self._reset(st.st_ino)
+            size = st.st_size
+            if size == self._scanned:
+                return size
+
+            mm = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+            try:
+                offsets = self._offsets
+                pos = mm.find('\n', self._scanned)
+                while pos != -1:
+                    offsets.append(pos + 1)
+                    pos = mm.find('\n', pos + 1)
+            finally:
+                mm.close()
+            self._scanned = size
+        return size
+
+    def count(self, size):
+        """Return number of lines in the file when it was size bytes long."""
+        n = len(self._offsets)
+        if self._offsets[n - 1] == size:
+            # Ends in a newline (or is empty): no partial final line.
+            return n - 1
+        return n
+
+    def read(self, first, last):
+        """Return lines first to last of the file.
+
+        Must be called with lock held, after update().
+
+        Args:
+            first (int): 1-based number of the first line to return.
+            last (int): 1-based number of the last line to return. Clipped to
+                the number of lines in the file.
+
+        Returns:
+            String containing the lines, including line endings.
+        """
+        size = self._scanned
+        last = min(last, self.count(size))
+        if first > last:
+            return ''
+        start = self._offsets[first - 1]
+        end = self._offsets[last] if last < len(self._offsets) else size
+        with open(self.filename, 'rb') as f:
+            f.seek(start)
+            return f.read(end - start)
+
+
+def get_line_index(filename):
+    """Return the cached LineIndex for a file, creating it if needed.
+
+    The index is not updated. Callers must take its lock and call update()
+    before reading from it.
+
+    Args:
+        filename (str): Path of the file.
+
+    Returns:
+        LineIndex for the file.
+    """
+    filename = os.path.abspath(filename)
+    with _indexes_lock:
+        index = _indexes.pop(filename, None)
+        if index is None:
+            index = LineIndex(filename)
+        _indexes[filename] = index
+        while len(_indexes) > _max_indexes:
+            _indexes.popitem(last=False)
+    return index
+
+def read_lines(filename, first, last):
+    """Return a range of lines from a file.
+
+    Args:
+        filename (str): Path of the file.
+        first (int): 1-based number of the first line to return.
+        last (int): 1-based number of the last line to return.
+
+    Returns:
+        Tuple of the string containing the lines and the total number of lines
+        in the file.
+
+    Raises:
+        OSError, IOError: The file could not be read.
+    """
+    index = get_line_index(filename)
+    with index.lock:
+        size = index.update()
+        return (index.read(first, last), index.count(size))
+
+def read_tail(filename, n):
+    """Return the last lines of a file.
+
+    Args:
+        filename (str): Path of the file.
+        n (int): Number of lines to return.
+
+    Returns:
+        Tuple of the string containing the lines and the total number of lines
+        in the file.
+
+    Raises:
+        OSError, IOError: The file could not be read.
+    """
+    index = get_line_index(filename)
+    with index.lock:
+        size = index.update()
+        total = index.count(size)
+        return (index.read(max(1, total - n + 1), total), total)
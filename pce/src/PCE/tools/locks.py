@@ -0,0 +1,234 @@
+"""Kernel-backed locking for OnRamp module and job state.
+
+Locks are taken with fcntl.flock() on a per-resource lock file. Waiters sleep
+in the kernel rather than spinning, and a lock is released by the kernel when
+the process holding it exits, so a crashed holder can never leave a resource
+locked.
+
+Exports:
+    StateLock: Exclusive or shared lock on a state lock file.
+    LockTimeout: Raised when a lock is not acquired within its timeout.
+    is_locked: Return whether an exclusive lock is held on a lock file.
+    get_lock_stats: Return counters describing lock acquisitions and waits.
+"""
+import errno
+import fcntl
+import logging
+import os
+import threading
+import time
+
+_logger = logging.getLogger('onramp')
+# Pid of the process _stats_lock was created in. A forked child creates its
+# own, as one held by another thread at the fork would never be released.
+_stats_pid = os.getpid()
+_stats_lock = threading.Lock()
+_stats = {
+    'acquired': 0,
+    'contended': 0,
+    'timeouts': 0,
+    'wait_total': 0.0,
+    'wait_max': 0.0
+}
+
+# Bounds (in seconds) on the sleep between attempts when waiting on a lock
+# with a timeout.
+_min_backoff = .001
+_max_backoff = .05
+
+class LockTimeout(Exception):
+    """Raised when a StateLock cannot be acquired within its timeout."""
+    pass
+
+class StateLock(object):
+    """Exclusive or shared lock on a state lock file.
+
+    The lock file is created if it does not exist and is never removed, as
+    removing a lock file that another process is waiting on would allow two
+    holders at once. StateLock may be used directly or with the 'with' python
+    keyword.
+
+    Example:
+
+        with StateLock('src/state/jobs/.47.lock', timeout=10):
+            ...
+    """
+
+    def __init__(self, lock_filename, shared=False, timeout=None):
+        """Return initialized, unacquired StateLock instance.
+
+        Args:
+            lock_filename (str): Path of the lock file.
+
+        Kwargs:
+            shared (bool): If True, take a shared (reader) lock instead of an
+                exclusive one.
+            timeout (float/None): Seconds to wait for the lock before raising
+                LockTimeout. If None, wait indefinitely.
+        """
+        self.lock_filename = lock_filename
+        self.shared = shared
+        self.timeout = timeout
+        self._fd = None
+
+    def __enter__(self):
+        """Provide entry for use in 'with' statements."""
+        self.acquire()
+        return self
+
+    def __exit__(self, e_type, e_value, e_traceback):
+        """Provide exit for use in 'with' statements."""
+        self.release()
+        if e_type:
+            return False
+
+    def acquire(self):
+        """Acquire the lock, blocking as configured.
+
+        Raises:
+            LockTimeout: The lock was not acquired within self.timeout seconds.
+        """
+        op = fcntl.LOCK_SH if self.shared else fcntl.LOCK_EX
+        fd = os.open(self.lock_filename, os.O_CREAT | os.O_RDWR, 0664)
+        flags = fcntl.fcntl(fd, fcntl.F_GETFD)
+        fcntl.fcntl(fd, fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
+
+        start = time.time()
+        try:
+            if self._try_lock(fd, op):
+                _record_wait(0.0, False)
+            elif self.timeout is None:
+                _flock(fd, op)
+                _record_wait(time.time() - start, True)
+            else:
+                self._wait_lock(fd, op, start)
+        except:
+            os.close(fd)
+            raise
+        self._fd = fd
+
+    def release(self):
+        """Release the lock if held."""
+        if self._fd is None:
+            return
+        try:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+        finally:
+            os.close(self._fd)
+            self._fd = None
+
+    def _try_lock(self, fd, op):
+        """Attempt to take the lock without blocking.
+
+        Returns:
+            True if the lock was taken, False if it is held elsewhere.
+        """
+        try:
+            fcntl.flock(fd, op | fcntl.LOCK_NB)
+        except IOError as e:
+            if e.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+            return False
+        return True
+
+    def _wait_lock(self, fd, op, start):
+        """Wait for the lock with backoff until self.timeout expires."""
+        deadline = start + self.timeout
+        backoff = _min_backoff
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                _record_timeout(time.time() - start)
+                msg = ('Timed out after %.3fs waiting on %s'
+                       % (self.timeout, self.lock_filename))
+                _logger.warn(msg)
+                raise LockTimeout(msg)
+            time.sleep(min(backoff, remaining))
+            if self._try_lock(fd, op):
+                _record_wait(time.time() - start, True)
+                return
+            backoff = min(backoff * 2, _max_backoff)
+
+def _flock(fd, op):
+    """Call fcntl.flock(), retrying if interrupted by a signal."""
+    while True:
+        try:
+            fcntl.flock(fd, op)
+            return
+        except IOError as e:
+            if e.errno != errno.EINTR:
+                raise
+
+def is_locked(lock_filename):
+    """Return whether an exclusive lock is held on a lock file.
+
+    The file is probed with a non-blocking shared lock, released at once, so
+    holders of shared locks are not reported.
+
+    Args:
+        lock_filename (str): Path of the lock file.
+
+    Returns:
+        True if any process, including this one, holds an exclusive lock on
+        the file. False if not, or if the file does not exist.
+    """
+    try:
+        fd = os.open(lock_filename, os.O_RDONLY)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+        return False
+    try:
+        try:
+            fcntl.flock(fd, fcntl.LOCK_SH | fcntl.LOCK_NB)
+        except IOError as e:
+            if e.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+            return True
+        fcntl.flock(fd, fcntl.LOCK_UN)
+        return False
+    finally:
+        os.close(fd)
+
+def _check_fork():
+    """Reset the lock stats in a forked child."""
+    global _stats_pid, _stats_lock
+    if _stats_pid != os.getpid():
+        _stats_pid = os.getpid()
+        _stats_lock = threading.Lock()
+        _stats.update(acquired=0, contended=0, timeouts=0, wait_total=0.0,
+                      wait_max=0.0)
+
+def _record_wait(wait, contended):
+    """Add a successful acquisition to the lock stats."""
+    _check_fork()
+    with _stats_lock:
+        _stats['acquired'] += 1
+        if contended:
+            _stats['contended'] += 1
+        _stats['wait_total'] += wait
+        _stats['wait_max'] = max(_stats['wait_max'], wait)
+
+def _record_timeout(wait):
+    """Add a timed out acquisition to the lock stats."""
+    _check_fork()
+    with _stats_lock:
+        _stats['timeouts'] += 1
+        _stats['wait_total'] += wait
+        _stats['wait_max'] = max(_stats['wait_max'], wait)
+
+def get_lock_stats():
+    """Return counters describing lock acquisitions and waits made by this
+    process.
+
+    Returns:
+        Dict with the following fields:
+            acquired: Number of locks acquired.
+            contended: Number of acquisitions that had to wait.
+            timeouts: Number of acquisitions abandoned due to timeout.
+            wait_total: Total seconds spent waiting on locks.
+            wait_max: Longest single wait in seconds.
+    """
+    _check_fork()
+    with _stats_lock:
+        return dict(_stats)
@@ -6,10 +6,17 @@ sources, as well as means of setting/storing/updating module state data.
 Exports:
     ModState: Encapsulation of module state that avoids race conditions.
     install_module: Installs module on host system.
+    install_interrupted: Record a module install cut off by the PCE service
+        stopping.
     get_source_types: Return list of acceptable module source types (local, git,
         etc.).
     deploy_module: Deploy an installed OnRamp educational module.
+    deploy_interrupted: Record a module deploy cut off by the PCE service
+        stopping.
     get_modules: Return list of tracked modules or single module.
+    get_module_etag: Return an entity tag for a module resource.
+    get_module_changes: Return modules changed since a change journal sequence
+        number.
     get_available_modules: Return list of modules shipped with OnRamp.
     init_module_delete: Initiate the deletion of a module.
 """
@@ -17,17 +24,21 @@ import argparse
 import copy
 import errno
 import fcntl
-import json
 import logging
 import os
 import shutil
 import sys
 import time
-from subprocess import CalledProcessError, check_output, STDOUT
 
 from configobj import ConfigObj
 
 from PCE.tools import module_log
+from PCE.tools.hooks import add_usage, run_hook
+from PCE.tools.locks import StateLock
+from PCE.tools.state import delete_state, get_changes, get_state_backend, \
+                            load_state, load_state_file, remove_state_file, \
+                            store_state, store_state_file
+from PCE.tools.trash import trash_tree
 from PCEHelper import pce_root
 
 _mod_state_dir = os.path.join(pce_root, 'src/state/modules')
@@ -50,7 +61,8 @@ class ModState(dict):
             mod_state['key2'] = 'val2'
     """
 
-    def __init__(self, id, mod_state_file=None):
+    def __init__(self, id, mod_state_file=None, timeout=None,
+                 readonly=False):
         """Return initialized ModState instance.
 
         Method works in get-or-create fashion, that is, if state exists for
@@ -58,38 +70,40 @@ class ModState(dict):
 
         Args:
             id (int): Id of the module to get/create state for.
-        """
-        if mod_state_file is None:
-            mod_state_file = os.path.join(_mod_state_dir, str(id))
 
+        Kwargs:
+            mod_state_file (str): Path of the state file to use instead of the
+                default location in the state dir.
+            timeout (float/None): Seconds to wait for the state lock before
+                raising PCE.tools.locks.LockTimeout. If None, block until
+                the lock is available.
+            readonly (bool): If True, return a snapshot of the stored state
+                without taking the state lock. Snapshots never block or are
+                blocked by other instances, and changes made to them are
+                discarded.
+        """
         self.mod_id = id
-        self._lock_filename = os.path.join(_mod_state_dir, '%s.lock' % str(id))
+        self._lock_filename = os.path.join(_mod_state_dir, '.%s.lock' % str(id))
         self._mod_state_filename = mod_state_file
 
-        while(True):
-            try:
-                # Raises OSError if file cannot be opened in create mode.
-                os.open(self._lock_filename,
-                        os.O_CREAT | os.O_EXCL | os.O_WRONLY)
-                break
-            except OSError as e:
-                if e.errno != errno.EEXIST:
-                    raise
-                time.sleep(.001)
+        self._readonly = readonly
+        self._lock = StateLock(self._lock_filename, timeout=timeout)
+        if not readonly:
+            self._lock.acquire()
 
         try:
-            self._state_file = open(mod_state_file, 'r+')
-            data = json.load(self._state_file)
+            if self._mod_state_filename is None:
+                data = load_state('modules', id, snapshot=readonly)
+            else:
+                data = load_state_file(self._mod_state_filename)
+        except:
+            self._lock.release()
+            raise
+        if data is not None:
             self.update(data)
-            self._state_file.seek(0)
-        except IOError as e1:
-            if e1.errno != errno.ENOENT:
-                raise
-            self._state_file = open(mod_state_file, 'w')
-        except ValueError as e2:
-            #_logger.debug('BAD JSON: %s' % file_contents)
-            # Invalid json. Ignore (will be overwritten by _close().
-            pass
+        # Kept to skip storing unchanged state on close. Copied, as nested
+        # values are shared with the instance.
+        self._stored = None if readonly else copy.deepcopy(data)
 
     def __enter__(self):
         """Provide entry for use in 'with' statements."""
@@ -108,23 +122,26 @@ class ModState(dict):
 
         If stored state exists, overwrite it with current instance keys/vals.
         """
-        if 'state' in self.keys() and self['state'] != 'Does not exist':
-            self._state_file.write(json.dumps(self))
-            self._state_file.truncate()
-            self._state_file.close()
-        else:
-            try:
-                self._state_file.close()
-                os.remove(self._mod_state_filename)
-            except OSError as e:
-                if e.errno != errno.ENOENT:
-                    raise e
+        if self._readonly:
+            return
 
         try:
-            os.remove(self._lock_filename)
-        except OSError as e:
-            if e.errno != errno.ENOENT:
-                raise e
+            if 'state' in self.keys() and self['state'] != 'Does not exist':
+                if self == self._stored:
+                    # Unchanged. Nothing to store.
+                    return
+                self['_version'] = self.get('_version', 0) + 1
+                if self._mod_state_filename is None:
+                    store_state('modules', self.mod_id, self)
+                else:
+                    store_state_file(self._mod_state_filename, self)
+            elif self._stored is not None:
+                if self._mod_state_filename is None:
+                    delete_state('modules', self.mod_id)
+                else:
+                    remove_state_file(self._mod_state_filename)
+        finally:
+            self._lock.release()
 
 
 def _local_checkout(source_path, install_path):
@@ -194,6 +211,7 @@ def install_module(source_type, source_path, install_parent_folder, mod_id,
         mod_state['error'] = None
         mod_state['uioptions'] = None
         mod_state['metadata'] = None
+        mod_state['hook_usage'] = {}
         mod_state['source_location'] = {
             'type': source_type,
             'path': source_abs_path
@@ -229,6 +247,47 @@ def install_module(source_type, source_path, install_parent_folder, mod_id,
 
     return (0, 'Module %d installed' % mod_id)
 
+def install_interrupted(source_type, source_path, install_parent_folder,
+                        mod_id, mod_name, verbose=False, mod_state_file=None):
+    """Record the failure of an install_module() call that was cut off by the
+    PCE service stopping, so that the module can be installed again.
+
+    Takes the same args as install_module().
+
+    Returns:
+        Tuple with 0th position being error code and 1st position being string
+        indication of status.
+    """
+    return _interrupted(mod_id, 'Checkout in progress', 'Checkout failed',
+                        mod_state_file)
+
+def deploy_interrupted(mod_id, verbose=False, mod_state_file=None):
+    """Record the failure of a deploy_module() call that was cut off by the
+    PCE service stopping, so that the module can be deployed again.
+
+    Takes the same args as deploy_module().
+
+    Returns:
+        Tuple with 0th position being error code and 1st position being string
+        indication of status.
+    """
+    return _interrupted(mod_id, 'Deploy in progress', 'Deploy failed',
+                        mod_state_file)
+
+def _interrupted(mod_id, in_progress_state, failed_state, mod_state_file=None):
+    """Move a module left in in_progress_state to failed_state."""
+    with ModState(mod_id, mod_state_file=mod_state_file) as mod_state:
+        if mod_state.get('state') != in_progress_state:
+            return (0, 'Module %d not interrupted' % mod_id)
+        msg = '%s interrupted by PCE service stop' % in_progress_state
+        _logger.warn('Module %d: %s' % (mod_id, msg))
+        mod_state['state'] = failed_state
+        mod_state['error'] = msg
+        if mod_state['_marked_for_del']:
+            _delete_module(mod_state)
+            return (-3, 'Module %d deleted' % mod_id)
+    return (-1, msg)
+
 def deploy_module(mod_id, verbose=False, mod_state_file=None):
     """Deploy an installed OnRamp educational module.
 
@@ -256,22 +315,22 @@ def deploy_module(mod_id, verbose=False, mod_state_file=None):
         mod_state['error'] = None
         mod_dir = mod_state['installed_path']
 
-    ret_dir = os.getcwd()
-    _logger.debug('ret_dir: %s' % ret_dir)
-    os.chdir(mod_dir)
-
+    usage = {}
     try:
-        _logger.debug('Calling bin/onramp_deploy.py')
-        _logger.debug('CWD: %s' % os.getcwd())
-        output = check_output([os.path.join(pce_root, 'src/env/bin/python'),
-                              'bin/onramp_deploy.py'], stderr=STDOUT)
+        code, output = run_hook(mod_dir, 'bin/onramp_deploy.py',
+                                log_id='deploy', usage=usage)
         _logger.debug('Back from bin/onramp_deploy.py')
-    except CalledProcessError as e:
-        _logger.debug('CalledProcessError from bin/onramp_deploy.py')
-        code = e.returncode
-        if code > 127:
-            code -= 256
-        output = e.output
+    except OSError as e1:
+        _logger.debug('OSError from bin/onramp_deploy.py')
+        _logger.debug(e1)
+        module_log(mod_dir, 'deploy', str(e1))
+        with ModState(mod_id, mod_state_file=mod_state_file) as mod_state:
+            mod_state['state'] = 'Deploy failed'
+            mod_state['error'] = str(e1)
+        return (-1, str(e1))
+
+    if code != 0:
+        _logger.debug('bin/onramp_deploy.py exited with %d' % code)
         if code != 1:
             with ModState(mod_id, mod_state_file=mod_state_file) as mod_state:
                 msg = ('Deploy exited with return status %d and output: %s'
@@ -279,6 +338,8 @@ def deploy_module(mod_id, verbose=False, mod_state_file=None):
                 _logger.debug(msg)
                 mod_state['state'] = 'Deploy failed'
                 mod_state['error'] = msg
+                add_usage(mod_state.setdefault('hook_usage', {}), 'deploy',
+                          usage)
                 if mod_state['_marked_for_del']:
                     _delete_module(mod_state)
                     return (-3, 'Module %d deleted' % mod_id)
@@ -288,26 +349,17 @@ def deploy_module(mod_id, verbose=False, mod_state_file=None):
             _logger.debug(msg)
             mod_state['state'] = msg
             mod_state['error'] = output
+            add_usage(mod_state.setdefault('hook_usage', {}), 'deploy', usage)
             if mod_state['_marked_for_del']:
                 _delete_module(mod_state)
                 return (-3, 'Module %d deleted' % mod_id)
             return (1, msg)
-    except OSError as e1:
-        output = str(e1)
-        _logger.debug('OSError from bin/onramp_deploy.py')
-        _logger.debug(e1)
-        with ModState(mod_id, mod_state_file=mod_state_file) as mod_state:
-            mod_state['state'] = 'Deploy failed'
-            mod_state['error'] = str(e1)
-        return (-1, str(e1))
-    finally:
-        os.chdir(ret_dir)
-        module_log(mod_dir, 'deploy', output)
 
     _logger.debug("Updating state to 'Module ready'")
     with ModState(mod_id, mod_state_file=mod_state_file) as mod_state:
         mod_state['state'] = 'Module ready'
         mod_state['error'] = None
+        add_usage(mod_state.setdefault('hook_usage', {}), 'deploy', usage)
         if mod_state['_marked_for_del']:
             _delete_module(mod_state)
             return (-3, 'Module %d deleted' % mod_id)
@@ -329,19 +381,50 @@ def _clean_mod(mod):
             mod.pop(key, None)
     return mod
 
-def get_modules(mod_id=None):
+def get_module_etag(mod_id):
+    """Return an entity tag for a module resource without building it.
+
+    The tag is made from the change journal sequence number of the module's
+    state record and, for ready modules, the size and modification time of
+    the uioptions and metadata files included in the resource.
+
+    Args:
+        mod_id (int): Id of the module.
+
+    Returns:
+        Quoted entity tag, or None if the module is not installed.
+    """
+    record = load_state('modules', mod_id, snapshot=True)
+    if not record or '_seq' not in record:
+        return None
+    tag = 's%d' % record['_seq']
+    if record.get('state') == 'Module ready':
+        for name in ['onramp_uioptions.cfgspec', 'onramp_metadata.cfgspec']:
+            filename = os.path.join(record['installed_path'], 'config', name)
+            try:
+                st = os.stat(filename)
+                tag += '-%x.%x' % (st.st_size, int(st.st_mtime * 1000))
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+                tag += '-0'
+    return '"%s"' % tag
+
+def get_modules(mod_id=None, state=None):
     """Return list of tracked modules or single module.
 
     Kwargs:
         mod_id (int/None): If int, return module resource with corresponding id.
             If None, return list of all tracked module resources.
+        state (str/list of str/None): If given, only list modules in (one of)
+            the given state(s).
 
     Returns:
         OnRamp formatted dict containing module attrs for each requested module.
     """
     _logger.debug('Mod (%s) HERE' % (str(mod_id)))
     if mod_id is not None:
-        with ModState(mod_id) as mod_state:
+        with ModState(mod_id, readonly=True) as mod_state:
             _logger.debug('Mod (%s) HERE 2' % (str(mod_id)))
             if 'state' in mod_state.keys():
                 mod = copy.deepcopy(mod_state)
@@ -370,16 +453,30 @@ def get_modules(mod_id=None):
             'source_location': None
         }
 
-    results = []
+    return [_clean_mod(record) for id, record in
+            get_state_backend().find('modules', state=state)]
+
+def get_module_changes(since, state=None):
+    """Return modules stored or deleted since the given change journal sequence
+    number.
 
-    # Need to filter out hidden files because of .nfs* files.
-    for id in filter(lambda x: not x.startswith('.'),
-                     os.listdir(_mod_state_dir)):
-        next_mod = {}
-        with ModState(id) as mod_state:
-            next_mod = copy.deepcopy(mod_state)
-        results.append(_clean_mod(next_mod))
-    return results
+    Modules are returned as last stored, without uioptions or metadata read
+    from the module's config files.
+
+    Args:
+        since (int): Sequence number returned by the previous call, 0 to return
+            all modules.
+
+    Kwargs:
+        state (str/list of str/None): If given, only return changed modules in
+            (one of) the given state(s).
+
+    Returns:
+        Tuple of the sequence number to pass as since on the next call, the list
+        of changed modules, and the list of ids of deleted modules.
+    """
+    seq, changed, deleted = get_changes('modules', since, state=state)
+    return (seq, [_clean_mod(record) for id, record in changed], deleted)
 
 def get_available_modules():
     """Return list of modules shipped with OnRamp.
@@ -436,15 +533,14 @@ def init_module_delete(mod_id):
 def _delete_module(mod_state):
     """Delete given module.
 
-    Both state for and contents of module will be removed.
+    Both state for and contents of module will be removed. State is removed
+    from storage when mod_state is closed. The install folder is moved to the
+    trash and removed in the background.
 
     Args:
         mod_state (ModState): State object for the module to remove.
     """
-    mod_id = mod_state['mod_id']
-    mod_state_file = os.path.join(_mod_state_dir, str(mod_id))
-    os.remove(mod_state_file)
     if 'installed_path' in mod_state.keys():
         path = mod_state['installed_path']
-        shutil.rmtree(path)
+        trash_tree(path)
     mod_state.clear()
@@ -0,0 +1,183 @@
+"""Creation of job run folders from installed modules.
+
+A run folder is a copy of the installed module in which a job runs. Rather
+than copying every file of the module for every job, files the module does not
+write to during a job are shared with the installed module: reflinked
+(copy-on-write clones, on filesystems that support them) or, if enabled,
+hardlinked. Files matching the module's mutable globs, and files the PCE itself
+writes, are always copied. Where a file cannot be shared, it is copied.
+
+Modules list globs (relative to the module root) of files their scripts modify
+in place as 'mutable' in the [onramp] section of config/onramp_metadata.cfg.
+New files created by a job are never shared, and need not be listed. A
+reflinked file is safe to modify in place whether listed or not, so hardlinking,
+which is not, is only done when asked for.
+
+Exports:
+    materialize_run_dir: Create a run folder from an installed module.
+    share_file: Reflink, hardlink, or copy a single file.
+    get_mutable_globs: Return the mutable globs of an installed module.
+"""
+import errno
+import fcntl
+import fnmatch
+import logging
+import os
+import shutil
+
+from configobj import ConfigObj
+
+_logger = logging.getLogger('onramp')
+# Files written by the PCE in run folders. Writes through a hardlink would
+# change the installed module, so these are always copied.
+_default_mutable = ['log/*', 'onramp_runparams.cfg', 'script.sh', 'output.txt']
+# Linux FICLONE ioctl: clone src file contents into dst file.
+_FICLONE = 0x40049409
+# Errors meaning a file cannot be shared this way here. Fall back on these.
+_share_errnos = (errno.EOPNOTSUPP, errno.ENOTTY, errno.EXDEV, errno.EINVAL,
+                 errno.ENOSYS, errno.EPERM, errno.EMLINK)
+_link_modes = ('reflink', 'hardlink', 'copy')
+
+def get_mutable_globs(mod_dir):
+    """Return the mutable globs of an installed module.
+
+    Args:
+        mod_dir (str): Root folder of the installed module.
+
+    Returns:
+        List of globs from the 'mutable' key of the [onramp] section of
+        config/onramp_metadata.cfg. Empty if not given or the file is missing
+        or badly formed.
+    """
+    cfg_file = os.path.join(mod_dir, 'config/onramp_metadata.cfg')
+    try:
+        conf = ConfigObj(cfg_file, file_error=True)
+    except (IOError, SyntaxError):
+        return []
+
+    if 'onramp' in conf.keys() and 'mutable' in conf['onramp'].keys():
+        globs = conf['onramp']['mutable']
+        if isinstance(globs, basestring):
+            # Globs is only a single string. Convert to list.
+            globs = [globs]
+        return globs
+    return []
+
+def _reflink(src, dst):
+    """Clone src to a new file at dst. Return False if not supported."""
+    with open(src, 'rb') as f_src:
+        with open(dst, 'wb') as f_dst:
+            try:
+                fcntl.ioctl(f_dst.fileno(), _FICLONE, f_src.fileno())
+            except IOError as e:
+                if e.errno not in _share_errnos:
+                    raise
+                cloned = False
+            else:
+                cloned = True
+    if not cloned:
+        os.remove(dst)
+        return False
+    shutil.copystat(src, dst)
+    return True
+
+def _hardlink(src, dst):
+    """Hardlink dst to src. Return False if not possible."""
+    try:
+        os.link(src, dst)
+    except OSError as e:
+        if e.errno not in _share_errnos:
+            raise
+        return False
+    return True
+
+def share_file(src, dst, link_mode='reflink'):
+    """Create dst with the contents of src, sharing storage where possible.
+
+    Args:
+        src (str): Path of the file to share.
+        dst (str): Path of the file to create. Must not exist.
+
+    Kwargs:
+        link_mode (str): As for materialize_run_dir().
+
+    Returns:
+        'reflinked', 'linked', or 'copied', indicating how dst was created.
+
+    Raises:
+        OSError, IOError: dst exists or could not be created.
+        ValueError: Unknown link_mode.
+    """
+    if link_mode not in _link_modes:
+        raise ValueError('Unknown link mode: %s' % link_mode)
+    if link_mode != 'copy' and _reflink(src, dst):
+        return 'reflinked'
+    if link_mode == 'hardlink' and _hardlink(src, dst):
+        return 'linked'
+    shutil.copy2(src, dst)
+    return 'copied'
+
+def materialize_run_dir(mod_dir, run_dir, mutable=None, link_mode='reflink'):
+    """Create a run folder with the contents of an installed module.
+
+    Args:
+        mod_dir (str): Root folder of the installed module.
+        run_dir (str): Run folder to create. Must not exist.
+
+    Kwargs:
+        mutable (list of str): Globs, relative to mod_dir, of files to always
+            copy, in addition to files written by the PCE.
+        link_mode (str): Most sharing to attempt for other files. 'reflink'
+            tries a reflink, then a copy. 'hardlink' tries a reflink, then a
+            hardlink, then a copy. 'copy' copies every file.
+
+    Returns:
+        Dict counting files reflinked, hardlinked, and copied, under the keys
+        'reflinked', 'linked', and 'copied'.
+
+    Raises:
+        OSError, IOError: run_dir exists or a file could not be created.
+        ValueError: Unknown link_mode.
+    """
+    if link_mode not in _link_modes:
+        raise ValueError('Unknown link mode: %s' % link_mode)
+    patterns = _default_mutable + list(mutable or [])
+    stats = {'reflinked': 0, 'linked': 0, 'copied': 0}
+    # Stop attempting a method after it fails once, as it will fail for every
+    # file of the module.
+    try_reflink = link_mode != 'copy'
+    try_hardlink = link_mode == 'hardlink'
+
+    for root, dirs, files in os.walk(mod_dir):
+        rel_root = os.path.relpath(root, mod_dir)
+        dst_root = os.path.normpath(os.path.join(run_dir, rel_root))
+        os.mkdir(dst_root)
+        shutil.copymode(root, dst_root)
+
+        for name in dirs + files:
+            src = os.path.join(root, name)
+            dst = os.path.join(dst_root, name)
+            if os.path.islink(src):
+                os.symlink(os.readlink(src), dst)
+                if name in dirs:
+                    dirs.remove(name)
+                continue
+            if name in dirs:
+                continue
+
+            rel = os.path.normpath(os.path.join(rel_root, name))
+            if any(fnmatch.fnmatch(rel, pattern) for pattern in patterns):
+                shutil.copy2(src, dst)
+                stats['copied'] += 1
+            elif try_reflink and _reflink(src, dst):
+                stats['reflinked'] += 1
+            elif try_hardlink and _hardlink(src, dst):
+                try_reflink = False
+                stats['linked'] += 1
+            else:
+                try_reflink = False
+                try_hardlink = False
+                shutil.copy2(src, dst)
+                stats['copied'] += 1
+
+    return stats
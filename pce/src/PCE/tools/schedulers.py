@@ -2,20 +2,242 @@
 
 Exports:
     SLURMScheduler: Interface to SLURM batch scheduler.
+    PBSScheduler: Interface to PBS batch scheduler.
+    LocalScheduler: Runs jobs on the PCE host without a batch scheduler.
     Scheduler: Generic instantiator for all implemented schedulers.
+    get_call_stats: Return counts of scheduler calls made by this process.
 """
+import errno
+import json
 import logging
+import multiprocessing
 import os
-from subprocess import CalledProcessError, check_output, STDOUT
+import signal
+import threading
+import time
+from subprocess import CalledProcessError, check_output, Popen, STDOUT
 
+from PCE.tools.locks import StateLock
 from PCEHelper import pce_root
 
+_local_state_dir = os.path.join(pce_root, 'src/state/local_jobs')
+# Seconds to keep records of finished local jobs.
+_local_keep_finished = 24 * 3600
+
+def _format_walltime(seconds):
+    """Return a time limit in seconds as HH:MM:SS."""
+    return '%d:%02d:%02d' % (seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+class _PendingCall(object):
+    """Result of a scheduler command, shared by the callers waiting on it."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.output = None
+        self.error = None
+
+    def result(self):
+        """Return the output of the command, or raise its error."""
+        if self.error is not None:
+            raise self.error
+        return self.output
+
+class _CallBroker(object):
+    """Runs scheduler commands for all schedulers of a process.
+
+    Identical queries made at the same time share one subprocess, and their
+    result is reused for scheduler_cache_ttl seconds. Commands that change
+    jobs are never shared, and clear the cached results, along with the
+    results of queries running at the time, which may predate the change.
+    Failed queries are not reused. All commands are
+    limited to scheduler_call_rate per second by a token bucket holding up to
+    scheduler_call_burst tokens. Settings are read from onramp_pce_config.cfg
+    for each call, so they follow config reloads.
+
+    The broker of a forked child starts afresh, as locks held by other threads
+    at the fork would never be released in the child.
+    """
+
+    def __init__(self):
+        """Return a _CallBroker with no calls made."""
+        self._reset()
+
+    def _reset(self):
+        """Drop cached results and counts and create new locks."""
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        self._bucket_lock = threading.Lock()
+        self._inflight = {}
+        self._cache = {}
+        # Bumped when the cache is cleared. Queries started under an older
+        # generation are not cached.
+        self._generation = 0
+        self._tokens = None
+        self._last = time.time()
+        self.stats = {'calls': 0, 'coalesced': 0, 'cached': 0,
+                      'throttled': 0, 'throttle_wait': 0.0}
+
+    def _get_settings(self):
+        """Return (rate, burst, cache_ttl) from onramp_pce_config.cfg."""
+        # Imported here as PCE.tools.config imports this module.
+        from PCE.tools.config import get_pce_config
+        cfg = get_pce_config()['cluster']
+        return (cfg.get('scheduler_call_rate', 0),
+                cfg.get('scheduler_call_burst', 1),
+                cfg.get('scheduler_cache_ttl', 0))
+
+    def _acquire(self, rate, burst):
+        """Take a token from the bucket, sleeping until one is available."""
+        if not rate:
+            return
+        with self._bucket_lock:
+            now = time.time()
+            if self._tokens is None:
+                self._tokens = float(burst)
+            self._tokens = min(float(burst),
+                               self._tokens + (now - self._last) * rate)
+            self._last = now
+            # Taken even if not yet available, so that callers waiting at the
+            # same time are spaced out.
+            self._tokens -= 1
+            wait = -self._tokens / rate
+        if wait > 0:
+            with self._lock:
+                self.stats['throttled'] += 1
+                self.stats['throttle_wait'] += wait
+            time.sleep(wait)
+
+    def _store(self, key, pending, ttl):
+        """Cache a finished call for ttl seconds, dropping expired results.
+        Must be called with self._lock held.
+        """
+        now = time.time()
+        for old_key in [k for k, v in self._cache.items() if v[0] <= now]:
+            del self._cache[old_key]
+        if ttl:
+            self._cache[key] = (now + ttl, pending)
+
+    def call(self, args, cwd=None, stderr=None, shared=True):
+        """Run a scheduler command and return its output, as check_output().
+
+        Args:
+            args (list of str): Command and its args.
+
+        Kwargs:
+            cwd (str): Folder to run the command in.
+            stderr: As for check_output().
+            shared (bool): Whether the command only queries the scheduler, so
+                that its output may be shared with identical calls.
+
+        Returns:
+            Output of the command.
+
+        Raises:
+            CalledProcessError: The command exited with non-zero status.
+            OSError: The command could not be run.
+        """
+        if self._pid != os.getpid():
+            self._reset()
+        rate, burst, ttl = self._get_settings()
+
+        if not shared:
+            with self._lock:
+                self.stats['calls'] += 1
+            self._acquire(rate, burst)
+            try:
+                return check_output(args, cwd=cwd, stderr=stderr)
+            finally:
+                # Cached job states may be changed by the command.
+                with self._lock:
+                    self._cache.clear()
+                    self._generation += 1
+
+        key = (tuple(args), cwd, stderr)
+        with self._lock:
+            cached = self._cache.get(key)
+            if cached is not None and cached[0] > time.time():
+                self.stats['cached'] += 1
+                return cached[1].result()
+            pending = self._inflight.get(key)
+            leader = pending is None
+            if leader:
+                pending = _PendingCall()
+                self._inflight[key] = pending
+                self.stats['calls'] += 1
+                generation = self._generation
+            else:
+                self.stats['coalesced'] += 1
+
+        if not leader:
+            pending.done.wait()
+            return pending.result()
+
+        try:
+            self._acquire(rate, burst)
+            pending.output = check_output(args, cwd=cwd, stderr=stderr)
+        except Exception as e:
+            pending.error = e
+        finally:
+            with self._lock:
+                del self._inflight[key]
+                if (pending.error is None
+                    and generation == self._generation):
+                    self._store(key, pending, ttl)
+            pending.done.set()
+        return pending.result()
+
+    def get_stats(self):
+        """Return a copy of the call counts of this process."""
+        with self._lock:
+            return dict(self.stats)
+
+_broker = _CallBroker()
+
+def _call(args, **kwargs):
+    """Run a scheduler command through the process's _CallBroker."""
+    return _broker.call(args, **kwargs)
+
+def get_call_stats():
+    """Return counts of scheduler calls made by this process.
+
+    Returns:
+        Dict with 'calls', the number of commands run, 'coalesced', the number
+        of calls that shared a command already running, 'cached', the number
+        answered from a recent result, 'throttled', the number delayed by the
+        rate limit, and 'throttle_wait', the seconds they were delayed.
+    """
+    return _broker.get_stats()
+
 class _BatchScheduler(object):
     """Superclass for batch scheduler classes.
 
     Subclasses must override the non-magic methods defined here.
     """
     local_python = os.path.join(pce_root, 'src', 'env', 'bin', 'python')
+    # Written to the run folder by the batch script when the run ends.
+    run_event_file = '.onramp_done'
+
+    def get_run_commands(self):
+        """Return the batch script commands that run bin/onramp_run.py.
+
+        After bin/onramp_run.py exits, its exit status and start and end times
+        are written as JSON to run_event_file in the folder it ran in, where
+        the PCE picks them up without waiting for the scheduler to report the
+        job done. The script exits with the exit status of bin/onramp_run.py.
+
+        Returns:
+            Commands to end the batch script with.
+        """
+        contents = 'onramp_started=$(date +%s)\n'
+        contents += '%s bin/onramp_run.py\n' % self.local_python
+        contents += 'onramp_status=$?\n'
+        contents += ("printf '{\"exit_status\": %%d, \"started\": %%s, "
+                     "\"finished\": %%s}\\n' $onramp_status $onramp_started "
+                     "$(date +%%s) > %s.tmp\n" % self.run_event_file)
+        contents += 'mv %s.tmp %s\n' % (self.run_event_file,
+                                         self.run_event_file)
+        contents += 'exit $onramp_status\n'
+        return contents
 
     @classmethod
     def is_scheduler_for(cls, type):
@@ -31,7 +253,8 @@ class _BatchScheduler(object):
         """
         pass
 
-    def get_batch_script(self, run_name, numtasks=4, num_nodes=1, email=None):
+    def get_batch_script(self, run_name, numtasks=4, num_nodes=1, email=None,
+                         threads=1, walltime=None):
         """Return the batch script that runs a job as per args formatted for the
         given batch scheduler.
 
@@ -41,6 +264,33 @@ class _BatchScheduler(object):
             num_nodes (int): Number of nodes to allocate for job.
             email (str): Email to send results to upon completion. If None, no
                 email sent.
+            threads (int): Number of cores (OpenMP threads) per task.
+            walltime (int/None): Time limit in seconds. If None, the
+                scheduler's default limit applies.
+
+        Returns:
+            Batch script implementing given attrs.
+        """
+        pass
+
+    def get_array_batch_script(self, run_name, count, numtasks=4, num_nodes=1,
+                               email=None, threads=1, walltime=None):
+        """Return the batch script that runs an array job as per args formatted
+        for the given batch scheduler.
+
+        Element i of the array runs bin/onramp_run.py in folder i under the
+        folder the script is scheduled from, with output to output.txt there.
+
+        Args:
+            run_name (str): Human-readable label for job run.
+            count (int): Number of array elements.
+            numtasks (int): Number of tasks to schedule per element.
+            num_nodes (int): Number of nodes to allocate per element.
+            email (str): Email to send results to upon completion. If None, no
+                email sent.
+            threads (int): Number of cores (OpenMP threads) per task.
+            walltime (int/None): Time limit in seconds. If None, the
+                scheduler's default limit applies.
 
         Returns:
             Batch script implementing given attrs.
@@ -74,6 +324,37 @@ class _BatchScheduler(object):
         """
         pass
 
+    def check_status_many(self, scheduler_job_nums):
+        """Return job status from scheduler for each of the given jobs.
+
+        This default implementation calls check_status() for each job.
+        Subclasses should override it to query the scheduler once for all jobs.
+
+        Args:
+            scheduler_job_nums (list of int): Job numbers of the jobs to check
+                state on as given by the scheduler, not as given by OnRamp.
+
+        Returns:
+            Dict mapping each job number to the 2-Tuple that check_status()
+            returns for it.
+        """
+        return dict((num, self.check_status(num)) for num in
+                    scheduler_job_nums)
+
+    def check_array_status(self, scheduler_job_num, count):
+        """Return status of each element of an array job from scheduler.
+
+        Args:
+            scheduler_job_num (int): Job number of the array job as given by
+                the scheduler, not as given by OnRamp.
+            count (int): Number of array elements.
+
+        Returns:
+            Dict mapping each element index to the 2-Tuple that check_status()
+            returns for a job.
+        """
+        pass
+
     def cancel_job(self, scheduler_job_num):
         """Cancel the given job.
     
@@ -86,6 +367,21 @@ class _BatchScheduler(object):
             giving detailed status info.
         """
         pass
+
+    def cancel_array_job(self, scheduler_job_num):
+        """Cancel all elements of the given array job.
+
+        This default implementation calls cancel_job().
+
+        Args:
+            scheduler_job_num (int): Job number, as given by the scheduler, of
+                the array job to cancel.
+
+        Returns:
+            2-Tuple with 0th item being error code and 1st item being a string
+            giving detailed status info.
+        """
+        return self.cancel_job(scheduler_job_num)
         
     def __init__(self, type):
         """Set batch scheduler type and return the instance.
@@ -110,7 +406,8 @@ class SLURMScheduler(_BatchScheduler):
         """
         return type == 'SLURM'
 
-    def get_batch_script(self, run_name, numtasks=4, num_nodes=1, email=None):
+    def get_batch_script(self, run_name, numtasks=4, num_nodes=1, email=None,
+                         threads=1, walltime=None):
         """Return the batch script that runs a job as per args formatted for the
         SLURM batch scheduler.
 
@@ -120,6 +417,9 @@ class SLURMScheduler(_BatchScheduler):
             num_nodes (int): Number of nodes to allocate for job.
             email (str): Email to send results to upon completion. If None, no
                 email sent.
+            threads (int): Number of cores (OpenMP threads) per task.
+            walltime (int/None): Time limit in seconds. If None, the
+                scheduler's default limit applies.
 
         Returns:
             Batch script implementing given attrs.
@@ -132,13 +432,65 @@ class SLURMScheduler(_BatchScheduler):
         contents += '#SBATCH --job-name=\"' + run_name + '\"\n'
         contents += '#SBATCH -o output.txt\n'
         contents += '#SBATCH -n ' + str(numtasks) + '\n'
+        contents += '#SBATCH -N ' + str(num_nodes) + '\n'
+        if threads > 1:
+            contents += '#SBATCH --cpus-per-task=' + str(threads) + '\n'
+        if walltime:
+            contents += '#SBATCH --time=' + _format_walltime(walltime) + '\n'
         if email:
             self.logger.debug('%s configured for email reporting to %s'
                               % (run_name, email))
             contents += '#SBATCH --mail-user=' + email + '\n'
         contents += '###################################\n'
         contents += '\n'
-        contents += '%s bin/onramp_run.py\n' % self.local_python
+        if threads > 1:
+            contents += 'export OMP_NUM_THREADS=%d\n' % threads
+        contents += self.get_run_commands()
+        return contents
+
+    def get_array_batch_script(self, run_name, count, numtasks=4, num_nodes=1,
+                               email=None, threads=1, walltime=None):
+        """Return the batch script that runs an array job as per args formatted
+        for the SLURM batch scheduler.
+
+        Args:
+            run_name (str): Human-readable label for job run.
+            count (int): Number of array elements.
+            numtasks (int): Number of tasks to schedule per element.
+            num_nodes (int): Number of nodes to allocate per element.
+            email (str): Email to send results to upon completion. If None, no
+                email sent.
+            threads (int): Number of cores (OpenMP threads) per task.
+            walltime (int/None): Time limit in seconds. If None, the
+                scheduler's default limit applies.
+
+        Returns:
+            Batch script implementing given attrs.
+        """
+        contents = '#!/bin/bash\n'
+        contents += '\n'
+        contents += '###################################\n'
+        contents += '# Slurm Submission options\n'
+        contents += '#\n'
+        contents += '#SBATCH --job-name=\"' + run_name + '\"\n'
+        contents += '#SBATCH --array=0-%d\n' % (count - 1)
+        contents += '#SBATCH -o %a/output.txt\n'
+        contents += '#SBATCH -n ' + str(numtasks) + '\n'
+        contents += '#SBATCH -N ' + str(num_nodes) + '\n'
+        if threads > 1:
+            contents += '#SBATCH --cpus-per-task=' + str(threads) + '\n'
+        if walltime:
+            contents += '#SBATCH --time=' + _format_walltime(walltime) + '\n'
+        if email:
+            self.logger.debug('%s configured for email reporting to %s'
+                              % (run_name, email))
+            contents += '#SBATCH --mail-user=' + email + '\n'
+        contents += '###################################\n'
+        contents += '\n'
+        contents += 'cd ${SLURM_ARRAY_TASK_ID}\n'
+        if threads > 1:
+            contents += 'export OMP_NUM_THREADS=%d\n' % threads
+        contents += self.get_run_commands()
         return contents
         
     def schedule(self, proj_loc):
@@ -153,19 +505,16 @@ class SLURMScheduler(_BatchScheduler):
                 status_code: Status code
                 status_msg: String giving detailed status info.
         """
-        ret_dir = os.getcwd()
-        os.chdir(proj_loc)
         try:
-            batch_output = check_output(['sbatch', 'script.sh'], stderr=STDOUT)
+            batch_output = _call(['sbatch', 'script.sh'], stderr=STDOUT,
+                                 cwd=proj_loc, shared=False)
         except CalledProcessError as e:
             msg = 'Job scheduling call failed'
-            os.chdir(ret_dir)
             return {
                 'status_code': e.returncode,
                 'msg': '%s: %s' % (msg, e.output),
                 'status_msg': '%s: %s' % (msg, e.output)
             }
-        os.chdir(ret_dir)
         output_fields = batch_output.strip().split()
 
         if 'Submitted batch job' != ' '.join(output_fields[:-1]):
@@ -204,14 +553,159 @@ class SLURMScheduler(_BatchScheduler):
             giving detailed status info.
         """
         try:
-            job_info = check_output(['scontrol', 'show', 'job',
-                                     str(scheduler_job_num)])
+            job_info = _call(['scontrol', 'show', 'job', str(scheduler_job_num)])
         except CalledProcessError as e:
             msg = 'Job info call failed'
             self.logger.error(msg)
             return (-1, msg)
 
         job_state = job_info.split('JobState=')[1].split()[0]
+        return self._get_status(job_state)
+
+    def check_status_many(self, scheduler_job_nums):
+        """Return job status from scheduler for each of the given jobs.
+
+        Jobs still known to the controller are checked with a single squeue
+        call. Jobs squeue no longer reports are checked with a single sacct
+        call. Jobs neither reports, as when squeue fails on a purged job and
+        accounting is disabled, are checked one at a time with
+        check_status(), so that one purged job or failed call does not fail
+        every job checked with it.
+
+        Args:
+            scheduler_job_nums (list of int): Job numbers of the jobs to check
+                state on as given by the scheduler, not as given by OnRamp.
+
+        Returns:
+            Dict mapping each job number to a 2-Tuple with 0th item being error
+            code and 1st item being a string giving detailed status info.
+        """
+        nums = set(int(num) for num in scheduler_job_nums)
+        if not nums:
+            return {}
+
+        states = {}
+        job_list = ','.join(str(num) for num in sorted(nums))
+        try:
+            # squeue fails outright if any job has been purged, in which case
+            # all jobs are checked with sacct.
+            output = _call(['squeue', '-h', '--states=all', '-o', '%i %T',
+                            '-j', job_list], stderr=STDOUT)
+            states.update(self._parse_states(output))
+        except (CalledProcessError, OSError) as e:
+            self.logger.debug('squeue call failed: %s' % str(e))
+
+        missing = nums - set(states.keys())
+        if missing:
+            job_list = ','.join(str(num) for num in sorted(missing))
+            try:
+                output = _call(['sacct', '-n', '-X', '-P', '-o',
+                                'JobID,State', '-j', job_list], stderr=STDOUT)
+                states.update(self._parse_states(output, sep='|'))
+            except (CalledProcessError, OSError) as e:
+                self.logger.warn('sacct call failed: %s' % str(e))
+
+        results = {}
+        for num in nums:
+            if num in states:
+                results[num] = self._get_status(states[num])
+            else:
+                results[num] = self.check_status(num)
+        return results
+
+    def check_array_status(self, scheduler_job_num, count):
+        """Return status of each element of an array job from scheduler.
+
+        Elements still known to the controller are checked with squeue, and
+        the rest with sacct.
+
+        Args:
+            scheduler_job_num (int): Job number of the array job as given by
+                the scheduler, not as given by OnRamp.
+            count (int): Number of array elements.
+
+        Returns:
+            Dict mapping each element index to a 2-Tuple with 0th item being
+            error code and 1st item being a string giving detailed status info.
+        """
+        job_num = int(scheduler_job_num)
+        states = {}
+        try:
+            output = _call(['squeue', '-h', '-r', '--states=all', '-o',
+                            '%i %T', '-j', str(job_num)], stderr=STDOUT)
+            states.update(self._parse_array_states(output, job_num))
+        except (CalledProcessError, OSError) as e:
+            self.logger.debug('squeue call failed: %s' % str(e))
+
+        if set(range(count)) - set(states.keys()):
+            try:
+                output = _call(['sacct', '-n', '-X', '-P', '-o',
+                                'JobID,State', '-j', str(job_num)],
+                               stderr=STDOUT)
+                for index, state in self._parse_array_states(
+                        output, job_num, sep='|').items():
+                    states.setdefault(index, state)
+            except (CalledProcessError, OSError) as e:
+                self.logger.error('Job info call failed: %s' % str(e))
+
+        results = {}
+        for index in range(count):
+            if index in states:
+                results[index] = self._get_status(states[index])
+            else:
+                msg = 'Job info call failed'
+                self.logger.error('%s for job %d_%d' % (msg, job_num, index))
+                results[index] = (-1, msg)
+        return results
+
+    def _parse_array_states(self, output, job_num, sep=None):
+        """Return dict mapping element index to SLURM job state from squeue or
+        sacct output listing elements of the given array job, as JOB_INDEX or
+        JOB_[RANGES], and a state per line.
+        """
+        states = {}
+        prefix = '%d_' % job_num
+        for line in output.splitlines():
+            fields = line.strip().split(sep)
+            if len(fields) < 2 or not fields[0].startswith(prefix):
+                continue
+            state = fields[1].split()
+            state = state[0] if state else ''
+            spec = fields[0][len(prefix):]
+            try:
+                if not spec.startswith('['):
+                    states[int(spec)] = state
+                    continue
+                # Pending elements not yet split off, e.g. 42_[0-3,7%2].
+                for part in spec.strip('[]').split('%')[0].split(','):
+                    first, _, last = part.partition('-')
+                    for index in range(int(first), int(last or first) + 1):
+                        states[index] = state
+            except ValueError:
+                continue
+        return states
+
+    def _parse_states(self, output, sep=None):
+        """Return dict mapping job number to SLURM job state from squeue or
+        sacct output listing a job id and state per line.
+        """
+        states = {}
+        for line in output.splitlines():
+            fields = line.strip().split(sep)
+            if len(fields) < 2:
+                continue
+            try:
+                num = int(fields[0])
+            except ValueError:
+                # Job steps and array elements.
+                continue
+            # sacct gives states like 'CANCELLED by 1000'.
+            state = fields[1].split()
+            states[num] = state[0] if state else ''
+        return states
+
+    def _get_status(self, job_state):
+        """Translate a SLURM job state to a check_status() result."""
         if job_state == 'RUNNING':
             return (0, 'Running')
         elif job_state == 'COMPLETED':
@@ -239,7 +733,8 @@ class SLURMScheduler(_BatchScheduler):
             giving detailed status info.
         """
         try:
-            result = check_output(['scancel', str(scheduler_job_num)], stderr=STDOUT)
+            result = _call(['scancel', str(scheduler_job_num)], stderr=STDOUT,
+                           shared=False)
         except CalledProcessError as e:
             msg = 'Job cancel call failed'
             self.logger.error(msg)
@@ -261,7 +756,8 @@ class PBSScheduler(_BatchScheduler):
         """
         return type == 'PBS'
 
-    def get_batch_script(self, run_name, numtasks=4, num_nodes=1, email=None):
+    def get_batch_script(self, run_name, numtasks=4, num_nodes=1, email=None,
+                         threads=1, walltime=None):
         """Return the batch script that runs a job as per args formatted for the
         PBS batch scheduler.
 
@@ -271,6 +767,9 @@ class PBSScheduler(_BatchScheduler):
             num_nodes (int): Number of nodes to allocate for job.
             email (str): Email to send results to upon completion. If None, no
                 email sent.
+            threads (int): Number of cores (OpenMP threads) per task.
+            walltime (int/None): Time limit in seconds. If None, the
+                scheduler's default limit applies.
 
         Returns:
             Batch script implementing given attrs.
@@ -278,7 +777,10 @@ class PBSScheduler(_BatchScheduler):
         script = '#!/bin/bash\n'
         script += '\n'
         script += '################################################\n'
-        script += '#PBS -l select=%d:mpiprocs=%d\n' % (num_nodes, numtasks)
+        script += '#PBS -l %s\n' % self._get_select(numtasks, num_nodes,
+                                                    threads)
+        if walltime:
+            script += '#PBS -l walltime=%s\n' % _format_walltime(walltime)
         script += '#PBS -N %s\n' % run_name
         script += '#PBS -V\n'
         script += '#PBS -j oe\n'
@@ -286,9 +788,58 @@ class PBSScheduler(_BatchScheduler):
         script += '################################################\n'
         script += '\n'
         script += 'cd ${PBS_O_WORKDIR}\n'
-        script += '%s bin/onramp_run.py\n' % self.local_python
+        if threads > 1:
+            script += 'export OMP_NUM_THREADS=%d\n' % threads
+        script += self.get_run_commands()
         return script
 
+    def get_array_batch_script(self, run_name, count, numtasks=4, num_nodes=1,
+                               email=None, threads=1, walltime=None):
+        """Return the batch script that runs an array job as per args formatted
+        for the PBS batch scheduler.
+
+        Args:
+            run_name (str): Human-readable label for job run.
+            count (int): Number of array elements. PBS requires at least 2.
+            numtasks (int): Number of tasks to schedule per element.
+            num_nodes (int): Number of nodes to allocate per element.
+            email (str): Email to send results to upon completion. If None, no
+                email sent.
+            threads (int): Number of cores (OpenMP threads) per task.
+            walltime (int/None): Time limit in seconds. If None, the
+                scheduler's default limit applies.
+
+        Returns:
+            Batch script implementing given attrs.
+        """
+        script = '#!/bin/bash\n'
+        script += '\n'
+        script += '################################################\n'
+        script += '#PBS -l %s\n' % self._get_select(numtasks, num_nodes,
+                                                    threads)
+        if walltime:
+            script += '#PBS -l walltime=%s\n' % _format_walltime(walltime)
+        script += '#PBS -N %s\n' % run_name
+        script += '#PBS -J 0-%d\n' % (count - 1)
+        script += '#PBS -V\n'
+        script += '#PBS -j oe\n'
+        script += '#PBS -o ^array_index^/output.txt\n'
+        script += '################################################\n'
+        script += '\n'
+        script += 'cd ${PBS_O_WORKDIR}/${PBS_ARRAY_INDEX}\n'
+        if threads > 1:
+            script += 'export OMP_NUM_THREADS=%d\n' % threads
+        script += self.get_run_commands()
+        return script
+
+    def _get_select(self, numtasks, num_nodes, threads):
+        """Return the select resource spreading numtasks tasks of threads
+        cores each over num_nodes chunks.
+        """
+        per_node = -(-numtasks // num_nodes)
+        return ('select=%d:ncpus=%d:mpiprocs=%d:ompthreads=%d'
+                % (num_nodes, per_node * threads, per_node, threads))
+
     def schedule(self, proj_loc):
         """Schedule a job using the PBS batch scheduler.
 
@@ -301,22 +852,21 @@ class PBSScheduler(_BatchScheduler):
                 status_code: Status code
                 status_msg: String giving detailed status info.
         """
-        ret_dir = os.getcwd()
-        os.chdir(proj_loc)
         try:
-            batch_output = check_output(['qsub', 'script.sh'], stderr=STDOUT)
+            batch_output = _call(['qsub', 'script.sh'], stderr=STDOUT,
+                                 cwd=proj_loc, shared=False)
         except CalledProcessError as e:
             msg = 'Job scheduling call failed'
-            os.chdir(ret_dir)
             return {
-                'returncode': e.returncode,
-                'msg': '%s: %s' % (msg, e.output)
+                'status_code': e.returncode,
+                'msg': '%s: %s' % (msg, e.output),
+                'status_msg': '%s: %s' % (msg, e.output)
             }
-        os.chdir(ret_dir)
         output_fields = batch_output.strip().split('.')
 
         try:
-            job_num = int(output_fields[0])
+            # Array jobs are given as NUM[].
+            job_num = int(output_fields[0].rstrip('[]'))
         except ValueError, IndexError:
             msg = 'Unexpeted output from sbatch'
             self.logger.error(msg)
@@ -343,8 +893,8 @@ class PBSScheduler(_BatchScheduler):
             giving detailed status info.
         """
         try:
-            job_info = check_output(['qstat', '-i', str(scheduler_job_num)],
-                                    stderr=STDOUT)
+            job_info = _call(['qstat', '-i', str(scheduler_job_num)],
+                             stderr=STDOUT)
         except CalledProcessError as e:
             if e.output.startswith('qstat: Unknown Job Id %d' % scheduler_job_num):
                 return (0, 'No info')
@@ -354,6 +904,116 @@ class PBSScheduler(_BatchScheduler):
 
         last_line = job_info.strip().split('\n')[-1:][0]
         job_state = last_line.split()[9]
+        return self._get_status(job_state)
+
+    def check_status_many(self, scheduler_job_nums):
+        """Return job status from scheduler for each of the given jobs with a
+        single qstat call.
+
+        Args:
+            scheduler_job_nums (list of int): Job numbers of the jobs to check
+                state on as given by the scheduler, not as given by OnRamp.
+
+        If qstat fails without listing any job, each job is checked with
+        check_status(), so that one failed call does not fail every job.
+
+        Returns:
+            Dict mapping each job number to a 2-Tuple with 0th item being error
+            code and 1st item being a string giving detailed status info.
+        """
+        nums = set(int(num) for num in scheduler_job_nums)
+        if not nums:
+            return {}
+
+        try:
+            job_info = _call(['qstat', '-i'] +
+                             [str(num) for num in sorted(nums)], stderr=STDOUT)
+            failed = False
+        except CalledProcessError as e:
+            # qstat exits non-zero if any job is unknown, but still lists the
+            # others.
+            job_info = e.output
+            failed = True
+
+        results = {}
+        for line in job_info.splitlines():
+            if line.startswith('qstat: Unknown Job Id'):
+                try:
+                    num = int(line.split()[4].split('.')[0])
+                except (IndexError, ValueError):
+                    continue
+                results[num] = (0, 'No info')
+                continue
+            fields = line.split()
+            if len(fields) < 10:
+                continue
+            try:
+                num = int(fields[0].split('.')[0])
+            except ValueError:
+                # Header lines.
+                continue
+            if num in nums:
+                results[num] = self._get_status(fields[9])
+
+        if failed and not results:
+            self.logger.warn('qstat of %d jobs failed: %s'
+                             % (len(nums), job_info))
+            return dict((num, self.check_status(num)) for num in nums)
+
+        # Jobs qstat neither listed nor reported as unknown.
+        for num in nums - set(results.keys()):
+            results[num] = (0, 'No info')
+        return results
+
+    def check_array_status(self, scheduler_job_num, count):
+        """Return status of each element of an array job from scheduler with a
+        single qstat call.
+
+        Args:
+            scheduler_job_num (int): Job number of the array job as given by
+                the scheduler, not as given by OnRamp.
+            count (int): Number of array elements.
+
+        Returns:
+            Dict mapping each element index to a 2-Tuple with 0th item being
+            error code and 1st item being a string giving detailed status info.
+        """
+        job_num = int(scheduler_job_num)
+        try:
+            job_info = _call(['qstat', '-t', '-i', '%d[]' % job_num],
+                             stderr=STDOUT)
+        except CalledProcessError as e:
+            if e.output.startswith('qstat: Unknown Job Id'):
+                # Finished and no longer known.
+                return dict((index, (0, 'No info')) for index in range(count))
+            msg = 'Job info call failed: %s' % e.output
+            self.logger.error(msg)
+            return dict((index, (-1, msg)) for index in range(count))
+
+        results = {}
+        prefix = '%d[' % job_num
+        for line in job_info.splitlines():
+            fields = line.split()
+            if len(fields) < 10 or not fields[0].startswith(prefix):
+                continue
+            try:
+                index = int(fields[0][len(prefix):].split(']')[0])
+            except ValueError:
+                # The array job itself, listed as NUM[].
+                continue
+            if fields[9] == 'X':
+                # Finished subjob.
+                results[index] = (0, 'Done')
+            else:
+                results[index] = self._get_status(fields[9])
+
+        # Elements not listed are no longer known.
+        for index in set(range(count)) - set(results.keys()):
+            results[index] = (0, 'No info')
+        return results
+
+    def _get_status(self, job_state):
+        """Translate a PBS job state to a check_status() result."""
         if (job_state == 'R'
             or job_state == 'r'
             or job_state == 's'
@@ -361,7 +1021,7 @@ class PBSScheduler(_BatchScheduler):
             or job_state == 't'
             or job_state == 'T'):
             return (0, 'Running')
-        elif job_state == 'W' or job_state == 'H':
+        elif job_state == 'Q' or job_state == 'W' or job_state == 'H':
             return (0, 'Queued')
         elif job_state == 'E':
             msg = 'Job failed'
@@ -389,13 +1049,547 @@ class PBSScheduler(_BatchScheduler):
             giving detailed status info.
         """
         try:
-            result = check_output(['qdel', str(scheduler_job_num)], stderr=STDOUT)
+            result = _call(['qdel', str(scheduler_job_num)], stderr=STDOUT,
+                           shared=False)
         except CalledProcessError as e:
             msg = 'Job cancel call failed'
             self.logger.error(msg)
             return (-1, msg)
         return (0, result)
 
+    def cancel_array_job(self, scheduler_job_num):
+        """Cancel all elements of the given array job.
+
+        Args:
+            scheduler_job_num (int): Job number, as given by the scheduler, of
+                the array job to cancel.
+
+        Returns:
+            2-Tuple with 0th item being error code and 1st item being a string
+            giving detailed status info.
+        """
+        try:
+            result = _call(['qdel', '%d[]' % int(scheduler_job_num)],
+                           stderr=STDOUT, shared=False)
+        except CalledProcessError:
+            msg = 'Job cancel call failed'
+            self.logger.error(msg)
+            return (-1, msg)
+        return (0, result)
+
+class LocalScheduler(_BatchScheduler):
+    """Runs jobs directly on the PCE host, for deployments without a batch
+    scheduler.
+
+    Each job or array element is run as a task needing the number of cores
+    given by its script's '#LOCAL -n' directive. Tasks start in submission
+    order while the cores of running tasks fit in the core budget (the
+    local_cores setting of onramp_pce_config.cfg, or every core of the host if
+    0), and are queued otherwise. A task needing more cores than the budget
+    runs alone. Queued tasks are started, and finished tasks detected, each
+    time the status of any local job is checked.
+
+    Jobs are stored as JSON records in src/state/local_jobs under the PCE root,
+    guarded by a lock file, so they are shared by all PCE processes and
+    survive config reloads.
+    """
+
+    @classmethod
+    def is_scheduler_for(cls, type):
+        """Return boolean indicating whether the class provides an interface to
+        the batch scheduler type given.
+
+        Args:
+            type (str): Batch scheduler type.
+
+        Returns:
+            True if class provides interface to given batch scheduler, False if
+            not.
+        """
+        return type == 'Local'
+
+    def __init__(self, type, state_dir=None):
+        """Set batch scheduler type and return the instance.
+
+        Args:
+            type (str): Batch scheduler type.
+
+        Kwargs:
+            state_dir (str): Folder to store job records in. Defaults to
+                src/state/local_jobs under the PCE root.
+        """
+        _BatchScheduler.__init__(self, type)
+        if state_dir is None:
+            state_dir = _local_state_dir
+        self.state_dir = state_dir
+
+    def get_batch_script(self, run_name, numtasks=4, num_nodes=1, email=None,
+                         threads=1, walltime=None):
+        """Return the batch script that runs a job as per args formatted for the
+        local scheduler.
+
+        Args:
+            run_name (str): Human-readable label for job run.
+            numtasks (int): Number of tasks of the job.
+            num_nodes (int): Ignored. Jobs run on the PCE host.
+            email (str): Ignored. No email is sent.
+            threads (int): Number of cores (OpenMP threads) per task.
+            walltime (int/None): Time limit in seconds, after which the job is
+                killed. If None, there is no limit.
+
+        Returns:
+            Batch script implementing given attrs.
+        """
+        contents = '#!/bin/bash\n'
+        contents += '\n'
+        contents += '###################################\n'
+        contents += '# Local Submission options\n'
+        contents += '#\n'
+        contents += '#LOCAL --job-name="%s"\n' % run_name
+        contents += '#LOCAL -n %d\n' % (numtasks * threads)
+        if walltime:
+            contents += '#LOCAL --time=%d\n' % walltime
+        contents += '###################################\n'
+        contents += '\n'
+        if threads > 1:
+            contents += 'export OMP_NUM_THREADS=%d\n' % threads
+        contents += self.get_run_commands()
+        return contents
+
+    def get_array_batch_script(self, run_name, count, numtasks=4, num_nodes=1,
+                               email=None, threads=1, walltime=None):
+        """Return the batch script that runs an array job as per args formatted
+        for the local scheduler.
+
+        Args:
+            run_name (str): Human-readable label for job run.
+            count (int): Number of array elements.
+            numtasks (int): Number of tasks of each element.
+            num_nodes (int): Ignored. Jobs run on the PCE host.
+            email (str): Ignored. No email is sent.
+            threads (int): Number of cores (OpenMP threads) per task.
+            walltime (int/None): Time limit in seconds, after which the job is
+                killed. If None, there is no limit.
+
+        Returns:
+            Batch script implementing given attrs.
+        """
+        contents = '#!/bin/bash\n'
+        contents += '\n'
+        contents += '###################################\n'
+        contents += '# Local Submission options\n'
+        contents += '#\n'
+        contents += '#LOCAL --job-name="%s"\n' % run_name
+        contents += '#LOCAL --array=0-%d\n' % (count - 1)
+        contents += '#LOCAL -n %d\n' % (numtasks * threads)
+        if walltime:
+            contents += '#LOCAL --time=%d\n' % walltime
+        contents += '###################################\n'
+        contents += '\n'
+        contents += 'cd ${LOCAL_ARRAY_TASK_ID}\n'
+        if threads > 1:
+            contents += 'export OMP_NUM_THREADS=%d\n' % threads
+        contents += self.get_run_commands()
+        return contents
+
+    def schedule(self, proj_loc):
+        """Schedule a job using the local scheduler.
+
+        The job starts at once if its cores fit in the core budget.
+
+        Args:
+            proj_loc (str): Folder containing the batch script 'script.sh' for
+                the job to schedule.
+
+        Returns:
+            Result dict with the following fields:
+                status_code: Status code
+                status_msg: String giving detailed status info.
+        """
+        proj_loc = os.path.abspath(proj_loc)
+        try:
+            cores, count, walltime = self._parse_script(
+                                        os.path.join(proj_loc, 'script.sh'))
+        except (IOError, ValueError) as e:
+            msg = 'Job scheduling call failed: %s' % str(e)
+            self.logger.error(msg)
+            return {
+                'status_code': -7,
+                'msg': msg,
+                'status_msg': msg
+            }
+
+        with self._locked():
+            job_num = self._next_job_num()
+            tasks = []
+            for index in range(count or 1):
+                tasks.append({
+                    'index': index if count else None,
+                    'state': 'Queued',
+                    'pid': None,
+                    'exit_status': None
+                })
+            self._store_job({
+                'job_num': job_num,
+                'run_dir': proj_loc,
+                'cores': cores,
+                'walltime': walltime,
+                'submitted': time.time(),
+                'finished': None,
+                'tasks': tasks
+            })
+            self._dispatch()
+
+        return {
+            'status_code': 0,
+            'status_msg': 'Job %d scheduled' % job_num,
+            'job_num': job_num
+        }
+
+    def check_status(self, scheduler_job_num):
+        """Return job status from scheduler.
+
+        Args:
+            scheduler_job_num (int): Job number of the job to check state on as
+                given by the scheduler, not as given by OnRamp.
+
+        Returns:
+            2-Tuple with 0th item being error code and 1st item being a string
+            giving detailed status info.
+        """
+        return self.check_status_many([scheduler_job_num])[
+                                                    int(scheduler_job_num)]
+
+    def check_status_many(self, scheduler_job_nums):
+        """Return job status from scheduler for each of the given jobs.
+
+        Args:
+            scheduler_job_nums (list of int): Job numbers of the jobs to check
+                state on as given by the scheduler, not as given by OnRamp.
+
+        Returns:
+            Dict mapping each job number to a 2-Tuple with 0th item being error
+            code and 1st item being a string giving detailed status info.
+        """
+        nums = set(int(num) for num in scheduler_job_nums)
+        if not nums:
+            return {}
+
+        with self._locked():
+            jobs = self._dispatch()
+
+        results = {}
+        for num in nums:
+            if num not in jobs:
+                results[num] = (0, 'No info')
+                continue
+            tasks = jobs[num]['tasks']
+            if any(task['state'] == 'Running' for task in tasks):
+                results[num] = (0, 'Running')
+            elif any(task['state'] == 'Queued' for task in tasks):
+                results[num] = (0, 'Queued')
+            else:
+                # Finished. The status of a single job is that of its task.
+                results[num] = self._get_status(tasks[0])
+        return results
+
+    def check_array_status(self, scheduler_job_num, count):
+        """Return status of each element of an array job from scheduler.
+
+        Args:
+            scheduler_job_num (int): Job number of the array job as given by
+                the scheduler, not as given by OnRamp.
+            count (int): Number of array elements.
+
+        Returns:
+            Dict mapping each element index to a 2-Tuple with 0th item being
+            error code and 1st item being a string giving detailed status info.
+        """
+        with self._locked():
+            jobs = self._dispatch()
+
+        job = jobs.get(int(scheduler_job_num))
+        tasks = dict((task['index'], task) for task in
+                     (job['tasks'] if job else []))
+        results = {}
+        for index in range(count):
+            if index in tasks:
+                results[index] = self._get_status(tasks[index])
+            else:
+                results[index] = (0, 'No info')
+        return results
+
+    def cancel_job(self, scheduler_job_num):
+        """Cancel the given job, or all elements of the given array job.
+
+        Queued tasks are dropped, and running tasks are sent SIGTERM along
+        with any processes they started.
+
+        Args:
+            scheduler_job_num (int): Job number, as given by the scheduler, of the
+                job to cancel.
+
+        Returns:
+            2-Tuple with 0th item being error code and 1st item being a string
+            giving detailed status info.
+        """
+        job_num = int(scheduler_job_num)
+        with self._locked():
+            job = self._load_job(job_num)
+            if job is None:
+                msg = 'Job cancel call failed'
+                self.logger.error('%s: Unknown job %d' % (msg, job_num))
+                return (-1, msg)
+            for task in job['tasks']:
+                if task['state'] == 'Running':
+                    try:
+                        os.killpg(task['pid'], signal.SIGTERM)
+                    except OSError:
+                        # Already exited.
+                        pass
+                if task['state'] in ('Queued', 'Running'):
+                    task['state'] = 'Cancelled'
+            job['finished'] = time.time()
+            self._store_job(job)
+            self._dispatch()
+        return (0, 'Job %d cancelled' % job_num)
+
+    def _get_status(self, task):
+        """Translate the state of a task to a check_status() result."""
+        if task['state'] in ('Queued', 'Running'):
+            return (0, task['state'])
+        elif task['state'] == 'Done' and task['exit_status'] == 0:
+            return (0, 'Done')
+        elif task['state'] == 'Cancelled':
+            msg = 'Job cancelled'
+            self.logger.error(msg)
+            return (-1, msg)
+        else:
+            msg = 'Job failed'
+            self.logger.error(msg)
+            return (-1, msg)
+
+    def _parse_script(self, script):
+        """Return the cores per task, number of array elements (0 if not an
+        array job), and time limit in seconds (None if unlimited) from the
+        #LOCAL directives of a batch script.
+        """
+        cores = 1
+        count = 0
+        walltime = None
+        with open(script) as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) < 2 or fields[0] != '#LOCAL':
+                    continue
+                if fields[1] == '-n' and len(fields) > 2:
+                    cores = int(fields[2])
+                elif fields[1].startswith('--array=0-'):
+                    count = int(fields[1][len('--array=0-'):]) + 1
+                elif fields[1].startswith('--time='):
+                    walltime = int(fields[1][len('--time='):])
+        if cores < 1:
+            raise ValueError('Bad core count: %d' % cores)
+        return (cores, count, walltime)
+
+    def _locked(self):
+        """Return the lock guarding job records, across all PCE processes."""
+        try:
+            os.makedirs(self.state_dir)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        return StateLock(os.path.join(self.state_dir, '.lock'))
+
+    def _job_file(self, job_num):
+        """Return the path of the record of the given job."""
+        return os.path.join(self.state_dir, '%d.json' % job_num)
+
+    def _exit_file(self, job_num, task):
+        """Return the path of the file the exit status of a task is written
+        to.
+        """
+        if task['index'] is None:
+            return os.path.join(self.state_dir, '%d.exit' % job_num)
+        return os.path.join(self.state_dir,
+                            '%d_%d.exit' % (job_num, task['index']))
+
+    def _next_job_num(self):
+        """Return the next job number. Must be called with lock held."""
+        counter = os.path.join(self.state_dir, 'next_job_num')
+        try:
+            with open(counter) as f:
+                job_num = int(f.read())
+        except (IOError, ValueError):
+            job_num = 1
+        with open(counter, 'w') as f:
+            f.write('%d' % (job_num + 1))
+        return job_num
+
+    def _load_job(self, job_num):
+        """Return the record of the given job, or None if unknown."""
+        try:
+            with open(self._job_file(job_num)) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return None
+
+    def _store_job(self, job):
+        """Store the record of a job. Must be called with lock held."""
+        filename = self._job_file(job['job_num'])
+        tmp_filename = '%s.tmp' % filename
+        with open(tmp_filename, 'w') as f:
+            json.dump(job, f)
+        os.rename(tmp_filename, filename)
+
+    def _remove_job(self, job):
+        """Remove the record and exit files of a job."""
+        for filename in ([self._job_file(job['job_num'])] +
+                         [self._exit_file(job['job_num'], task)
+                          for task in job['tasks']]):
+            try:
+                os.remove(filename)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+
+    def _get_core_budget(self):
+        """Return the number of cores local tasks may use at once."""
+        # Imported here as PCE.tools.config imports this module.
+        from PCE.tools.config import get_pce_config
+        cores = get_pce_config()['cluster'].get('local_cores', 0)
+        if not cores:
+            cores = multiprocessing.cpu_count()
+        return cores
+
+    def _update_task(self, job, task):
+        """Mark a running task finished if it has exited, and kill it if it
+        has run longer than the job's time limit. Return True if the task was
+        changed.
+        """
+        if task['state'] != 'Running':
+            return False
+        job_num = job['job_num']
+        if (job.get('walltime') and task.get('started')
+            and time.time() - task['started'] > job['walltime']):
+            self.logger.debug('Local job %d exceeded its time limit'
+                              % job_num)
+            try:
+                os.killpg(task['pid'], signal.SIGKILL)
+            except OSError:
+                pass
+        # Reap the task if this process started it.
+        try:
+            os.waitpid(task['pid'], os.WNOHANG)
+        except OSError:
+            pass
+
+        exit_file = self._exit_file(job_num, task)
+        try:
+            with open(exit_file) as f:
+                task['exit_status'] = int(f.read())
+        except (IOError, ValueError):
+            try:
+                os.kill(task['pid'], 0)
+                return False
+            except OSError as e:
+                if e.errno == errno.EPERM:
+                    return False
+            # Killed before writing its exit status.
+            task['exit_status'] = -1
+        task['state'] = 'Done'
+        return True
+
+    def _start_task(self, job, task):
+        """Start a queued task. Its output goes to output.txt in the folder it
+        runs in, and its exit status to its exit file.
+        """
+        cwd = job['run_dir']
+        env = os.environ.copy()
+        if task['index'] is not None:
+            env['LOCAL_ARRAY_TASK_ID'] = str(task['index'])
+            output = os.path.join(cwd, str(task['index']), 'output.txt')
+        else:
+            output = os.path.join(cwd, 'output.txt')
+        env['LOCAL_JOB_ID'] = str(job['job_num'])
+        env['LOCAL_NUM_CORES'] = str(job['cores'])
+
+        # The shell writes the exit status so that it is known whichever
+        # process reaps the task.
+        command = ('/bin/bash script.sh > "$0" 2>&1; echo $? > "$1"')
+        with open(os.devnull, 'r+') as devnull:
+            p = Popen(['/bin/sh', '-c', command, output,
+                       self._exit_file(job['job_num'], task)],
+                      cwd=cwd, env=env, stdin=devnull, stdout=devnull,
+                      stderr=devnull, close_fds=True, preexec_fn=os.setsid)
+        task['pid'] = p.pid
+        task['state'] = 'Running'
+        task['started'] = time.time()
+        self.logger.debug('Started local job %d%s in %s' % (
+            job['job_num'],
+            '' if task['index'] is None else '_%d' % task['index'], cwd))
+
+    def _dispatch(self):
+        """Update the state of running tasks, start queued tasks that fit in
+        the core budget, and remove records of jobs finished long ago. Must
+        be called with lock held.
+
+        Returns:
+            Dict mapping job number to the record of each job.
+        """
+        jobs = {}
+        for name in os.listdir(self.state_dir):
+            if not name.endswith('.json'):
+                continue
+            job = self._load_job(int(name[:-len('.json')]))
+            if job is not None:
+                jobs[job['job_num']] = job
+
+        now = time.time()
+        budget = self._get_core_budget()
+        used = 0
+        queued = []
+        for job_num in sorted(jobs.keys()):
+            job = jobs[job_num]
+            if job['finished'] is not None:
+                if now - job['finished'] > _local_keep_finished:
+                    self._remove_job(job)
+                    del jobs[job_num]
+                continue
+            changed = False
+            for task in job['tasks']:
+                changed = self._update_task(job, task) or changed
+                if task['state'] == 'Running':
+                    used += job['cores']
+                elif task['state'] == 'Queued':
+                    queued.append((job, task))
+            if not any(task['state'] in ('Queued', 'Running')
+                       for task in job['tasks']):
+                job['finished'] = now
+                changed = True
+            if changed:
+                self._store_job(job)
+
+        # Tasks start in submission order. A task that does not fit blocks
+        # those after it, so that large jobs are not starved.
+        started = set()
+        for job, task in queued:
+            if used and used + job['cores'] > budget:
+                break
+            try:
+                self._start_task(job, task)
+            except OSError as e:
+                self.logger.error('Starting local job %d failed: %s'
+                                  % (job['job_num'], str(e)))
+                task['state'] = 'Done'
+                task['exit_status'] = -1
+            else:
+                used += job['cores']
+            started.add(job['job_num'])
+        for job_num in started:
+            self._store_job(jobs[job_num])
+        return jobs
+
 def Scheduler(type):
     """Instantiate the appropriate scheduler class for given type.
 
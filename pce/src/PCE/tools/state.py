@@ -0,0 +1,1286 @@
+"""Storage backends for OnRamp module and job state.
+
+State records are stored by kind ('jobs' or 'modules') and integer id. The
+JobState and ModState classes use the backend configured in the [state] section
+of onramp_pce_config.cfg for storage, while locking is always done with
+PCE.tools.locks on lock files in the state dirs.
+
+Exports:
+    JSONStateBackend: One JSON file per record under src/state/<kind>.
+    SQLiteStateBackend: Indexed SQLite database in WAL mode.
+    StateBackend: Generic instantiator for all implemented state backends.
+    get_state_backend: Return the state backend configured for the PCE.
+    load_state: Load a state record, from the state cache if enabled.
+    store_state: Store a state record with the configured backend.
+    delete_state: Remove a state record from the configured backend.
+    get_changes: Return state records changed since a journal sequence number.
+    StateCache: In-process cache of parsed state records.
+    enable_state_cache: Route state snapshot reads through a StateCache.
+    ChangeNotifier: Wakes threads waiting for changes to stored state.
+    enable_change_notifier: Wake waiters as soon as state changes.
+    wait_for_changes: Block until the change journal has new entries.
+    load_state_file: Load a state record from a JSON state file.
+    store_state_file: Atomically store a state record to a JSON state file.
+    remove_state_file: Remove a JSON state file.
+    migrate_state: Copy all state from one backend to another.
+"""
+import copy
+import errno
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from PCE.tools.config import get_pce_config
+from PCE.tools.inotify import InotifyWatcher
+from PCE.tools.locks import StateLock, is_locked
+from PCEHelper import pce_root
+
+_state_dir = os.path.join(pce_root, 'src/state')
+_kinds = ('jobs', 'modules')
+# The change journal is compacted every _journal_compact_interval entries.
+# Compaction drops all but the latest entry of each record, and the entries of
+# deletes more than _journal_keep_deletes entries old, so callers with an older
+# since must resynchronize.
+_journal_compact_interval = 10000
+_journal_keep_deletes = 10000
+_logger = logging.getLogger('onramp')
+_backend = None
+_cache = None
+_notifier = None
+
+def load_state_file(filename):
+    """Load a state record from a JSON state file.
+
+    Args:
+        filename (str): Path of the state file.
+
+    Returns:
+        Dict containing the stored state, or None if the file does not exist or
+        does not contain valid JSON.
+    """
+    try:
+        with open(filename, 'r') as f:
+            return json.load(f)
+    except IOError as e:
+        if e.errno != errno.ENOENT:
+            raise
+    except ValueError:
+        # Invalid json. Ignore (will be overwritten on next store).
+        pass
+    return None
+
+def store_state_file(filename, state):
+    """Atomically store a state record to a JSON state file.
+
+    The record is written to a hidden temp file in the same folder and renamed
+    over filename, so a reader never sees a partially written file.
+
+    Args:
+        filename (str): Path of the state file.
+        state (dict): State record to store.
+    """
+    folder, name = os.path.split(filename)
+    tmp_filename = os.path.join(folder, '.%s.%d.tmp' % (name, os.getpid()))
+    with open(tmp_filename, 'w') as f:
+        json.dump(state, f)
+    os.rename(tmp_filename, filename)
+
+def remove_state_file(filename):
+    """Remove a JSON state file, ignoring files that do not exist.
+
+    Args:
+        filename (str): Path of the state file.
+    """
+    try:
+        os.remove(filename)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+
+
+class _StateBackend(object):
+    """Superclass for state backend classes.
+
+    Subclasses must override the non-magic methods defined here.
+    """
+
+    @classmethod
+    def is_backend_for(cls, type):
+        """Return boolean indicating whether the class implements the given
+        state backend type.
+
+        Args:
+            type (str): State backend type.
+
+        Returns:
+            True if class implements given state backend, False if not.
+        """
+        pass
+
+    def load(self, kind, id):
+        """Return the stored state record for the given id.
+
+        Args:
+            kind (str): One of 'jobs', 'modules'.
+            id (int): Id of the job/module.
+
+        Returns:
+            Dict containing the stored state, or None if no state is stored.
+        """
+        pass
+
+    def store(self, kind, id, state):
+        """Store the state record for the given id, replacing any existing
+        record.
+
+        Args:
+            kind (str): One of 'jobs', 'modules'.
+            id (int): Id of the job/module.
+            state (dict): State record to store.
+        """
+        pass
+
+    def delete(self, kind, id):
+        """Remove the stored state record for the given id if it exists.
+
+        Args:
+            kind (str): One of 'jobs', 'modules'.
+            id (int): Id of the job/module.
+        """
+        pass
+
+    def find(self, kind, state=None, username=None, mod_id=None):
+        """Return stored state records matching all given attrs.
+
+        Args:
+            kind (str): One of 'jobs', 'modules'.
+
+        Kwargs:
+            state (str/list of str/None): If given, only return records whose
+                'state' attr is (one of) the given value(s).
+            username (str/None): If given, only return records with this
+                'username' attr.
+            mod_id (int/None): If given, only return records with this 'mod_id'
+                attr.
+
+        Returns:
+            List of (id, state record) tuples ordered by id.
+        """
+        pass
+
+    def stamp(self, kind, id):
+        """Return a cheap-to-compute value that changes whenever the stored
+        record for the given id changes.
+
+        Args:
+            kind (str): One of 'jobs', 'modules'.
+            id (int): Id of the job/module.
+
+        Returns:
+            Comparable value, or None if no record is stored.
+        """
+        pass
+
+    def last_seq(self):
+        """Return the sequence number of the latest change journal entry.
+
+        Returns:
+            Int sequence number, 0 if the journal is empty.
+        """
+        pass
+
+    def journal_since(self, kind, since):
+        """Return the records changed after the given journal entry.
+
+        Args:
+            kind (str): One of 'jobs', 'modules'.
+            since (int): Sequence number of the last change already seen.
+
+        Returns:
+            Tuple of the sequence number of the latest journal entry read and
+            a list of (id, seq, op) tuples giving the latest journal entry of
+            each record of the kind stored ('store') or deleted ('delete')
+            after since, ordered by seq.
+        """
+        pass
+
+    def journal_floor(self):
+        """Return the sequence number below which the journal is incomplete.
+
+        Returns:
+            Int sequence number. Entries at or below it may have been dropped
+            by compact_journal() or seed_journal().
+        """
+        pass
+
+    def compact_journal(self):
+        """Drop journal entries no longer needed to answer journal_since().
+
+        All but the latest entry of each record are dropped, along with the
+        entries of deletes more than _journal_keep_deletes entries old, which
+        raises the journal floor.
+        """
+        pass
+
+    def seed_journal(self, seq):
+        """Number later changes above seq, and raise the journal floor to seq.
+
+        Used when copying state from another backend, so that sequence numbers
+        (and entity tags derived from them) given out by the source are never
+        reused for other changes.
+
+        Args:
+            seq (int): Sequence number of the latest change of the source.
+        """
+        pass
+
+    def is_applying(self, kind, id):
+        """Return whether a journaled change of a record may not yet be
+        applied to the stored record.
+
+        Args:
+            kind (str): One of 'jobs', 'modules'.
+            id (int): Id of the job/module.
+
+        Returns:
+            False if every journaled change of the record has been applied, or
+            abandoned by a writer that exited before applying it.
+        """
+        pass
+
+    def watch_paths(self):
+        """Return the folders to watch for changes to stored state.
+
+        Returns:
+            List of folder paths.
+        """
+        pass
+
+    def event_key(self, path, name):
+        """Map a change to a file in a watched folder to the state it affects.
+
+        Args:
+            path (str): Watched folder containing the changed file.
+            name (str): Name of the changed file.
+
+        Returns:
+            (kind, id) tuple if a single record changed, 'all' if any record may
+            have changed, or None if no state changed.
+        """
+        pass
+
+    def __init__(self, type, state_dir=None):
+        """Set state backend type and location and return the instance.
+
+        Args:
+            type (str): State backend type.
+
+        Kwargs:
+            state_dir (str): Folder containing PCE state. Defaults to
+                src/state under the PCE root.
+        """
+        if state_dir is None:
+            state_dir = _state_dir
+        self.state_dir = state_dir
+
+    def changes_since(self, kind, since, state=None, username=None,
+                      mod_id=None):
+        """Return the state records changed after the given journal entry.
+
+        If since is 0, is older than the journal floor (after compaction or a
+        migration to a new backend), or is newer than the latest journal entry,
+        all records are returned so that the caller can resynchronize.
+
+        Args:
+            kind (str): One of 'jobs', 'modules'.
+            since (int): Sequence number of the last change already seen.
+
+        Kwargs:
+            state, username, mod_id: As for find(). Only applied to changed
+                records, deleted ids are always returned.
+
+        Returns:
+            Tuple of (seq, changed, deleted), where seq is the sequence number
+            to pass as since on the next call, changed is a list of
+            (id, state record) tuples for records stored after since and
+            deleted is a list of ids of records deleted after since.
+        """
+        seq = self.last_seq()
+        if since <= 0 or since > seq or since < self.journal_floor():
+            return (seq, self.find(kind, state=state, username=username,
+                                   mod_id=mod_id), [])
+
+        # Records are loaded after reading the journal, so each one is at
+        # least as new as the returned seq, unless its change is still being
+        # applied. The returned seq is then held below that change, so that
+        # the caller gets the record again once it has been applied.
+        seq, entries = self.journal_since(kind, since)
+        changed = []
+        deleted = []
+        for id, entry_seq, op in entries:
+            record = self.load(kind, id)
+            if not self._applied(record, entry_seq, op):
+                if self.is_applying(kind, id):
+                    seq = min(seq, entry_seq - 1)
+                    continue
+                # Applied since loaded, or abandoned.
+                record = self.load(kind, id)
+            if record is None:
+                deleted.append(id)
+            elif self._matches(record, state, username, mod_id):
+                changed.append((id, record))
+        return (max(seq, since), changed, deleted)
+
+    @staticmethod
+    def _applied(record, seq, op):
+        """Return True if a record reflects its journal entry seq."""
+        if op == 'delete':
+            return record is None or record.get('_seq', 0) > seq
+        return record is not None and record.get('_seq', 0) >= seq
+
+    @staticmethod
+    def _matches(record, state, username, mod_id):
+        """Return True if record matches all given find() attrs."""
+        if state is not None:
+            if isinstance(state, basestring):
+                state = [state]
+            if record.get('state') not in state:
+                return False
+        if username is not None and record.get('username') != username:
+            return False
+        if mod_id is not None and record.get('mod_id') != mod_id:
+            return False
+        return True
+
+
+class JSONStateBackend(_StateBackend):
+    """Store each state record as a JSON file under src/state/<kind>.
+
+    Changes are appended to the src/state/journal file as lines of the form
+    '<seq> <kind> <id> <op>', under an exclusive lock on src/state/.journal.lock
+    so that sequence numbers are assigned and appended in order. The lock is
+    only held to append the entry. The change is applied after, under the
+    record's state lock held by the caller, so that records are written in
+    parallel. Lines of kind '-' only mark a sequence number, and the journal
+    floor is kept in src/state/journal.floor.
+    """
+    _journal_name = 'journal'
+    _floor_name = 'journal.floor'
+
+    @classmethod
+    def is_backend_for(cls, type):
+        """Return boolean indicating whether the class implements the given
+        state backend type.
+
+        Args:
+            type (str): State backend type.
+
+        Returns:
+            True if class implements given state backend, False if not.
+        """
+        return type == 'json'
+
+    def _filename(self, kind, id):
+        """Return the path of the state file for the given record."""
+        return os.path.join(self.state_dir, kind, str(id))
+
+    def __init__(self, type, state_dir=None):
+        super(JSONStateBackend, self).__init__(type, state_dir=state_dir)
+        self.journal_filename = os.path.join(self.state_dir,
+                                             self._journal_name)
+        self._journal_lock_filename = os.path.join(self.state_dir,
+                                                   '.journal.lock')
+        self.floor_filename = os.path.join(self.state_dir, self._floor_name)
+
+    def _journal(self, kind, id, op, state=None):
+        """Assign the next sequence number to a change, append it to the
+        journal, and apply it.
+
+        A reader that has seen the entry before the change is applied finds
+        the record's state lock held, and waits for the change (see
+        _StateBackend.changes_since()).
+        """
+        with StateLock(self._journal_lock_filename):
+            seq = self.last_seq() + 1
+            self._append('%d %s %d %s\n' % (seq, kind, int(id), op))
+
+        if state is None:
+            remove_state_file(self._filename(kind, id))
+        else:
+            record = dict(state)
+            record['_seq'] = seq
+            store_state_file(self._filename(kind, id), record)
+
+        if seq % _journal_compact_interval == 0:
+            self.compact_journal()
+
+    def _append(self, line):
+        """Append a line to the journal. Must be called with the journal lock
+        held.
+        """
+        fd = os.open(self.journal_filename,
+                     os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0664)
+        try:
+            os.write(fd, line)
+        finally:
+            os.close(fd)
+
+    @staticmethod
+    def _parse_entry(line):
+        """Return (seq, kind, id, op) for a journal line, None if
+        incomplete.
+        """
+        if not line.endswith('\n'):
+            # Partially appended.
+            return None
+        fields = line.split()
+        if len(fields) != 4:
+            return None
+        return (int(fields[0]), fields[1], int(fields[2]), fields[3])
+
+    def load(self, kind, id):
+        return load_state_file(self._filename(kind, id))
+
+    def store(self, kind, id, state):
+        self._journal(kind, id, 'store', state)
+
+    def delete(self, kind, id):
+        self._journal(kind, id, 'delete')
+
+    def last_seq(self):
+        try:
+            f = open(self.journal_filename, 'r')
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return 0
+        with f:
+            f.seek(0, os.SEEK_END)
+            size = f.tell()
+            f.seek(max(0, size - 4096))
+            for line in reversed(f.read().splitlines(True)):
+                entry = self._parse_entry(line)
+                if entry is not None:
+                    return entry[0]
+        return 0
+
+    def journal_since(self, kind, since):
+        try:
+            f = open(self.journal_filename, 'r')
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return (0, [])
+        with f:
+            # Entries are in sequence order, so bisect to a line at or before
+            # the first entry after since rather than reading the whole file.
+            f.seek(0, os.SEEK_END)
+            lo = 0
+            hi = f.tell()
+            while hi - lo > 4096:
+                mid = (lo + hi) // 2
+                f.seek(mid)
+                f.readline()
+                entry = self._parse_entry(f.readline())
+                if entry is not None and entry[0] <= since:
+                    lo = mid
+                else:
+                    hi = mid
+            f.seek(lo)
+            if lo > 0:
+                f.readline()
+
+            seq = 0
+            latest = {}
+            for line in f:
+                entry = self._parse_entry(line)
+                if entry is None:
+                    break
+                seq = entry[0]
+                if seq > since and entry[1] == kind:
+                    latest[entry[2]] = (entry[2], seq, entry[3])
+        return (seq, sorted(latest.values(), key=lambda entry: entry[1]))
+
+    def journal_floor(self):
+        try:
+            with open(self.floor_filename, 'r') as f:
+                return int(f.read())
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+        except ValueError:
+            pass
+        return 0
+
+    def _set_floor(self, seq):
+        """Store the journal floor. Must be called with the journal lock
+        held.
+        """
+        folder, name = os.path.split(self.floor_filename)
+        tmp_filename = os.path.join(folder, '.%s.%d.tmp' % (name, os.getpid()))
+        with open(tmp_filename, 'w') as f:
+            f.write('%d\n' % seq)
+        os.rename(tmp_filename, self.floor_filename)
+
+    def compact_journal(self):
+        with StateLock(self._journal_lock_filename):
+            try:
+                f = open(self.journal_filename, 'r')
+            except IOError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+                return
+            with f:
+                latest = {}
+                for line in f:
+                    entry = self._parse_entry(line)
+                    if entry is None:
+                        break
+                    latest[entry[1:3]] = entry
+            if not latest:
+                return
+
+            seq = max(entry[0] for entry in latest.values())
+            horizon = seq - _journal_keep_deletes
+            floor = self.journal_floor()
+            kept = []
+            for entry in latest.values():
+                if entry[1] == '-' and entry[0] != seq:
+                    continue
+                if entry[3] == 'delete' and entry[0] <= horizon:
+                    floor = max(floor, entry[0])
+                    continue
+                kept.append(entry)
+            kept.sort()
+
+            # The floor is raised before entries are dropped, so that readers
+            # never see a journal missing entries above the floor.
+            if floor > self.journal_floor():
+                self._set_floor(floor)
+            folder, name = os.path.split(self.journal_filename)
+            tmp_filename = os.path.join(folder, '.%s.%d.tmp'
+                                        % (name, os.getpid()))
+            with open(tmp_filename, 'w') as f:
+                for entry in kept:
+                    f.write('%d %s %d %s\n' % entry)
+            os.rename(tmp_filename, self.journal_filename)
+        _logger.info('Compacted state change journal to %d entries'
+                     % len(kept))
+
+    def seed_journal(self, seq):
+        with StateLock(self._journal_lock_filename):
+            if seq > self.journal_floor():
+                self._set_floor(seq)
+            if seq > self.last_seq():
+                self._append('%d - 0 seed\n' % seq)
+
+    def is_applying(self, kind, id):
+        # Writers hold the record's state lock from before appending its entry
+        # until after applying it, and the kernel releases it if they exit.
+        return is_locked(os.path.join(self.state_dir, kind,
+                                      '.%d.lock' % int(id)))
+
+    def stamp(self, kind, id):
+        try:
+            st = os.stat(self._filename(kind, id))
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return None
+        # Stores rename a new file into place, so the inode always changes.
+        return (st.st_ino, st.st_mtime, st.st_size)
+
+    def watch_paths(self):
+        return [os.path.join(self.state_dir, kind) for kind in _kinds]
+
+    def event_key(self, path, name):
+        if not name.isdigit():
+            # Lock and temp files.
+            return None
+        return (os.path.basename(path), int(name))
+
+    def find(self, kind, state=None, username=None, mod_id=None):
+        # Only numeric names are state files. This skips hidden lock, temp
+        # and .nfs* files.
+        ids = sorted(int(name) for name in
+                     os.listdir(os.path.join(self.state_dir, kind))
+                     if name.isdigit())
+        results = []
+        for id in ids:
+            record = self.load(kind, id)
+            if (record is not None
+                and self._matches(record, state, username, mod_id)):
+                results.append((id, record))
+        return results
+
+
+class SQLiteStateBackend(_StateBackend):
+    """Store state records in a SQLite database in WAL mode.
+
+    The state, username and mod_id attrs of each record are kept in indexed
+    columns so that listings and state queries are a single indexed read.
+    Changes are journaled in the journal table, in the transaction applying
+    them, and the journal floor is kept in the journal_floor table.
+    """
+    _db_name = 'onramp_state.db'
+    _schema = [
+        'CREATE TABLE IF NOT EXISTS %s (id INTEGER PRIMARY KEY, state TEXT, '
+        'username TEXT, mod_id INTEGER, data TEXT NOT NULL)',
+        'CREATE INDEX IF NOT EXISTS %s_state ON %s (state)',
+        'CREATE INDEX IF NOT EXISTS %s_username ON %s (username)',
+        'CREATE INDEX IF NOT EXISTS %s_mod_id ON %s (mod_id)'
+    ]
+    _journal_schema = [
+        'CREATE TABLE IF NOT EXISTS journal (seq INTEGER PRIMARY KEY '
+        'AUTOINCREMENT, kind TEXT NOT NULL, id INTEGER NOT NULL, '
+        'op TEXT NOT NULL)',
+        'CREATE INDEX IF NOT EXISTS journal_kind_seq ON journal (kind, seq)',
+        'CREATE TABLE IF NOT EXISTS journal_floor (seq INTEGER NOT NULL)'
+    ]
+
+    @classmethod
+    def is_backend_for(cls, type):
+        """Return boolean indicating whether the class implements the given
+        state backend type.
+
+        Args:
+            type (str): State backend type.
+
+        Returns:
+            True if class implements given state backend, False if not.
+        """
+        return type == 'sqlite'
+
+    def __init__(self, type, state_dir=None):
+        super(SQLiteStateBackend, self).__init__(type, state_dir=state_dir)
+        self.db_filename = os.path.join(self.state_dir, self._db_name)
+        self._local = threading.local()
+
+    def _conn(self):
+        """Return the database connection for the current thread and process,
+        creating it if needed.
+        """
+        # Connections must not be shared across threads or forked processes.
+        if getattr(self._local, 'pid', None) != os.getpid():
+            conn = sqlite3.connect(self.db_filename, timeout=30,
+                                   isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            for kind in _kinds:
+                for stmt in self._schema:
+                    conn.execute(stmt.replace('%s', kind))
+            for stmt in self._journal_schema:
+                conn.execute(stmt)
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return self._local.conn
+
+    def load(self, kind, id):
+        row = self._conn().execute('SELECT data FROM %s WHERE id = ?' % kind,
+                                   (int(id),)).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0])
+
+    def _journal(self, conn, kind, id, op):
+        """Append a change to the journal and return its sequence number.
+
+        Must be called in the transaction applying the change.
+        """
+        return conn.execute('INSERT INTO journal (kind, id, op) '
+                            'VALUES (?, ?, ?)', (kind, int(id), op)).lastrowid
+
+    def store(self, kind, id, state):
+        conn = self._conn()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            record = dict(state)
+            seq = record['_seq'] = self._journal(conn, kind, id, 'store')
+            conn.execute(
+                'INSERT OR REPLACE INTO %s (id, state, username, mod_id, data) '
+                'VALUES (?, ?, ?, ?, ?)' % kind,
+                (int(id), state.get('state'), state.get('username'),
+                 state.get('mod_id'), json.dumps(record))
+            )
+            conn.execute('COMMIT')
+        except:
+            conn.execute('ROLLBACK')
+            raise
+        if seq % _journal_compact_interval == 0:
+            self.compact_journal()
+
+    def delete(self, kind, id):
+        conn = self._conn()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            seq = self._journal(conn, kind, id, 'delete')
+            conn.execute('DELETE FROM %s WHERE id = ?' % kind, (int(id),))
+            conn.execute('COMMIT')
+        except:
+            conn.execute('ROLLBACK')
+            raise
+        if seq % _journal_compact_interval == 0:
+            self.compact_journal()
+
+    def last_seq(self):
+        row = self._conn().execute('SELECT MAX(seq) FROM journal').fetchone()
+        return row[0] or 0
+
+    def journal_since(self, kind, since):
+        conn = self._conn()
+        # Read both in one transaction so they see the same snapshot.
+        conn.execute('BEGIN')
+        try:
+            seq = conn.execute('SELECT MAX(seq) FROM journal').fetchone()[0]
+            # SQLite takes op from the row with the max seq.
+            rows = conn.execute(
+                'SELECT id, MAX(seq) AS last, op FROM journal '
+                'WHERE kind = ? AND seq > ? GROUP BY id ORDER BY last',
+                (kind, since)
+            ).fetchall()
+        finally:
+            conn.execute('COMMIT')
+        return (seq or 0, [tuple(row) for row in rows])
+
+    def journal_floor(self):
+        row = self._conn().execute(
+                            'SELECT MAX(seq) FROM journal_floor').fetchone()
+        return row[0] or 0
+
+    def _set_floor(self, conn, seq):
+        """Raise the journal floor to seq. Must be called in a transaction."""
+        conn.execute('DELETE FROM journal_floor WHERE seq < ?', (seq,))
+        if conn.execute('SELECT COUNT(*) FROM journal_floor').fetchone()[0]:
+            return
+        conn.execute('INSERT INTO journal_floor (seq) VALUES (?)', (seq,))
+
+    def compact_journal(self):
+        conn = self._conn()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.execute('DELETE FROM journal WHERE seq NOT IN '
+                         '(SELECT MAX(seq) FROM journal GROUP BY kind, id)')
+            horizon = self.last_seq() - _journal_keep_deletes
+            floor = conn.execute('SELECT MAX(seq) FROM journal WHERE '
+                                 "op = 'delete' AND seq <= ?",
+                                 (horizon,)).fetchone()[0]
+            if floor is not None:
+                self._set_floor(conn, floor)
+                conn.execute("DELETE FROM journal WHERE op = 'delete' AND "
+                             'seq <= ?', (horizon,))
+            count = conn.execute('SELECT COUNT(*) FROM journal').fetchone()[0]
+            conn.execute('COMMIT')
+        except:
+            conn.execute('ROLLBACK')
+            raise
+        _logger.info('Compacted state change journal to %d entries' % count)
+
+    def seed_journal(self, seq):
+        conn = self._conn()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            self._set_floor(conn, seq)
+            if seq > self.last_seq():
+                conn.execute("INSERT INTO journal (seq, kind, id, op) "
+                             "VALUES (?, '-', 0, 'seed')", (seq,))
+            conn.execute('COMMIT')
+        except:
+            conn.execute('ROLLBACK')
+            raise
+
+    def is_applying(self, kind, id):
+        # Changes are applied in the transaction journaling them.
+        return False
+
+    def stamp(self, kind, id):
+        # Any commit changes the WAL or the database file, so this is a stamp
+        # for the whole database rather than the single record.
+        stamp = []
+        for filename in (self.db_filename, self.db_filename + '-wal'):
+            try:
+                st = os.stat(filename)
+                stamp.append((st.st_ino, st.st_mtime, st.st_size))
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+                stamp.append(None)
+        return tuple(stamp)
+
+    def watch_paths(self):
+        return [self.state_dir]
+
+    def event_key(self, path, name):
+        if name.startswith(self._db_name) and not name.endswith('-shm'):
+            return 'all'
+        return None
+
+    def find(self, kind, state=None, username=None, mod_id=None):
+        where = []
+        params = []
+        if state is not None:
+            if isinstance(state, basestring):
+                state = [state]
+            where.append('state IN (%s)' % ', '.join('?' * len(state)))
+            params += state
+        if username is not None:
+            where.append('username = ?')
+            params.append(username)
+        if mod_id is not None:
+            where.append('mod_id = ?')
+            params.append(mod_id)
+
+        query = 'SELECT id, data FROM %s' % kind
+        if where:
+            query += ' WHERE ' + ' AND '.join(where)
+        query += ' ORDER BY id'
+        return [(row[0], json.loads(row[1]))
+                for row in self._conn().execute(query, params)]
+
+
+def StateBackend(type, state_dir=None):
+    """Instantiate the appropriate state backend class for given type.
+
+    Args:
+        type (str): Identifier for state backend type.
+
+    Kwargs:
+        state_dir (str): Folder containing PCE state. Defaults to src/state
+            under the PCE root.
+
+    Returns:
+        Instance of a _StateBackend for given type.
+    """
+    for cls in _StateBackend.__subclasses__():
+        if cls.is_backend_for(type):
+            return cls(type, state_dir=state_dir)
+    raise ValueError
+
+def get_state_backend():
+    """Return the state backend configured in onramp_pce_config.cfg.
+
+    The backend is instantiated on first call and shared for the life of the
+    process.
+
+    Returns:
+        Instance of a _StateBackend.
+    """
+    global _backend
+    if _backend is None:
+        cfg = get_pce_config()
+        type = 'json'
+        if 'state' in cfg.keys() and 'backend' in cfg['state'].keys():
+            type = cfg['state']['backend']
+        _backend = StateBackend(type)
+    return _backend
+
+def load_state(kind, id, snapshot=False):
+    """Load a state record with the configured backend.
+
+    Args:
+        kind (str): One of 'jobs', 'modules'.
+        id (int): Id of the job/module.
+
+    Kwargs:
+        snapshot (bool): If True, the record is not being loaded under the
+            state lock and may be served from the state cache if enabled.
+
+    Returns:
+        Dict containing the stored state, or None if no state is stored.
+    """
+    if snapshot and _cache is not None:
+        return _cache.load(kind, id)
+    return get_state_backend().load(kind, id)
+
+def store_state(kind, id, state):
+    """Store a state record with the configured backend.
+
+    Args:
+        kind (str): One of 'jobs', 'modules'.
+        id (int): Id of the job/module.
+        state (dict): State record to store.
+    """
+    get_state_backend().store(kind, id, state)
+    if _cache is not None:
+        _cache.invalidate(kind, id)
+    if _notifier is not None:
+        _notifier.notify()
+
+def delete_state(kind, id):
+    """Remove a state record from the configured backend.
+
+    Args:
+        kind (str): One of 'jobs', 'modules'.
+        id (int): Id of the job/module.
+    """
+    get_state_backend().delete(kind, id)
+    if _cache is not None:
+        _cache.invalidate(kind, id)
+    if _notifier is not None:
+        _notifier.notify()
+
+
+def get_changes(kind, since, state=None, username=None, mod_id=None):
+    """Return state records changed since a change journal sequence number.
+
+    Every store and delete of a record is appended to the backend's change
+    journal with a monotonically increasing sequence number. Callers keep the
+    returned seq and pass it as since on their next call to receive only the
+    records that changed in between.
+
+    Args:
+        kind (str): One of 'jobs', 'modules'.
+        since (int): Sequence number returned by the previous call, 0 to get
+            all records.
+
+    Kwargs:
+        state, username, mod_id: Limit changed records as for
+            _StateBackend.find().
+
+    Returns:
+        Tuple of (seq, changed, deleted) as returned by
+        _StateBackend.changes_since().
+    """
+    return get_state_backend().changes_since(kind, since, state=state,
+                                             username=username, mod_id=mod_id)
+
+
+class StateCache(object):
+    """In-process cache of parsed state records.
+
+    When watching (see start_watching()), records are invalidated by inotify
+    events on the backend's state folders and cache hits do no filesystem I/O.
+    Otherwise, each hit is validated against the backend's stamp() for the
+    record, typically a single stat() call.
+
+    The cache of a forked child, such as a work queue task, starts afresh and
+    unwatched, as locks held by other threads at the fork would never be
+    released in the child, and the inotify thread invalidating records does
+    not run there.
+    """
+
+    def __init__(self, backend):
+        """Return an empty, unwatched StateCache.
+
+        Args:
+            backend (_StateBackend): Backend to load records from.
+        """
+        self.backend = backend
+        self._reset()
+
+    def _reset(self):
+        """Drop cached records, counts, and watcher and create a new lock."""
+        self._pid = os.getpid()
+        self._records = {}
+        self._lock = threading.Lock()
+        # Invalidation counters used to avoid caching a record loaded before,
+        # but inserted after, a change to it.
+        self._epoch = 0
+        self._key_epochs = {}
+        self._watcher = None
+        self._hits = 0
+        self._misses = 0
+
+    def _check_fork(self):
+        """Start afresh if this is a forked child of the process that created
+        or last reset the cache.
+        """
+        if self._pid != os.getpid():
+            self._reset()
+
+    def load(self, kind, id):
+        """Return a copy of the state record for the given id.
+
+        Args:
+            kind (str): One of 'jobs', 'modules'.
+            id (int): Id of the job/module.
+
+        Returns:
+            Dict containing the stored state, or None if no state is stored.
+        """
+        self._check_fork()
+        key = (kind, int(id))
+        watching = self._watcher is not None
+        stamp = None
+        if not watching:
+            stamp = self.backend.stamp(kind, id)
+
+        with self._lock:
+            entry = self._records.get(key)
+            if entry is not None and (watching or entry[0] == stamp):
+                self._hits += 1
+                return copy.deepcopy(entry[1])
+            self._misses += 1
+            epochs = (self._epoch, self._key_epochs.get(key, 0))
+
+        record = self.backend.load(kind, id)
+
+        with self._lock:
+            if epochs == (self._epoch, self._key_epochs.get(key, 0)):
+                self._records[key] = (stamp, record)
+        return copy.deepcopy(record)
+
+    def invalidate(self, kind=None, id=None):
+        """Drop cached records.
+
+        Kwargs:
+            kind (str/None): Kind of record to drop. If None, drop all records.
+            id (int/None): Id of record to drop. If None, drop all records.
+        """
+        self._check_fork()
+        with self._lock:
+            if kind is None or id is None:
+                self._records.clear()
+                self._epoch += 1
+                return
+            key = (kind, int(id))
+            self._records.pop(key, None)
+            self._key_epochs[key] = self._key_epochs.get(key, 0) + 1
+
+    def start_watching(self):
+        """Invalidate records via inotify instead of validating each hit.
+
+        Returns:
+            True if watching started, False if inotify is unavailable, in which
+            case stamp validation remains in use.
+        """
+        self._check_fork()
+        try:
+            watcher = InotifyWatcher(self.backend.watch_paths(),
+                                     self._handle_event)
+        except OSError as e:
+            _logger.warn('State cache falling back to mtime checks: %s'
+                         % str(e))
+            return False
+        # Events missed before the watch existed would never be seen.
+        self.invalidate()
+        watcher.start()
+        self._watcher = watcher
+        return True
+
+    def stop_watching(self):
+        """Stop inotify invalidation and fall back to stamp validation."""
+        self._check_fork()
+        watcher = self._watcher
+        if watcher is not None:
+            self._watcher = None
+            watcher.stop()
+            self.invalidate()
+
+    def _handle_event(self, path, name):
+        """Invalidate records affected by an inotify event."""
+        if path is None:
+            self.invalidate()
+            return
+        key = self.backend.event_key(path, name)
+        if key == 'all':
+            self.invalidate()
+        elif key is not None:
+            self.invalidate(*key)
+
+    def get_stats(self):
+        """Return cache counters.
+
+        Returns:
+            Dict with the following fields:
+                hits: Number of loads served from the cache.
+                misses: Number of loads served from the backend.
+                hit_rate: Fraction of loads served from the cache.
+                size: Number of cached records.
+                mode: 'inotify' or 'mtime', the invalidation mode in use.
+        """
+        self._check_fork()
+        with self._lock:
+            total = self._hits + self._misses
+            return {
+                'hits': self._hits,
+                'misses': self._misses,
+                'hit_rate': float(self._hits) / total if total else 0.0,
+                'size': len(self._records),
+                'mode': 'inotify' if self._watcher is not None else 'mtime'
+            }
+
+def enable_state_cache():
+    """Route state snapshot reads in this process through a StateCache.
+
+    Returns:
+        The StateCache in use.
+    """
+    global _cache
+    if _cache is None:
+        _cache = StateCache(get_state_backend())
+    return _cache
+
+class ChangeNotifier(object):
+    """Wakes threads waiting for changes to stored state.
+
+    Stores and deletes made through store_state() and delete_state() in this
+    process wake waiters at once. Changes stored by other processes, such as
+    work queue children, wake them through inotify events on the backend's
+    state folders while watching (see start_watching()), and are otherwise
+    found by checking the change journal every poll_interval seconds.
+
+    The notifier of a forked child starts afresh and unwatched, as for
+    StateCache. Waiters in the parent are woken by its own inotify watches.
+    """
+
+    def __init__(self, backend, poll_interval=1.0):
+        """Return an unwatched ChangeNotifier.
+
+        Args:
+            backend (_StateBackend): Backend whose change journal to follow.
+
+        Kwargs:
+            poll_interval (float): Max seconds between checks of the change
+                journal while waiting.
+        """
+        self.backend = backend
+        self.poll_interval = poll_interval
+        self._reset()
+
+    def _reset(self):
+        """Drop the watcher and create a new condition."""
+        self._pid = os.getpid()
+        self._cond = threading.Condition()
+        # Count of notifications, so a waiter can tell whether one arrived
+        # after it last read the journal.
+        self._generation = 0
+        self._stopped = False
+        self._watcher = None
+
+    def _check_fork(self):
+        """Start afresh if this is a forked child of the process that created
+        or last reset the notifier.
+        """
+        if self._pid != os.getpid():
+            self._reset()
+
+    def notify(self):
+        """Wake all waiting threads to check the change journal."""
+        self._check_fork()
+        with self._cond:
+            self._generation += 1
+            self._cond.notify_all()
+
+    def wait(self, since, timeout):
+        """Block until the change journal has entries after since.
+
+        Args:
+            since (int): Sequence number of the last change already seen.
+            timeout (float): Max seconds to wait.
+
+        Returns:
+            Sequence number of the latest change, equal to or less than since
+            if the wait timed out, or None if the notifier was stopped.
+        """
+        self._check_fork()
+        deadline = time.time() + timeout
+        while True:
+            with self._cond:
+                if self._stopped:
+                    return None
+                generation = self._generation
+            seq = self.backend.last_seq()
+            # A seq older than since means the journal was replaced, as after
+            # a migration, which callers resynchronize from.
+            remaining = deadline - time.time()
+            if seq != since or remaining <= 0:
+                return seq
+            with self._cond:
+                if generation == self._generation and not self._stopped:
+                    self._cond.wait(min(remaining, self.poll_interval))
+
+    def start_watching(self):
+        """Wake waiters via inotify on changes stored by other processes.
+
+        Returns:
+            True if watching started, False if inotify is unavailable, in which
+            case the change journal is polled.
+        """
+        self._check_fork()
+        with self._cond:
+            self._stopped = False
+        try:
+            watcher = InotifyWatcher(self.backend.watch_paths(),
+                                     lambda path, name: self.notify())
+        except OSError as e:
+            _logger.warn('Change notifier falling back to polling: %s'
+                         % str(e))
+            return False
+        watcher.start()
+        self._watcher = watcher
+        return True
+
+    def stop_watching(self):
+        """Stop inotify watching and release all waiting threads."""
+        self._check_fork()
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        watcher = self._watcher
+        if watcher is not None:
+            self._watcher = None
+            watcher.stop()
+
+def enable_change_notifier():
+    """Wake waiters in this process as soon as state changes.
+
+    Returns:
+        The ChangeNotifier in use.
+    """
+    global _notifier
+    if _notifier is None:
+        _notifier = ChangeNotifier(get_state_backend())
+    return _notifier
+
+def wait_for_changes(since, timeout):
+    """Block until the change journal has entries after since.
+
+    Without enable_change_notifier(), the journal is checked every second.
+
+    Args:
+        since (int): Sequence number of the last change already seen.
+        timeout (float): Max seconds to wait.
+
+    Returns:
+        As for ChangeNotifier.wait().
+    """
+    notifier = _notifier
+    if notifier is None:
+        notifier = ChangeNotifier(get_state_backend())
+    return notifier.wait(since, timeout)
+
+def migrate_state(source_type, dest_type, state_dir=None):
+    """Copy all job and module state from one backend to another.
+
+    Records already present in the destination are overwritten. The PCE service
+    should be stopped while migrating.
+
+    Args:
+        source_type (str): State backend type to copy from.
+        dest_type (str): State backend type to copy to.
+
+    Kwargs:
+        state_dir (str): Folder containing PCE state. Defaults to src/state
+            under the PCE root.
+
+    Returns:
+        Dict mapping each kind ('jobs', 'modules') to the number of records
+        copied.
+    """
+    source = StateBackend(source_type, state_dir=state_dir)
+    dest = StateBackend(dest_type, state_dir=state_dir)
+    # Clients of the source resynchronize, and its sequence numbers are never
+    # reused for other changes.
+    dest.seed_journal(source.last_seq())
+    counts = {}
+    for kind in _kinds:
+        counts[kind] = 0
+        for id, record in source.find(kind):
+            dest.store(kind, id, record)
+            counts[kind] += 1
+        _logger.info('Migrated %d %s records from %s to %s state'
+                     % (counts[kind], kind, source_type, dest_type))
+    return counts
@@ -0,0 +1,169 @@
+"""Deferred removal of module install folders and job run folders.
+
+Removing a large folder tree file by file can take seconds on network
+filesystems. Deletes instead rename the tree into the trash folder, which is
+atomic and frees its path at once, and the REST service removes trees in the
+trash in the background, at most trash_reap_rate files per second, every
+trash_reap_interval seconds (see onramp_pce_config.cfg).
+
+Exports:
+    trash_tree: Move a folder tree to the trash.
+    reap_trash: Remove trees in the trash.
+"""
+import errno
+import logging
+import os
+import shutil
+import time
+import uuid
+
+from PCE.tools.config import get_pce_config
+from PCEHelper import pce_root
+
+_trash_dir = os.path.join(pce_root, 'src/trash')
+_logger = logging.getLogger('onramp')
+
+def trash_tree(path, trash_dir=None):
+    """Move a folder tree to the trash, to be removed by reap_trash().
+
+    The tree is removed at once instead if trash_reap_interval is 0, or if it
+    is on a different filesystem than the trash.
+
+    Args:
+        path (str): Folder to remove.
+
+    Kwargs:
+        trash_dir (str): Trash folder. Defaults to src/trash under the PCE
+            root.
+
+    Returns:
+        True if the tree was removed or moved to the trash, False if it did
+        not exist.
+
+    Raises:
+        OSError: The tree could not be moved.
+    """
+    if not os.path.lexists(path):
+        return False
+    if not get_pce_config()['cluster']['trash_reap_interval']:
+        shutil.rmtree(path)
+        return True
+
+    if trash_dir is None:
+        trash_dir = _trash_dir
+    try:
+        os.makedirs(trash_dir)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+    # Named by time so that the oldest trees are removed first.
+    name = '%d-%s' % (time.time(), uuid.uuid4().hex)
+    try:
+        os.rename(path, os.path.join(trash_dir, name))
+    except OSError as e:
+        if e.errno == errno.ENOENT:
+            return False
+        if e.errno != errno.EXDEV:
+            raise
+        _logger.warn('%s is not on the trash filesystem, removing it now'
+                     % path)
+        shutil.rmtree(path)
+        return True
+    _logger.debug('Moved %s to trash as %s' % (path, name))
+    return True
+
+
+class _Pacer(object):
+    """Limit the rate of file removals by sleeping between them."""
+
+    def __init__(self, rate):
+        """Return a _Pacer.
+
+        Args:
+            rate (int): Max removals per second, 0 for no limit.
+        """
+        self.rate = rate
+        self.count = 0
+        self.start = time.time()
+
+    def tick(self):
+        """Count a removal, sleeping if the rate has been reached."""
+        if not self.rate:
+            return
+        self.count += 1
+        if self.count < self.rate:
+            return
+        elapsed = time.time() - self.start
+        if elapsed < 1.0:
+            time.sleep(1.0 - elapsed)
+        self.count = 0
+        self.start = time.time()
+
+def _remove(path, remove):
+    """Remove path with the given function, ignoring errors.
+
+    Returns:
+        True if removed, else False.
+    """
+    try:
+        remove(path)
+        return True
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            _logger.warn('Could not remove %s from trash: %s' % (path, e))
+        return False
+
+def _remove_tree(path, pacer):
+    """Remove a tree bottom up, pacing file removals.
+
+    Returns:
+        Number of files removed.
+    """
+    if not os.path.isdir(path) or os.path.islink(path):
+        return int(_remove(path, os.remove))
+
+    num_files = 0
+    for root, dirs, files in os.walk(path, topdown=False):
+        for name in files:
+            num_files += _remove(os.path.join(root, name), os.remove)
+            pacer.tick()
+        for name in dirs:
+            sub = os.path.join(root, name)
+            if os.path.islink(sub):
+                num_files += _remove(sub, os.remove)
+                pacer.tick()
+            else:
+                _remove(sub, os.rmdir)
+    _remove(path, os.rmdir)
+    return num_files
+
+def reap_trash(rate=None, trash_dir=None):
+    """Remove the trees in the trash, oldest first.
+
+    Kwargs:
+        rate (int): Max files removed per second, 0 for no limit. Defaults to
+            trash_reap_rate in onramp_pce_config.cfg.
+        trash_dir (str): Trash folder. Defaults to src/trash under the PCE
+            root.
+
+    Returns:
+        Tuple with 0th position being the number of trees removed and 1st
+        position the number of files removed.
+    """
+    if rate is None:
+        rate = get_pce_config()['cluster']['trash_reap_rate']
+    if trash_dir is None:
+        trash_dir = _trash_dir
+    try:
+        names = sorted(os.listdir(trash_dir))
+    except OSError as e:
+        if e.errno == errno.ENOENT:
+            return (0, 0)
+        raise
+
+    pacer = _Pacer(rate)
+    num_files = 0
+    for name in names:
+        num_files += _remove_tree(os.path.join(trash_dir, name), pacer)
+    return (len(names), num_files)
@@ -0,0 +1,393 @@
+"""Durable, bounded queue for long-running PCE work.
+
+Work such as module installs/deploys and job launches is stored as a task file
+in src/state/queue before being accepted, and run by a fixed number of worker
+threads, each running one task at a time in a child process. Tasks that were
+queued when the service stopped are run when it next starts. Tasks are not
+idempotent, so tasks that were running are not run again: their processes are
+left running across a restart and waited on again after it, and tasks whose
+processes died with the service are reported to their interrupt function.
+
+Exports:
+    WorkQueue: Durable task queue with a fixed-size worker pool.
+    QueueFull: Raised when submitting to a full queue.
+    enable_work_queue: Create the work queue used by the REST service.
+    get_work_queue: Return the work queue enabled in this process.
+"""
+import collections
+import errno
+import importlib
+import json
+import logging
+import os
+import threading
+import time
+
+from PCE.tools.state import store_state_file
+from PCEHelper import pce_root
+
+_queue_dir = os.path.join(pce_root, 'src/state/queue')
+_logger = logging.getLogger('onramp')
+_work_queue = None
+# Seconds between checks of whether an adopted task process, started by an
+# earlier PCE process, has exited.
+_adopt_poll_interval = 1.0
+
+def _load_func(module, name):
+    """Return the PCE function of a stored task."""
+    if module.split('.')[0] != 'PCE':
+        raise ValueError('Task module %s not in PCE package' % module)
+    return getattr(importlib.import_module(module), name)
+
+def _get_start_time(pid):
+    """Return the start time of a process, which with its pid identifies it
+    across pid reuse and reboots.
+
+    Returns:
+        Start time in clock ticks after boot, field 22 of /proc/<pid>/stat, or
+        None if there is no process with the pid.
+    """
+    try:
+        with open('/proc/%d/stat' % pid, 'r') as f:
+            stat = f.read()
+    except IOError as e:
+        if e.errno not in (errno.ENOENT, errno.ESRCH):
+            raise
+        return None
+    # The command name, field 2, is in parens and may contain spaces. Fields
+    # after it start with field 3.
+    return int(stat[stat.rindex(')') + 1:].split()[19])
+
+def _wait_pid(pid, start_time):
+    """Wait for a process to exit, whether or not it is a child.
+
+    Args:
+        pid (int): Pid of the process.
+        start_time (int/None): Start time of the process, as returned by
+            _get_start_time(), to tell it from a later process given the same
+            pid. Only needed if the process is not a child.
+    """
+    while True:
+        try:
+            os.waitpid(pid, 0)
+            return
+        except OSError as e:
+            if e.errno == errno.EINTR:
+                continue
+            if e.errno != errno.ECHILD:
+                raise
+            break
+    # Not a child of this process, or already reaped.
+    while start_time is not None and _get_start_time(pid) == start_time:
+        time.sleep(_adopt_poll_interval)
+
+class QueueFull(Exception):
+    """Raised by WorkQueue.submit() when max_queue tasks are already waiting."""
+    pass
+
+
+class WorkQueue(object):
+    """Run submitted tasks in at most max_workers child processes at a time.
+
+    Each task is stored as <seq>.task in the queue dir when submitted, renamed
+    to <seq>.running when started, rewritten with the pid and start time of
+    its process by that process before it runs the task, and removed when its
+    process exits.
+    Tasks are functions in the PCE package, referenced by module and name so
+    that they can be stored.
+
+    Task processes are forked directly rather than with multiprocessing, which
+    would wait for them when the service exits, so that stop() need not wait
+    for running tasks. start() then finds each .running task in one of three
+    states:
+        No pid: The task never started. It is run again.
+        Process alive: The task is adopted, and waited on by a worker. The
+            process must have both the recorded pid and start time, so that
+            an unrelated process later given the pid is not mistaken for it.
+        Process gone: The task was cut off. Its interrupt function, if any, is
+            called with the task's args to record the failure.
+    """
+
+    def __init__(self, max_workers=4, max_queue=100, queue_dir=None):
+        """Return an unstarted WorkQueue.
+
+        Kwargs:
+            max_workers (int): Max number of tasks to run at once.
+            max_queue (int): Max number of tasks waiting to run.
+            queue_dir (str): Folder to store tasks in. Defaults to
+                src/state/queue under the PCE root.
+        """
+        if queue_dir is None:
+            queue_dir = _queue_dir
+        self.queue_dir = queue_dir
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self._pending = collections.deque()
+        # (pid, start time) of the processes of adopted tasks by seq.
+        self._adopted = {}
+        # Pids of tasks waited on by workers by seq, including workers left
+        # waiting by stop().
+        self._active = {}
+        self._cond = threading.Condition()
+        self._workers = []
+        self._stopping = False
+        self._running = 0
+        self._completed = 0
+        self._rejected = 0
+
+        try:
+            os.mkdir(self.queue_dir)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        self._next_seq = 1 + max([0] + [int(name.split('.')[0]) for name in
+                                        self._list('.task', '.running')])
+
+    def _list(self, *suffixes):
+        """Return sorted names of files in the queue dir with given suffixes."""
+        return sorted(name for name in os.listdir(self.queue_dir)
+                      if name.endswith(suffixes)
+                      and name.split('.')[0].isdigit())
+
+    def _path(self, seq, suffix):
+        """Return the path of the task file for the given task."""
+        return os.path.join(self.queue_dir, '%012d%s' % (seq, suffix))
+
+    def start(self):
+        """Requeue stored tasks, adopt or recover running ones, and start the
+        worker threads.
+        """
+        with self._cond:
+            self._pending.clear()
+            self._adopted.clear()
+            for name in self._list('.running'):
+                seq = int(name.split('.')[0])
+                if seq not in self._active:
+                    self._recover(seq)
+            for name in self._list('.task'):
+                self._pending.append(int(name.split('.')[0]))
+            if self._pending:
+                _logger.info('Resuming %d queued tasks' % len(self._pending))
+            # Adopted tasks take the first workers.
+            self._pending.extendleft(sorted(self._adopted, reverse=True))
+            self._stopping = False
+
+        for i in range(self.max_workers):
+            worker = threading.Thread(target=self._work,
+                                      name='WorkQueue-%d' % i)
+            worker.daemon = True
+            worker.start()
+            self._workers.append(worker)
+
+    def _recover(self, seq):
+        """Requeue, adopt, or report as interrupted a task left running by an
+        earlier start(). Must be called with self._cond held.
+        """
+        filename = self._path(seq, '.running')
+        with open(filename, 'r') as f:
+            task = json.load(f)
+        pid = task.get('pid')
+        if pid is None:
+            os.rename(filename, self._path(seq, '.task'))
+            return
+        start_time = task.get('start_time')
+        if start_time is not None and _get_start_time(pid) == start_time:
+            _logger.info('Adopting running task %d (pid %d)' % (seq, pid))
+            self._adopted[seq] = (pid, start_time)
+            return
+
+        _logger.warn('Task %d: %s.%s%s was interrupted'
+                     % (seq, task['module'], task['function'],
+                        str(tuple(task['args']))))
+        try:
+            if task.get('interrupt_function'):
+                func = _load_func(task['module'], task['interrupt_function'])
+                func(*task['args'])
+        except Exception as e:
+            _logger.error('Error recovering interrupted task %d: %s'
+                          % (seq, str(e)))
+        finally:
+            os.remove(filename)
+
+    def stop(self, timeout=10):
+        """Stop the worker threads.
+
+        Workers stop once their current tasks complete, or after timeout
+        seconds, leaving the processes of tasks still running to finish on
+        their own. Those tasks are adopted by the next start(), and tasks not
+        yet started remain stored and are run by it.
+
+        Kwargs:
+            timeout (float): Max seconds to wait for running tasks.
+        """
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+        deadline = time.time() + timeout
+        for worker in self._workers:
+            worker.join(max(0, deadline - time.time()))
+        with self._cond:
+            if self._running:
+                _logger.info('Leaving %d tasks running' % self._running)
+        self._workers = []
+
+    def submit(self, func, args, interrupt_func=None):
+        """Store a task and queue it to run.
+
+        Args:
+            func (function): Function in the PCE package to run.
+            args (tuple): JSON-serializable args to call func with.
+
+        Kwargs:
+            interrupt_func (function/None): Function in the same module as
+                func to call with args, in place of func, if the task is cut
+                off by the process running it dying.
+
+        Returns:
+            Number of queued tasks ahead of the submitted one.
+
+        Raises:
+            QueueFull: max_queue tasks are already waiting to run.
+        """
+        task = {
+            'module': func.__module__,
+            'function': func.__name__,
+            'interrupt_function': (interrupt_func.__name__ if interrupt_func
+                                   else None),
+            'args': list(args)
+        }
+        with self._cond:
+            if len(self._pending) >= self.max_queue:
+                self._rejected += 1
+                raise QueueFull('%d tasks already queued' % len(self._pending))
+            seq = self._next_seq
+            self._next_seq += 1
+            store_state_file(self._path(seq, '.task'), task)
+            position = len(self._pending)
+            self._pending.append(seq)
+            self._cond.notify()
+        return position
+
+    def _work(self):
+        """Run queued tasks until stopped."""
+        while True:
+            with self._cond:
+                while not self._pending and not self._stopping:
+                    self._cond.wait()
+                if self._stopping:
+                    return
+                seq = self._pending.popleft()
+                adopted = self._adopted.pop(seq, None)
+                self._running += 1
+
+            try:
+                if adopted is None:
+                    self._run(seq)
+                else:
+                    self._wait(seq, *adopted)
+            except Exception as e:
+                _logger.error('Error running queued task %d: %s'
+                              % (seq, str(e)))
+            finally:
+                with self._cond:
+                    self._active.pop(seq, None)
+                    self._running -= 1
+                    self._completed += 1
+
+    def _run(self, seq):
+        """Run the given stored task in a child process and remove it."""
+        filename = self._path(seq, '.running')
+        os.rename(self._path(seq, '.task'), filename)
+        try:
+            with open(filename, 'r') as f:
+                task = json.load(f)
+            func = _load_func(task['module'], task['function'])
+            if task.get('interrupt_function'):
+                _load_func(task['module'], task['interrupt_function'])
+        except:
+            os.remove(filename)
+            raise
+
+        _logger.debug('Running queued task %d: %s.%s%s'
+                      % (seq, task['module'], task['function'],
+                         str(tuple(task['args']))))
+        pid = os.fork()
+        if pid == 0:
+            # Child. Record that the task has started, then run it. Objects
+            # shared with other threads of the parent, such as the state cache
+            # and the scheduler call broker, start afresh on first use here.
+            status = 1
+            try:
+                task['pid'] = os.getpid()
+                task['start_time'] = _get_start_time(task['pid'])
+                store_state_file(filename, task)
+                func(*task['args'])
+                status = 0
+            except:
+                _logger.exception('Error in queued task %d' % seq)
+            finally:
+                os._exit(status)
+        self._wait(seq, pid)
+
+    def _wait(self, seq, pid, start_time=None):
+        """Wait for the process of the given task to exit and remove the
+        task.
+
+        Args:
+            seq (int): Sequence number of the task.
+            pid (int): Pid of the task's process.
+
+        Kwargs:
+            start_time (int/None): Start time of the task's process, required
+                if it is not a child of this process.
+        """
+        with self._cond:
+            self._active[seq] = pid
+        _wait_pid(pid, start_time)
+        try:
+            os.remove(self._path(seq, '.running'))
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+    def get_stats(self):
+        """Return queue counters.
+
+        Returns:
+            Dict with the following fields:
+                queued: Number of tasks waiting to run, including adopted
+                    tasks not yet taken by a worker.
+                running: Number of tasks running or adopted.
+                completed: Number of tasks run since start.
+                rejected: Number of tasks rejected as the queue was full.
+                max_workers: Max number of tasks run at once.
+                max_queue: Max number of tasks waiting to run.
+        """
+        with self._cond:
+            return {
+                'queued': len(self._pending),
+                'running': self._running,
+                'completed': self._completed,
+                'rejected': self._rejected,
+                'max_workers': self.max_workers,
+                'max_queue': self.max_queue
+            }
+
+def enable_work_queue(max_workers, max_queue):
+    """Create the work queue used for work submitted in this process.
+
+    Args:
+        max_workers (int): Max number of tasks to run at once.
+        max_queue (int): Max number of tasks waiting to run.
+
+    Returns:
+        The unstarted WorkQueue.
+    """
+    global _work_queue
+    if _work_queue is None:
+        _work_queue = WorkQueue(max_workers=max_workers, max_queue=max_queue)
+    return _work_queue
+
+def get_work_queue():
+    """Return the work queue enabled in this process, None if not enabled."""
+    return _work_queue
@@ -9,13 +9,181 @@ import socket
 import sys
 
 import cherrypy
-from cherrypy.process.plugins import Daemonizer, PIDFile
-from configobj import ConfigObj
-from validate import Validator
+from cherrypy.process.plugins import Daemonizer, Monitor, PIDFile, \
+                                     SimplePlugin
 
-from PCE.dispatchers import APIMap, ClusterInfo, ClusterPing, Files, Jobs, \
-                            Modules
-from PCEHelper import pce_root
+from PCE.dispatchers import APIMap, ClusterInfo, ClusterPing, Events, Files, \
+                            Jobs, Modules
+from PCE.tools.config import get_pce_config, reload_config
+from PCE.tools.jobs import check_run_events, enable_job_poller, poll_jobs
+from PCE.tools.schedulers import get_call_stats
+from PCE.tools.state import enable_change_notifier, enable_state_cache
+from PCE.tools.trash import reap_trash
+from PCE.tools.workqueue import enable_work_queue
+
+_log_levels = {
+    'DEBUG': logging.DEBUG,
+    'INFO': logging.INFO,
+    'WARNING': logging.WARNING,
+    'ERROR': logging.ERROR,
+    'CRITICAL': logging.CRITICAL
+}
+# Attrs of the [server] section of onramp_pce_config.cfg read by the PCE
+# rather than passed to CherryPy.
+_pce_server_attrs = ['max_streams']
+
+
+class _StateCachePlugin(SimplePlugin):
+    """Run inotify invalidation of the state cache while the engine runs."""
+
+    def __init__(self, bus, cache):
+        """Initialize the plugin.
+
+        Args:
+            bus (cherrypy.process.wspbus.Bus): Bus to subscribe to.
+            cache (PCE.tools.state.StateCache): Cache to watch for.
+        """
+        SimplePlugin.__init__(self, bus)
+        self.cache = cache
+        self.running = False
+
+    def start(self):
+        """Start watching state folders."""
+        self.running = True
+        if self.cache.start_watching():
+            self.bus.log('State cache invalidating via inotify')
+    # Start after Daemonizer forks so the watcher thread lives in the daemon.
+    start.priority = 75
+
+    def stop(self):
+        """Stop watching state folders and log final cache stats."""
+        # The engine may be stopped more than once on exit.
+        if not self.running:
+            return
+        self.running = False
+        _log_cache_stats(self.cache)
+        self.cache.stop_watching()
+
+def _log_cache_stats(cache):
+    """Log hit/miss counts of the state cache."""
+    stats = cache.get_stats()
+    logging.getLogger('onramp').info(
+        'State cache: %d hits, %d misses (%.1f%% hit rate), %d records, '
+        'invalidation by %s' % (stats['hits'], stats['misses'],
+                                100 * stats['hit_rate'], stats['size'],
+                                stats['mode']))
+
+def _log_scheduler_call_stats():
+    """Log counts of scheduler calls made by the REST service process."""
+    stats = get_call_stats()
+    logging.getLogger('onramp').info(
+        'Scheduler calls: %d run, %d coalesced, %d cached, %d throttled '
+        '(%.1fs waited)' % (stats['calls'], stats['coalesced'],
+                            stats['cached'], stats['throttled'],
+                            stats['throttle_wait']))
+
+class _ChangeNotifierPlugin(SimplePlugin):
+    """Run inotify watching of the change notifier while the engine runs."""
+
+    def __init__(self, bus, notifier):
+        """Initialize the plugin.
+
+        Args:
+            bus (cherrypy.process.wspbus.Bus): Bus to subscribe to.
+            notifier (PCE.tools.state.ChangeNotifier): Notifier to watch for.
+        """
+        SimplePlugin.__init__(self, bus)
+        self.notifier = notifier
+
+    def start(self):
+        """Start watching state folders."""
+        if self.notifier.start_watching():
+            self.bus.log('Change notifier watching via inotify')
+    # Start after Daemonizer forks so the watcher thread lives in the daemon.
+    start.priority = 75
+
+    def stop(self):
+        """Stop watching and release requests waiting for changes."""
+        self.notifier.stop_watching()
+    # Stop before the HTTP server, which waits for its requests to end.
+    stop.priority = 10
+
+class _WorkQueuePlugin(SimplePlugin):
+    """Run the work queue's workers while the engine runs."""
+
+    def __init__(self, bus, queue):
+        """Initialize the plugin.
+
+        Args:
+            bus (cherrypy.process.wspbus.Bus): Bus to subscribe to.
+            queue (PCE.tools.workqueue.WorkQueue): Queue to run.
+        """
+        SimplePlugin.__init__(self, bus)
+        self.queue = queue
+        self.running = False
+
+    def start(self):
+        """Start the workers, resuming stored tasks and adopting running
+        ones.
+        """
+        self.running = True
+        self.queue.start()
+        self.bus.log('Work queue running %d workers'
+                     % self.queue.max_workers)
+    # Start after Daemonizer forks so the worker threads live in the daemon.
+    start.priority = 75
+
+    def stop(self):
+        """Stop the workers once their running tasks complete, or leave the
+        tasks running for the next start() to adopt.
+        """
+        if not self.running:
+            return
+        self.running = False
+        self.queue.stop()
+        stats = self.queue.get_stats()
+        logging.getLogger('onramp').info(
+            'Work queue stopped: %d tasks run, %d queued, %d rejected'
+            % (stats['completed'], stats['queued'], stats['rejected']))
+
+def _poll_jobs():
+    """Update state of active jobs from the batch scheduler.
+
+    Errors are logged rather than raised so that the poller keeps running.
+    """
+    logger = logging.getLogger('onramp')
+    try:
+        num_jobs = poll_jobs()
+        logger.debug('Polled scheduler status of %d jobs' % num_jobs)
+    except Exception as e:
+        logger.error('Job status poll failed: %s' % str(e))
+
+def _check_run_events():
+    """Apply run events written by the batch scripts of finished jobs.
+
+    Errors are logged rather than raised so that the check keeps running.
+    """
+    logger = logging.getLogger('onramp')
+    try:
+        num_events = check_run_events()
+        if num_events:
+            logger.debug('Applied %d job run events' % num_events)
+    except Exception as e:
+        logger.error('Job run event check failed: %s' % str(e))
+
+def _reap_trash():
+    """Remove deleted module and run folders moved to the trash.
+
+    Errors are logged rather than raised so that the reaper keeps running.
+    """
+    logger = logging.getLogger('onramp')
+    try:
+        num_trees, num_files = reap_trash()
+        if num_trees:
+            logger.debug('Removed %d trees, %d files from trash'
+                         % (num_trees, num_files))
+    except Exception as e:
+        logger.error('Trash reap failed: %s' % str(e))
 
 
 def _CORS():
@@ -37,17 +205,49 @@ def _term_handler(signal, frame):
     sys.exit(0)
 
 def _restart_handler(signal, frame):
-    """Restart the server.
+    """Reload onramp_pce_config.cfg, restarting the server if required.
+
+    The new config is used by all subsequent requests. Log level changes are
+    applied immediately. Server, state, queue, and poller settings are only
+    read at startup, so the server is restarted if any of them changed.
 
     This function is intended to be registered as a SIGHUP handler.
     """
     logger = logging.getLogger('onramp')
-    logger.info('Restarting server')
-    # FIXME: This needs to reload the config, including attrs in
-    # onramp_pce_config.cfg.
-    cherrypy.engine.restart()
-    logger.debug('Blocking cherrypy engine')
-    cherrypy.engine.block()
+    logger.info('Reloading onramp_pce_config.cfg')
+    old_cfg = get_pce_config()
+    result = reload_config()
+    if result[0] != 0:
+        logger.error('%s (keeping current config)' % result[1])
+        return
+    cfg = get_pce_config()
+
+    if 'log_level' in cfg['cluster'].keys():
+        logger.setLevel(_log_levels[cfg['cluster']['log_level']])
+
+    restart_attrs = [
+        ('server', None),
+        ('state', None),
+        ('queue', None),
+        ('cluster', 'log_file'),
+        ('cluster', 'status_poll_interval'),
+        ('cluster', 'run_event_interval'),
+        ('cluster', 'trash_reap_interval'),
+        ('cluster', 'scheduler_stats_interval')
+    ]
+    for section, key in restart_attrs:
+        old_val = old_cfg.get(section)
+        new_val = cfg.get(section)
+        if key is not None:
+            old_val = old_val.get(key) if old_val is not None else None
+            new_val = new_val.get(key) if new_val is not None else None
+        if old_val != new_val:
+            logger.info('Restarting server')
+            cherrypy.engine.restart()
+            logger.debug('Blocking cherrypy engine')
+            cherrypy.engine.block()
+            return
+    logger.info(result[1])
 
 if __name__ == '__main__':
     # Default conf. Some of these can/will be overrided by attrs in
@@ -78,12 +278,11 @@ if __name__ == '__main__':
 
     # Load onramp_pce_config.cfg and integrate appropriate attrs into cherrpy
     # conf.
-    cfg = ConfigObj(os.path.join(pce_root, 'bin', 'onramp_pce_config.cfg'),
-                    configspec=os.path.join(pce_root, 'src', 'configspecs',
-                                            'onramp_pce_config.cfgspec'))
-    cfg.validate(Validator())
+    cfg = get_pce_config()
     if 'server' in cfg.keys():
         for k in cfg['server']:
+            if k in _pce_server_attrs:
+                continue
             conf['global']['server.' + k] = cfg['server'][k]
     if 'cluster' in cfg.keys():
         if 'log_level' in cfg['cluster'].keys():
@@ -98,33 +297,73 @@ if __name__ == '__main__':
     cherrypy.config.update(conf)
 
     # Set up logging.
-    log_levels = {
-        'DEBUG': logging.DEBUG,
-        'INFO': logging.INFO,
-        'WARNING': logging.WARNING,
-        'ERROR': logging.ERROR,
-        'CRITICAL': logging.CRITICAL
-    }
     log_name = 'onramp'
     logger = logging.getLogger(log_name)
-    logger.setLevel(log_levels[conf['internal']['log_level']])
+    logger.setLevel(_log_levels[conf['internal']['log_level']])
     handler = logging.FileHandler(conf['internal']['onramp_log_file'])
     handler.setFormatter(
         logging.Formatter('[%(asctime)s] %(levelname)s %(message)s'))
     logger.addHandler(handler)
     logger.info('Logging at %s to %s' % (conf['internal']['log_level'],
                                          conf['internal']['onramp_log_file']))
+    if cfg['server']['max_streams'] >= cfg['server']['thread_pool']:
+        logger.warn('max_streams is not below thread_pool. Event streams, '
+                    'output follows, and job watches may hold every server '
+                    'thread.')
 
     # Log the PID
     PIDFile(cherrypy.engine, conf['internal']['PIDfile']).subscribe()
 
     Daemonizer(cherrypy.engine).subscribe()
+
+    # Cache parsed state for snapshot reads.
+    if cfg['state']['cache']:
+        cache = enable_state_cache()
+        _StateCachePlugin(cherrypy.engine, cache).subscribe()
+        interval = cfg['state']['cache_stats_interval']
+        if interval:
+            Monitor(cherrypy.engine, lambda: _log_cache_stats(cache),
+                    frequency=interval, name='StateCacheStats').subscribe()
+
+    # Wake job watches and event streams as soon as state changes.
+    _ChangeNotifierPlugin(cherrypy.engine, enable_change_notifier()).subscribe()
+
+    # Run launches, installs and deploys on a bounded worker pool.
+    queue = enable_work_queue(cfg['queue']['max_workers'],
+                              cfg['queue']['max_queue'])
+    _WorkQueuePlugin(cherrypy.engine, queue).subscribe()
+
+    # Poll scheduler status of active jobs in the background.
+    interval = cfg['cluster']['status_poll_interval']
+    if interval:
+        enable_job_poller()
+        Monitor(cherrypy.engine, _poll_jobs, frequency=interval,
+                name='JobPoller').subscribe()
+
+    # Start postprocessing as soon as batch scripts report their end.
+    interval = cfg['cluster']['run_event_interval']
+    if interval:
+        Monitor(cherrypy.engine, _check_run_events, frequency=interval,
+                name='RunEvents').subscribe()
+
+    interval = cfg['cluster']['scheduler_stats_interval']
+    if interval:
+        Monitor(cherrypy.engine, _log_scheduler_call_stats, frequency=interval,
+                name='SchedulerCallStats').subscribe()
+
+    # Remove deleted module and run folders without blocking requests.
+    interval = cfg['cluster']['trash_reap_interval']
+    if interval:
+        Monitor(cherrypy.engine, _reap_trash, frequency=interval,
+                name='TrashReaper').subscribe()
+
     cherrypy.tools.CORS = cherrypy.Tool('before_finalize', _CORS)
     cherrypy.tree.mount(Modules(cfg, log_name), '/modules', conf)
     cherrypy.tree.mount(Jobs(cfg, log_name), '/jobs', conf)
     cherrypy.tree.mount(ClusterInfo(cfg, log_name), '/cluster/info', conf)
     cherrypy.tree.mount(ClusterPing(cfg, log_name), '/cluster/ping', conf)
     cherrypy.tree.mount(Files(cfg, log_name), '/files', conf)
+    cherrypy.tree.mount(Events(cfg, log_name), '/events', conf)
     cherrypy.tree.mount(APIMap(cfg, log_name), '/api', conf)
 
     logger.info('Starting cherrypy engine')
@@ -0,0 +1,530 @@
+#!/usr/bin/env python
+"""Stand-ins for SLURM and PBS commands, for load testing the PCE without a
+cluster.
+
+The sbatch, scontrol, squeue, sacct, and scancel commands, and the qsub,
+qstat, and qdel commands, in this folder run this script, which mimics the
+output of the real commands as parsed by PCE.tools.schedulers. Submitted jobs
+really run their script.sh on the local host, with output written where the
+script's #SBATCH -o or #PBS -o directive says, so module run scripts and
+postprocessing work as on a cluster.
+
+To use, put this folder first in the PATH of the PCE service:
+
+    PATH=$PWD/src/testing/fakesched:$PATH bin/onramp_pce_service.py start
+
+There is no daemon. Jobs move from pending to running to finished each time
+one of the commands is run, so the PCE polling status drives progress. Job
+state is kept in jobs.json in the state folder, guarded by a lock file, and
+is shared by the SLURM and PBS commands.
+
+Behavior is set with environment variables of the PCE service:
+
+    FAKESCHED_DIR: State folder. Default: /tmp/fakesched-USER.
+    FAKESCHED_LATENCY: Seconds each command takes to respond. Default: 0.
+    FAKESCHED_QUEUE_WAIT: Min seconds jobs are pending before they may start.
+        Default: 0.
+    FAKESCHED_MAX_RUNNING: Max number of jobs (or array elements) running at
+        once, 0 for no limit. Default: 0.
+    FAKESCHED_FAIL_RATE: Fraction, from 0 to 1, of jobs that fail when
+        started, without running their script, as if their node failed.
+        Default: 0.
+    FAKESCHED_CALL_FAIL_RATE: Fraction of command calls that fail with a
+        communication error, as when the controller is overloaded. Default: 0.
+    FAKESCHED_MIN_JOB_AGE: Seconds finished jobs are still listed by squeue,
+        as SLURM's MinJobAge. Default: 300.
+    FAKESCHED_PURGE_AGE: Seconds after which finished jobs are forgotten,
+        also by sacct. Default: 3600.
+
+A job whose script exits non-zero ends FAILED. Works with Python 2.7 and 3.
+"""
+import errno
+import fcntl
+import json
+import os
+import random
+import signal
+import subprocess
+import sys
+import time
+
+_hostname = 'fakehost'
+_slurm_commands = ['sbatch', 'scontrol', 'squeue', 'sacct', 'scancel']
+_pbs_commands = ['qsub', 'qstat', 'qdel']
+
+
+class CommandError(Exception):
+    """Raised to exit a command with the given message and exit status."""
+
+    def __init__(self, msg, status=1):
+        Exception.__init__(self, msg)
+        self.status = status
+
+
+def _get_setting(name, default, type=float):
+    """Return the value of the FAKESCHED_<name> environment variable."""
+    value = os.environ.get('FAKESCHED_%s' % name)
+    if value is None:
+        return default
+    return type(value)
+
+def _get_state_dir():
+    """Return the state folder, creating it if needed."""
+    user = os.environ.get('USER') or str(os.getuid())
+    state_dir = os.environ.get('FAKESCHED_DIR',
+                               os.path.join('/tmp', 'fakesched-%s' % user))
+    try:
+        os.makedirs(state_dir)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    return state_dir
+
+
+class FakeScheduler(object):
+    """Job store and job runner shared by the fake commands.
+
+    Must be used as a context manager, which holds the lock on the store and
+    brings job state up to date on entry, and stores it on exit.
+    """
+
+    def __init__(self, state_dir):
+        """Return a FakeScheduler using the given state folder.
+
+        Args:
+            state_dir (str): Folder containing jobs.json.
+        """
+        self.state_dir = state_dir
+        self.jobs_file = os.path.join(state_dir, 'jobs.json')
+        self.queue_wait = _get_setting('QUEUE_WAIT', 0.0)
+        self.max_running = _get_setting('MAX_RUNNING', 0, int)
+        self.fail_rate = _get_setting('FAIL_RATE', 0.0)
+        self.purge_age = _get_setting('PURGE_AGE', 3600.0)
+        self._lock_file = None
+        self.data = None
+
+    def __enter__(self):
+        self._lock_file = open(os.path.join(self.state_dir, '.lock'), 'a')
+        fcntl.flock(self._lock_file.fileno(), fcntl.LOCK_EX)
+        try:
+            with open(self.jobs_file) as f:
+                self.data = json.load(f)
+        except (IOError, ValueError):
+            self.data = {'next_job_num': 100, 'jobs': {}}
+        self.update()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if exc_type is None:
+                tmp_file = '%s.tmp' % self.jobs_file
+                with open(tmp_file, 'w') as f:
+                    json.dump(self.data, f)
+                os.rename(tmp_file, self.jobs_file)
+        finally:
+            fcntl.flock(self._lock_file.fileno(), fcntl.LOCK_UN)
+            self._lock_file.close()
+
+    def get_job(self, job_num):
+        """Return the job with the given number, or None if unknown."""
+        return self.data['jobs'].get(str(job_num))
+
+    def submit(self, script, cwd, flavor):
+        """Submit a batch script.
+
+        Args:
+            script (str): Path of the batch script.
+            cwd (str): Folder the job runs in.
+            flavor (str): 'slurm' or 'pbs', determining the directives read.
+
+        Returns:
+            Job number.
+        """
+        name, output, count = _parse_script(script, flavor)
+        job_num = self.data['next_job_num']
+        self.data['next_job_num'] += 1
+        now = time.time()
+        tasks = []
+        for index in range(count or 1):
+            tasks.append({
+                'index': index if count else None,
+                'state': 'PENDING',
+                'pid': None,
+                'exit_status': None,
+                'ended': None
+            })
+        self.data['jobs'][str(job_num)] = {
+            'job_num': job_num,
+            'name': name,
+            'flavor': flavor,
+            'script': os.path.abspath(script),
+            'cwd': os.path.abspath(cwd),
+            'output': output,
+            'array': bool(count),
+            'submitted': now,
+            'eligible': now + self.queue_wait,
+            'tasks': tasks
+        }
+        self.update()
+        return job_num
+
+    def cancel(self, job):
+        """Cancel all pending and running tasks of a job."""
+        for task in job['tasks']:
+            if task['state'] == 'RUNNING':
+                try:
+                    os.killpg(task['pid'], signal.SIGTERM)
+                except OSError:
+                    pass
+            if task['state'] in ('PENDING', 'RUNNING'):
+                task['state'] = 'CANCELLED'
+                task['ended'] = time.time()
+
+    def update(self):
+        """Detect finished tasks, start eligible pending tasks, and forget
+        jobs finished longer than the purge age ago.
+        """
+        now = time.time()
+        running = 0
+        pending = []
+        for key in sorted(self.data['jobs'].keys(), key=int):
+            job = self.data['jobs'][key]
+            for task in job['tasks']:
+                if task['state'] == 'RUNNING':
+                    self._update_task(job, task)
+                if task['state'] == 'RUNNING':
+                    running += 1
+                elif task['state'] == 'PENDING' and job['eligible'] <= now:
+                    pending.append((job, task))
+            ended = [task['ended'] for task in job['tasks']]
+            if None not in ended and now - max(ended) > self.purge_age:
+                self._remove_exit_files(job)
+                del self.data['jobs'][key]
+
+        for job, task in pending:
+            if self.max_running and running >= self.max_running:
+                break
+            if random.random() < self.fail_rate:
+                task['state'] = 'FAILED'
+                task['exit_status'] = 1
+                task['ended'] = now
+                continue
+            self._start_task(job, task)
+            running += 1
+
+    def _exit_file(self, job, task):
+        """Return the path of the file the exit status of a task goes to."""
+        if task['index'] is None:
+            name = '%d.exit' % job['job_num']
+        else:
+            name = '%d_%d.exit' % (job['job_num'], task['index'])
+        return os.path.join(self.state_dir, name)
+
+    def _remove_exit_files(self, job):
+        """Remove the exit status files of a job."""
+        for task in job['tasks']:
+            try:
+                os.remove(self._exit_file(job, task))
+            except OSError:
+                pass
+
+    def _update_task(self, job, task):
+        """Mark a running task finished if it has exited."""
+        try:
+            with open(self._exit_file(job, task)) as f:
+                task['exit_status'] = int(f.read())
+        except (IOError, ValueError):
+            try:
+                os.kill(task['pid'], 0)
+                return
+            except OSError as e:
+                if e.errno == errno.EPERM:
+                    return
+            # Killed before writing its exit status.
+            task['exit_status'] = -1
+        task['state'] = 'COMPLETED' if task['exit_status'] == 0 else 'FAILED'
+        task['ended'] = time.time()
+
+    def _start_task(self, job, task):
+        """Start a pending task, detached from the calling command."""
+        index = task['index']
+        env = os.environ.copy()
+        output = job['output']
+        job_id = str(job['job_num'])
+        if job['flavor'] == 'slurm':
+            env['SLURM_JOB_ID'] = job_id
+            env['SLURM_SUBMIT_DIR'] = job['cwd']
+            if index is not None:
+                env['SLURM_ARRAY_JOB_ID'] = job_id
+                env['SLURM_ARRAY_TASK_ID'] = str(index)
+                output = output.replace('%a', str(index))
+            output = output.replace('%j', job_id)
+        else:
+            env['PBS_JOBID'] = '%s.%s' % (job_id, _hostname)
+            env['PBS_O_WORKDIR'] = job['cwd']
+            if index is not None:
+                env['PBS_JOBID'] = '%s[%d].%s' % (job_id, index, _hostname)
+                env['PBS_ARRAY_INDEX'] = str(index)
+                output = output.replace('^array_index^', str(index))
+        output = os.path.join(job['cwd'], output)
+
+        command = '/bin/bash "$0" > "$1" 2>&1; echo $? > "$2"'
+        with open(os.devnull, 'r+') as devnull:
+            p = subprocess.Popen(['/bin/sh', '-c', command, job['script'],
+                                  output, self._exit_file(job, task)],
+                                 cwd=job['cwd'], env=env, stdin=devnull,
+                                 stdout=devnull, stderr=devnull,
+                                 close_fds=True, preexec_fn=os.setsid)
+        task['pid'] = p.pid
+        task['state'] = 'RUNNING'
+
+
+def _parse_script(script, flavor):
+    """Return the job name, output file, and number of array elements (0 if
+    not an array job) from the directives of a batch script.
+    """
+    name = os.path.basename(script)
+    output = 'slurm-%j.out' if flavor == 'slurm' else '%s.o' % name
+    count = 0
+    prefix = '#SBATCH' if flavor == 'slurm' else '#PBS'
+    with open(script) as f:
+        for line in f:
+            fields = line.split()
+            if len(fields) < 2 or fields[0] != prefix:
+                continue
+            option = fields[1]
+            value = fields[2] if len(fields) > 2 else ''
+            if option == '-o':
+                output = value
+            elif option in ('-J', '-N') and flavor == 'pbs':
+                if option == '-N':
+                    name = value
+                else:
+                    count = _parse_range(value)
+            elif option.startswith('--job-name='):
+                name = option.split('=', 1)[1].strip('"')
+            elif option.startswith('--array='):
+                count = _parse_range(option.split('=', 1)[1])
+    return (name, output, count)
+
+def _parse_range(spec):
+    """Return the number of elements of an array range given as 0-N."""
+    first, _, last = spec.split('%')[0].partition('-')
+    if int(first) != 0:
+        raise CommandError('Only array ranges starting at 0 are supported')
+    return int(last or first) + 1
+
+def _parse_job_list(spec):
+    """Return the job numbers in a comma-separated list of job ids."""
+    nums = []
+    for job_id in spec.split(','):
+        try:
+            nums.append(int(job_id.split('.')[0].split('[')[0].split('_')[0]))
+        except ValueError:
+            raise CommandError('Invalid job id specified')
+    return nums
+
+def _get_option(args, name, default=None):
+    """Return the value following an option in args, or default."""
+    if name in args:
+        i = args.index(name)
+        if i + 1 < len(args):
+            return args[i + 1]
+    return default
+
+def _slurm_array_state(job):
+    """Return the SLURM state of an array job as a whole."""
+    states = [task['state'] for task in job['tasks']]
+    for state in ('RUNNING', 'PENDING', 'FAILED', 'CANCELLED'):
+        if state in states:
+            return state
+    return 'COMPLETED'
+
+def _slurm_lines(job, expand):
+    """Return (job id, state) tuples listing a SLURM job.
+
+    Array elements are listed as NUM_INDEX, with pending elements not yet
+    split off listed together as NUM_[FIRST-LAST] unless expand is set.
+    """
+    job_num = job['job_num']
+    if not job['array']:
+        return [(str(job_num), job['tasks'][0]['state'])]
+    lines = []
+    pending = [task['index'] for task in job['tasks']
+               if task['state'] == 'PENDING']
+    for task in job['tasks']:
+        if task['state'] != 'PENDING' or expand:
+            lines.append(('%d_%d' % (job_num, task['index']), task['state']))
+    if pending and not expand:
+        lines.append(('%d_[%d-%d]' % (job_num, pending[0], pending[-1]),
+                      'PENDING'))
+    return lines
+
+def sbatch(sched, args):
+    if not args:
+        raise CommandError('sbatch: error: Batch script is empty!')
+    try:
+        job_num = sched.submit(args[-1], os.getcwd(), 'slurm')
+    except IOError:
+        raise CommandError('sbatch: error: Unable to open file %s' % args[-1])
+    return 'Submitted batch job %d\n' % job_num
+
+def scontrol(sched, args):
+    if args[:2] != ['show', 'job'] or len(args) < 3:
+        raise CommandError('scontrol: error: Unsupported command')
+    job = sched.get_job(_parse_job_list(args[2])[0])
+    if job is None or _aged_out(job):
+        raise CommandError('slurm_load_jobs error: Invalid job id specified')
+    state = (_slurm_array_state(job) if job['array']
+             else job['tasks'][0]['state'])
+    return ('JobId=%d JobName=%s\n'
+            '   UserId=%s GroupId=%s\n'
+            '   Priority=1 Nice=0 Account=(null) QOS=normal\n'
+            '   JobState=%s Reason=None Dependency=(null)\n'
+            '   WorkDir=%s\n'
+            % (job['job_num'], job['name'], os.environ.get('USER', 'root'),
+               os.environ.get('USER', 'root'), state, job['cwd']))
+
+def squeue(sched, args):
+    nums = _parse_job_list(_get_option(args, '-j', ''))
+    expand = '-r' in args
+    lines = []
+    for num in nums:
+        job = sched.get_job(num)
+        if job is None or _aged_out(job):
+            raise CommandError('slurm_load_jobs error: Invalid job id '
+                               'specified')
+        lines.extend(_slurm_lines(job, expand))
+    if '-h' not in args:
+        lines.insert(0, ('JOBID', 'STATE'))
+    return ''.join('%s %s\n' % line for line in lines)
+
+def sacct(sched, args):
+    nums = _parse_job_list(_get_option(args, '-j', ''))
+    lines = []
+    for num in nums:
+        job = sched.get_job(num)
+        if job is None:
+            continue
+        for job_id, state in _slurm_lines(job, True):
+            if state == 'CANCELLED':
+                state = 'CANCELLED by %d' % os.getuid()
+            lines.append((job_id, state))
+    return ''.join('%s|%s\n' % line for line in lines)
+
+def scancel(sched, args):
+    for num in _parse_job_list(args[-1] if args else ''):
+        job = sched.get_job(num)
+        if job is None:
+            raise CommandError('scancel: error: Kill job error on job id %d: '
+                               'Invalid job id specified' % num)
+        sched.cancel(job)
+    return ''
+
+def qsub(sched, args):
+    if not args:
+        raise CommandError('qsub: no script file specified', 2)
+    try:
+        job_num = sched.submit(args[-1], os.getcwd(), 'pbs')
+    except IOError:
+        raise CommandError('qsub: script file:: No such file or directory', 2)
+    job = sched.get_job(job_num)
+    return '%d%s.%s\n' % (job_num, '[]' if job['array'] else '', _hostname)
+
+_pbs_states = {'PENDING': 'Q', 'RUNNING': 'R', 'COMPLETED': 'X',
+               'FAILED': 'X', 'CANCELLED': 'X'}
+
+def _pbs_line(job_id, job, state):
+    """Return a line of qstat -i output."""
+    return ('%-15s %-8s %-8s %-10s %6s %3d %3d %6s %5s %s %5s\n'
+            % (job_id, os.environ.get('USER', 'root')[:8], 'workq',
+               job['name'][:10], '--', 1, 1, '--', '--', state, '--'))
+
+def qstat(sched, args):
+    job_ids = [arg for arg in args if not arg.startswith('-')]
+    lines = []
+    unknown = []
+    for job_id in job_ids:
+        num = _parse_job_list(job_id)[0]
+        job = sched.get_job(num)
+        # Finished jobs are no longer listed, as without qstat -x.
+        if job is None or _ended(job) != float('inf'):
+            unknown.append('qstat: Unknown Job Id %d.%s\n' % (num, _hostname))
+            continue
+        if not job['array']:
+            state = _pbs_states[job['tasks'][0]['state']]
+            lines.append(_pbs_line('%d.%s' % (num, _hostname), job, state))
+            continue
+        states = [task['state'] for task in job['tasks']]
+        lines.append(_pbs_line('%d[].%s' % (num, _hostname), job,
+                               'B' if 'RUNNING' in states else 'Q'))
+        if '-t' in args:
+            for task in job['tasks']:
+                lines.append(_pbs_line('%d[%d].%s' % (num, task['index'],
+                                                       _hostname),
+                                       job, _pbs_states[task['state']]))
+
+    output = ''
+    if lines:
+        output += ('%60s Req\'d  Req\'d   Elap\n' % ''
+                   + 'Job ID          Username Queue    Jobname    SessID NDS '
+                     'TSK Memory Time  S Time\n'
+                   + '--------------- -------- -------- ---------- ------ --- '
+                     '--- ------ ----- - -----\n'
+                   + ''.join(lines))
+    if unknown:
+        raise CommandError(''.join(unknown) + output, 153)
+    return output
+
+def qdel(sched, args):
+    for job_id in [arg for arg in args if not arg.startswith('-')]:
+        num = _parse_job_list(job_id)[0]
+        job = sched.get_job(num)
+        if job is None:
+            raise CommandError('qdel: Unknown Job Id %d.%s' % (num, _hostname),
+                               153)
+        sched.cancel(job)
+    return ''
+
+def _ended(job):
+    """Return when the last task of a job ended, or inf if some task has not
+    ended.
+    """
+    ended = [task['ended'] for task in job['tasks']]
+    if None in ended:
+        return float('inf')
+    return max(ended)
+
+def _aged_out(job):
+    """Return True if a job ended longer than the min job age ago, so that
+    squeue and scontrol no longer know it.
+    """
+    return time.time() - _ended(job) > _get_setting('MIN_JOB_AGE', 300.0)
+
+def main(argv):
+    command = os.path.basename(argv[0])
+    args = argv[1:]
+    if command in ('fakesched', 'fakesched.py') and args:
+        command = args.pop(0)
+    if command not in _slurm_commands + _pbs_commands:
+        sys.stderr.write('Usage: fakesched.py COMMAND [ARGS...]\n'
+                         'COMMAND is one of: %s\n'
+                         % ', '.join(_slurm_commands + _pbs_commands))
+        return 2
+
+    time.sleep(_get_setting('LATENCY', 0.0))
+    try:
+        if random.random() < _get_setting('CALL_FAIL_RATE', 0.0):
+            raise CommandError('%s: error: Unable to contact controller: '
+                               'Connection timed out' % command)
+        with FakeScheduler(_get_state_dir()) as sched:
+            output = globals()[command](sched, args)
+    except CommandError as e:
+        # The PCE reads stderr merged into stdout.
+        sys.stderr.write(str(e).rstrip('\n') + '\n')
+        return e.status
+    sys.stdout.write(output)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
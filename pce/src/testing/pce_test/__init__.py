@@ -9,6 +9,7 @@ Exports:
     JobsTest: Unit tests for the PCE jobs resource.
     ClusterTest: Unit tests for the PCE cluster resource.
 """
+import hashlib
 import json
 import os
 import requests
@@ -222,7 +223,7 @@ class ModulesTest(PCEBase):
         # Install some mods.
         for k in installed_mods.keys():
             r = pce_post('modules/', **installed_mods[k])
-            self.assertEqual(r.status_code, 200)
+            self.assertEqual(r.status_code, 202)
             d = r.json()
             self.check_json(d)
             self.assertEqual(d['status_code'], 0)
@@ -274,14 +275,14 @@ class ModulesTest(PCEBase):
         self.assertIsNotNone(expected_conf)
         r = pce_post('modules/', mod_id=10, mod_name='testmodule2_ui',
                      source_location=location)
-        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.status_code, 202)
         d = r.json()
         self.check_json(d)
         self.assertEqual(d['status_code'], 0)
         self.assertEqual(d['status_msg'], 'Checkout initiated')
         time.sleep(3)
         r = pce_post('modules/10/')
-        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.status_code, 202)
         d = r.json()
         self.check_json(d)
         time.sleep(4)
@@ -317,7 +318,7 @@ class ModulesTest(PCEBase):
         # Good post of new mod
         r = pce_post('modules/', mod_id=3, mod_name='template',
                      source_location=location)
-        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.status_code, 202)
         d = r.json()
         self.check_json(d)
         self.assertEqual(d['status_code'], 0)
@@ -326,7 +327,7 @@ class ModulesTest(PCEBase):
         # Good post of 2nd new mod
         r = pce_post('modules/', mod_id=4, mod_name='template',
                      source_location=location)
-        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.status_code, 202)
         d = r.json()
         self.check_json(d)
         self.assertEqual(d['status_code'], 0)
@@ -340,7 +341,7 @@ class ModulesTest(PCEBase):
         # Attempt to post with already existing id
         r = pce_post('modules/', mod_id=3, mod_name='template',
                      source_location=location)
-        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.status_code, 202)
         d = r.json()
         self.check_json(d)
         self.assertEqual(d['status_code'], 0)
@@ -350,7 +351,7 @@ class ModulesTest(PCEBase):
         # Attempt to post with already existing id, but different mod name
         r = pce_post('modules/', mod_id=3, mod_name='mpi-ring',
                      source_location=location)
-        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.status_code, 202)
         d = r.json()
         self.check_json(d)
         self.assertEqual(d['status_code'], 0)
@@ -369,7 +370,7 @@ class ModulesTest(PCEBase):
                             os.path.join(pce_root, '../modules/bad_path'))
         r = pce_post('modules/', mod_id=5, mod_name='template',
                      source_location=location)
-        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.status_code, 202)
         d = r.json()
         self.check_json(d)
         self.assertEqual(d['status_code'], 0)
@@ -390,7 +391,7 @@ class ModulesTest(PCEBase):
         location['path'] = template_path
         r = pce_post('modules/', mod_id=5, mod_name='template',
                      source_location=location)
-        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.status_code, 202)
         d = r.json()
         self.check_json(d)
         self.assertEqual(d['status_code'], 0)
@@ -400,7 +401,7 @@ class ModulesTest(PCEBase):
 
         # Attempt deploy that should work
         r = pce_post('modules/5/')
-        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.status_code, 202)
         d = r.json()
         self.check_json(d)
         self.assertEqual(d['status_code'], 0)
@@ -420,7 +421,7 @@ class ModulesTest(PCEBase):
 
         # Re-attempt deploy that already happened.
         r = pce_post('modules/5/')
-        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.status_code, 202)
         d = r.json()
         self.check_json(d)
         self.assertEqual(d['status_code'], 0)
@@ -588,24 +589,24 @@ class JobsTest(PCEBase):
         # Install and deploy test modules for use.
         r = pce_post('modules/', mod_id=1, mod_name='testmodule2',
                      source_location=good_mod_location)
-        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.status_code, 202)
         time.sleep(3)
         r = pce_post('modules/1/')
-        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.status_code, 202)
         time.sleep(3)
         r = pce_post('modules/', mod_id=2, mod_name='testmodulebadpreprocess',
                      source_location=bad_preprocess_location)
-        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.status_code, 202)
         time.sleep(3)
         r = pce_post('modules/2/')
-        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.status_code, 202)
         time.sleep(3)
         r = pce_post('modules/', mod_id=3, mod_name='testmodulebadpostprocess',
                      source_location=bad_postprocess_location)
-        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.status_code, 202)
         time.sleep(3)
         r = pce_post('modules/3/')
-        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.status_code, 202)
         time.sleep(3)
 
     def verify_launch(self, job_id, mod_id, username, run_name,
@@ -660,7 +661,7 @@ class JobsTest(PCEBase):
         # Launch a job
         r = pce_post('jobs/', mod_id=1, job_id=1, username='testuser',
                      run_name='testrun1')
-        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.status_code, 202)
         d = r.json()
         self.check_json(d)
         self.assertEqual(d['status_code'], 0)
@@ -691,7 +692,50 @@ class JobsTest(PCEBase):
         self.check_job(d['job'])
 
         r = pce_get('jobs/')
-        self.assertEqual(r.status_code, 404)
+        self.assertEqual(r.status_code, 200)
+        d = r.json()
+        self.check_json(d, good=True)
+        self.assertEqual(len(d['jobs']), 1)
+        self.check_job(d['jobs'][0])
+
+        r = pce_get('jobs/', state='Done', username='testuser')
+        self.assertEqual(r.status_code, 200)
+        d = r.json()
+        self.check_json(d, good=True)
+        self.assertEqual([job['job_id'] for job in d['jobs']], [1])
+
+        r = pce_get('jobs/', state='Running')
+        self.assertEqual(r.status_code, 200)
+        d = r.json()
+        self.check_json(d, good=True)
+        self.assertListEqual(d['jobs'], [])
+
+        r = pce_get('jobs/', since=0)
+        self.assertEqual(r.status_code, 200)
+        d = r.json()
+        self.check_json(d, good=True)
+        self.assertEqual(len(d['jobs']), 1)
+        self.check_job(d['jobs'][0])
+        self.assertListEqual(d['deleted'], [])
+        seq = d['seq']
+        self.assertGreater(seq, 0)
+
+        r = pce_get('jobs/', since=seq)
+        self.assertEqual(r.status_code, 200)
+        d = r.json()
+        self.check_json(d, good=True)
+        self.assertListEqual(d['jobs'], [])
+        self.assertListEqual(d['deleted'], [])
+        self.assertEqual(d['seq'], seq)
+
+        r = pce_get('jobs/', since='abc')
+        self.assertEqual(r.status_code, 400)
+
+        r = pce_get('jobs/abc/')
+        self.assertEqual(r.status_code, 400)
+        d = r.json()
+        self.check_json(d)
+        self.assertEqual(d['status_code'], -8)
 
         r = pce_get('jobs/45/99/')
         self.assertEqual(r.status_code, 404)
@@ -710,7 +754,7 @@ class JobsTest(PCEBase):
         # Good post to jobs/
         r = pce_post('jobs/', mod_id=1, job_id=1, username='testuser',
                      run_name='testrun1')
-        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.status_code, 202)
         d = r.json()
         self.check_json(d)
         self.assertEqual(d['status_code'], 0)
@@ -719,7 +763,7 @@ class JobsTest(PCEBase):
         # Second good post to jobs/
         r = pce_post('jobs/', mod_id=1, job_id=2, username='testuser',
                      run_name='testrun2')
-        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.status_code, 202)
         d = r.json()
         self.check_json(d)
         self.assertEqual(d['status_code'], 0)
@@ -737,7 +781,7 @@ class JobsTest(PCEBase):
         time.sleep(5)
         r = pce_post('jobs/', mod_id=1, job_id=1, username='testuser',
                      run_name='testrun1')
-        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.status_code, 202)
         d = r.json()
         self.check_json(d)
         self.assertEqual(d['status_code'], 0)
@@ -822,7 +866,7 @@ class JobsTest(PCEBase):
         # Check output from module with preprocess error.
         r = pce_post('jobs/', mod_id=2, job_id=3, username='testuser',
                      run_name='testrunbadpreprocess')
-        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.status_code, 202)
         d = r.json()
         self.check_json(d)
         self.assertEqual(d['status_code'], 0)
@@ -841,7 +885,7 @@ class JobsTest(PCEBase):
         # Check output from module with postprocess error.
         r = pce_post('jobs/', mod_id=3, job_id=4, username='testuser',
                      run_name='testrunbadpostprocess')
-        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.status_code, 202)
         d = r.json()
         self.check_json(d)
         self.assertEqual(d['status_code'], 0)
@@ -871,7 +915,7 @@ class JobsTest(PCEBase):
         params = {'np': '4', 'nodes': '4', 'onramp':{}, 'hello':{'name': 'testname'}}
         r = pce_post('jobs/', mod_id=1, job_id=5, username='testuser',
                      run_name='testruncfgparams', cfg_params=params)
-        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.status_code, 202)
         d = r.json()
         self.check_json(d)
         self.assertEqual(d['status_code'], 0)
@@ -884,6 +928,30 @@ class JobsTest(PCEBase):
         conf = ConfigObj(os.path.join(run_dir, 'onramp_runparams.cfg'))
         self.assertEqual(conf, params)
 
+        # Check handling of sweep
+        sweep = {'hello': {'name': ['name1', 'name2']}}
+        r = pce_post('jobs/', mod_id=1, job_id=6, username='testuser',
+                     run_name='testrunsweep', cfg_params=params, sweep=sweep)
+        self.assertEqual(r.status_code, 202)
+        time.sleep(5)
+        folders = ('testuser', 'testmodule2_1', 'testrunsweep')
+        run_dir = os.path.join(pce_root, 'users/%s/%s/%s' % folders)
+        for index, name in enumerate(['name1', 'name2']):
+            conf = ConfigObj(os.path.join(run_dir, str(index),
+                                          'onramp_runparams.cfg'))
+            self.assertEqual(conf['hello']['name'], name)
+        r = pce_get('jobs/6/')
+        d = r.json()
+        self.assertEqual([element['params'] for element in d['job']['array']],
+                         [{'hello.name': 'name1'}, {'hello.name': 'name2'}])
+
+        # Sweep giving a single run
+        r = pce_post('jobs/', mod_id=1, job_id=7, username='testuser',
+                     run_name='testrunsweep1', cfg_params=params,
+                     sweep={'hello': {'name': ['name1']}})
+        self.assertEqual(r.status_code, 400)
+        self.assertEqual(r.json()['status_code'], -8)
+
     def test_PUT(self):
         r = pce_put('jobs/')
         self.assertEqual(r.status_code, 404)
@@ -1247,9 +1315,10 @@ class ModuleJobFlowTest(PCEBase):
         d = job_running_response.json()
         self.check_json(d, good=True)
         self.assertIn('job', d.keys())
-        output = 'Output to stderrOutput from bin/onramp_status.py\n'
+        # bin/onramp_status.py is started in the background by this request,
+        # so its output is not available yet.
         self.check_job(d['job'], state='Running', check_scheduler_job_num=True,
-                       error=None, mod_status_output=output)
+                       error=None, mod_status_output=None)
 
         print '---------------------------------'
         print 'job_still_running_response.text:'
@@ -1293,8 +1362,22 @@ class ModuleJobFlowTest(PCEBase):
                   'will result in deterministic output!Hello, this will result '
                   'in deterministic output!Hello, this will result in '
                   'deterministic output!')
+        # Output is referenced by the job and served by jobs/:id/output.
         self.check_job(d['job'], state='Done',
-                       check_scheduler_job_num=True, error=None, output=output)
+                       check_scheduler_job_num=True, error=None)
+        output_file = d['job']['output_file']
+        self.assertEqual(output_file['name'], 'output.txt')
+        self.assertEqual(output_file['size'], len(output))
+        self.assertEqual(output_file['sha256'],
+                         hashlib.sha256(output).hexdigest())
+        self.assertEqual(output_file['url'], 'jobs/1/output')
+        r = pce_get('jobs/1/output')
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.text, output)
+        r = requests.get(pce_url('jobs/1/output'),
+                         headers={'Range': 'bytes=7-10'})
+        self.assertEqual(r.status_code, 206)
+        self.assertEqual(r.text, output[7:11])
         self.assertIn('visible_files', d['job'].keys())
         visible_files = d['job']['visible_files']
         self.assertEqual(len(visible_files), 3)
@@ -1315,7 +1398,21 @@ class ModuleJobFlowTest(PCEBase):
         fname = os.path.join(pce_root,
                              'users/testuser/testmodule_1/testrun1/output.txt')
         with open(fname) as f:
-            self.assertEqual(r.text, f.read())
+            contents = f.read()
+            self.assertEqual(r.text, contents)
+
+        # Paged access.
+        lines = contents.splitlines(True)
+        r = pce_get('files/testuser/testmodule_1/testrun1/output.txt',
+                    lines='1-1')
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.text, lines[0])
+        self.assertEqual(r.headers['X-Total-Lines'], str(len(lines)))
+        r = pce_get('jobs/1/output', tail=1)
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.text, lines[-1])
+        r = pce_get('jobs/1/output', lines='2-1')
+        self.assertEqual(r.status_code, 400)
 
         r = pce_get('files/testuser/testmodule_1/testrun1/onramp_runparams.cfg')
         self.assertEqual(r.status_code, 403)
@@ -1381,7 +1478,7 @@ class ModuleJobFlowTest(PCEBase):
 
         def deploy():
             r = pce_post('modules/1/')
-            self.assertEqual(r.status_code, 200)
+            self.assertEqual(r.status_code, 202)
             r = pce_get('modules/1/')
             self.assertEqual(r.status_code, 200)
             d = r.json()
@@ -1487,7 +1584,7 @@ class ModuleJobFlowTest(PCEBase):
 
         def deploy():
             r = pce_post('modules/1/')
-            self.assertEqual(r.status_code, 200)
+            self.assertEqual(r.status_code, 202)
             r = pce_get('modules/1/')
             self.assertEqual(r.status_code, 200)
             d = r.json()
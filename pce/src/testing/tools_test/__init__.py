@@ -0,0 +1,927 @@
+"""Unit testing for PCE modules that can be tested without a running PCE
+server.
+"""
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+import cherrypy
+from cherrypy._cprequest import Request, Response
+from cherrypy.lib.httputil import Host
+
+from PCE import dispatchers
+from PCE.tools import hooks, locks, rundirs, schedulers, state, trash, \
+                      workqueue
+from PCE.tools.buildcache import BuildCache, get_build_spec
+from PCE.tools.hooks import HookTimeout, add_usage, run_command, run_hook
+from PCE.tools.lineindex import LineIndex, read_lines, read_tail
+from PCE.tools.locks import LockTimeout, StateLock, get_lock_stats, is_locked
+from PCE.tools.rundirs import get_mutable_globs, materialize_run_dir, \
+                              share_file
+from PCE.tools.schedulers import PBSScheduler, SLURMScheduler
+from PCE.tools.state import ChangeNotifier, JSONStateBackend, StateCache, \
+                            load_state_file, store_state, store_state_file
+from PCE.tools.trash import reap_trash, trash_tree
+from PCE.tools.workqueue import QueueFull, WorkQueue
+
+
+class ToolsBase(unittest.TestCase):
+    """Give each test a scratch dir, removed after the test."""
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp(prefix='onramp_tools_test_')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+    def path(self, *names):
+        return os.path.join(self.tmp_dir, *names)
+
+    def write(self, filename, data, mode='w'):
+        with open(filename, mode) as f:
+            f.write(data)
+
+    def wait_for(self, cond, timeout=5):
+        """Wait for cond() to return True, failing after timeout seconds."""
+        deadline = time.time() + timeout
+        while not cond():
+            if time.time() > deadline:
+                self.fail('Timed out waiting for %s' % cond.__name__)
+            time.sleep(.01)
+
+
+class LineIndexTest(ToolsBase):
+
+    def setUp(self):
+        ToolsBase.setUp(self)
+        self.filename = self.path('output.txt')
+
+    def test_empty_file(self):
+        self.write(self.filename, '')
+        self.assertEqual(read_lines(self.filename, 1, 10), ('', 0))
+        self.assertEqual(read_tail(self.filename, 10), ('', 0))
+
+    def test_read_lines(self):
+        self.write(self.filename, 'one\ntwo\nthree\n')
+        self.assertEqual(read_lines(self.filename, 1, 1), ('one\n', 3))
+        self.assertEqual(read_lines(self.filename, 2, 3), ('two\nthree\n', 3))
+        self.assertEqual(read_lines(self.filename, 2, 100), ('two\nthree\n', 3))
+        self.assertEqual(read_lines(self.filename, 4, 10), ('', 3))
+        self.assertEqual(read_tail(self.filename, 2), ('two\nthree\n', 3))
+        self.assertEqual(read_tail(self.filename, 10),
+                         ('one\ntwo\nthree\n', 3))
+
+    def test_no_trailing_newline(self):
+        self.write(self.filename, 'one\ntwo')
+        self.assertEqual(read_lines(self.filename, 2, 2), ('two', 2))
+        self.assertEqual(read_tail(self.filename, 1), ('two', 2))
+
+    def test_growth(self):
+        index = LineIndex(self.filename)
+        self.write(self.filename, 'one\ntw')
+        with index.lock:
+            size = index.update()
+            self.assertEqual(index.count(size), 2)
+            self.assertEqual(index.read(2, 2), 'tw')
+
+        # Completing the partial final line and adding more only scans the
+        # new data.
+        self.write(self.filename, 'o\nthree\n', mode='a')
+        with index.lock:
+            size = index.update()
+            self.assertEqual(index._scanned, size)
+            self.assertEqual(index.count(size), 3)
+            self.assertEqual(index.read(1, 3), 'one\ntwo\nthree\n')
+            self.assertEqual(list(index._offsets), [0, 4, 8, 14])
+
+        # No change: update() does not rescan.
+        with index.lock:
+            self.assertEqual(index.update(), size)
+            self.assertEqual(index.count(size), 3)
+
+    def test_truncation(self):
+        index = LineIndex(self.filename)
+        self.write(self.filename, 'one\ntwo\nthree\n')
+        with index.lock:
+            index.update()
+        self.write(self.filename, 'four\n')
+        with index.lock:
+            size = index.update()
+            self.assertEqual(index.count(size), 1)
+            self.assertEqual(index.read(1, 10), 'four\n')
+
+        self.write(self.filename, '')
+        with index.lock:
+            size = index.update()
+            self.assertEqual(index.count(size), 0)
+            self.assertEqual(index.read(1, 10), '')
+
+    def test_replaced_file(self):
+        index = LineIndex(self.filename)
+        self.write(self.filename, 'one\ntwo\n')
+        with index.lock:
+            index.update()
+
+        # A new file at least as long as the old one is only detected by its
+        # inode.
+        other = self.path('other.txt')
+        self.write(other, 'three\nfour\nfive\n')
+        os.rename(other, self.filename)
+        with index.lock:
+            size = index.update()
+            self.assertEqual(index.count(size), 3)
+            self.assertEqual(index.read(1, 1), 'three\n')
+            self.assertEqual(index.read(3, 3), 'five\n')
+
+
+class StateLockTest(ToolsBase):
+
+    def setUp(self):
+        ToolsBase.setUp(self)
+        self.lock_filename = self.path('.1.lock')
+        self.sleep = locks.time.sleep
+        self.sleeps = []
+
+    def tearDown(self):
+        locks.time.sleep = self.sleep
+        ToolsBase.tearDown(self)
+
+    def record_sleeps(self):
+        """Record the sleeps of lock waits."""
+        def sleep(secs):
+            self.sleeps.append(secs)
+            self.sleep(secs)
+        locks.time.sleep = sleep
+
+    def test_acquire_release(self):
+        self.assertFalse(is_locked(self.lock_filename))
+        with StateLock(self.lock_filename) as lock:
+            self.assertTrue(os.path.exists(self.lock_filename))
+            self.assertTrue(is_locked(self.lock_filename))
+            self.assertIsNotNone(lock._fd)
+        self.assertIsNone(lock._fd)
+        self.assertFalse(is_locked(self.lock_filename))
+        # The lock file is kept.
+        self.assertTrue(os.path.exists(self.lock_filename))
+        # Releasing an unheld lock does nothing.
+        lock.release()
+
+    def test_shared(self):
+        with StateLock(self.lock_filename, shared=True):
+            with StateLock(self.lock_filename, shared=True, timeout=0):
+                self.assertFalse(is_locked(self.lock_filename))
+            self.assertRaises(LockTimeout, StateLock(self.lock_filename,
+                                                     timeout=0).acquire)
+
+    def test_timeout(self):
+        self.record_sleeps()
+        before = get_lock_stats()
+        with StateLock(self.lock_filename):
+            start = time.time()
+            lock = StateLock(self.lock_filename, timeout=.2)
+            self.assertRaises(LockTimeout, lock.acquire)
+            waited = time.time() - start
+        self.assertTrue(.2 <= waited < 1, waited)
+        self.assertIsNone(lock._fd)
+        after = get_lock_stats()
+        self.assertEqual(after['timeouts'], before['timeouts'] + 1)
+        self.assertEqual(after['acquired'], before['acquired'] + 1)
+        self.assertTrue(after['wait_max'] >= .2)
+
+        # Sleeps back off exponentially from _min_backoff to _max_backoff,
+        # and the last is cut short at the deadline.
+        self.assertEqual(self.sleeps[0], locks._min_backoff)
+        for prev, secs in zip(self.sleeps, self.sleeps[1:-1]):
+            self.assertEqual(secs, min(prev * 2, locks._max_backoff))
+        self.assertEqual(max(self.sleeps), locks._max_backoff)
+        self.assertTrue(self.sleeps[-1] <= locks._max_backoff)
+
+    def test_wait(self):
+        self.record_sleeps()
+        before = get_lock_stats()
+        holder = StateLock(self.lock_filename)
+        holder.acquire()
+        timer = threading.Timer(.1, holder.release)
+        timer.start()
+        try:
+            with StateLock(self.lock_filename, timeout=5):
+                self.assertTrue(is_locked(self.lock_filename))
+        finally:
+            timer.cancel()
+            holder.release()
+        self.assertTrue(self.sleeps)
+        after = get_lock_stats()
+        self.assertEqual(after['contended'], before['contended'] + 1)
+        self.assertEqual(after['timeouts'], before['timeouts'])
+
+    def test_wait_indefinitely(self):
+        before = get_lock_stats()
+        holder = StateLock(self.lock_filename)
+        holder.acquire()
+        timer = threading.Timer(.1, holder.release)
+        timer.start()
+        try:
+            with StateLock(self.lock_filename):
+                pass
+        finally:
+            timer.cancel()
+            holder.release()
+        after = get_lock_stats()
+        self.assertEqual(after['contended'], before['contended'] + 1)
+        self.assertTrue(after['wait_total'] - before['wait_total'] >= .05)
+
+
+class WorkQueueTest(ToolsBase):
+    """Tests run PCE.tools.state.store_state_file as the task, as a PCE
+    function with JSON-serializable args and a visible result.
+    """
+
+    def setUp(self):
+        ToolsBase.setUp(self)
+        self.queue_dir = self.path('queue')
+        self.queue = WorkQueue(max_workers=2, max_queue=2,
+                               queue_dir=self.queue_dir)
+        self.poll_interval = workqueue._adopt_poll_interval
+        workqueue._adopt_poll_interval = .01
+
+    def tearDown(self):
+        self.queue.stop(timeout=1)
+        workqueue._adopt_poll_interval = self.poll_interval
+        ToolsBase.tearDown(self)
+
+    def queue_files(self):
+        return sorted(os.listdir(self.queue_dir))
+
+    def store_running(self, seq, args, proc=None, **kwargs):
+        """Store a task as left running by an earlier start(), in the given
+        subprocess.Popen if any.
+        """
+        task = {
+            'module': 'PCE.tools.state',
+            'function': 'store_state_file',
+            'interrupt_function': 'store_state_file',
+            'args': args
+        }
+        if proc is not None:
+            task['pid'] = proc.pid
+            task['start_time'] = workqueue._get_start_time(proc.pid)
+        task.update(kwargs)
+        store_state_file(os.path.join(self.queue_dir, '%012d.running' % seq),
+                         task)
+
+    def test_run(self):
+        out = self.path('out.json')
+        self.queue.start()
+        self.assertEqual(self.queue.submit(store_state_file,
+                                           (out, {'a': 1})), 0)
+        def done():
+            return self.queue.get_stats()['completed'] == 1
+        self.wait_for(done)
+        self.assertEqual(load_state_file(out), {'a': 1})
+        self.assertEqual(self.queue_files(), [])
+
+    def test_queue_full(self):
+        outs = [self.path('out%d.json' % i) for i in range(3)]
+        self.assertEqual(self.queue.submit(store_state_file, (outs[0], {})), 0)
+        self.assertEqual(self.queue.submit(store_state_file, (outs[1], {})), 1)
+        self.assertRaises(QueueFull, self.queue.submit, store_state_file,
+                          (outs[2], {}))
+        self.assertEqual(self.queue.get_stats()['rejected'], 1)
+        self.assertEqual(self.queue_files(),
+                         ['000000000001.task', '000000000002.task'])
+
+        # Stored tasks are run by a new queue over the same dir.
+        queue = WorkQueue(max_workers=1, queue_dir=self.queue_dir)
+        queue.start()
+        try:
+            self.wait_for(lambda: os.path.exists(outs[1]))
+        finally:
+            queue.stop(timeout=1)
+        self.assertTrue(os.path.exists(outs[0]))
+        self.assertFalse(os.path.exists(outs[2]))
+
+    def test_non_pce_task(self):
+        self.queue.start()
+        self.queue.submit(json.dump, ({}, self.path('out.json')))
+        self.wait_for(lambda: self.queue.get_stats()['completed'] == 1)
+        self.assertEqual(self.queue_files(), [])
+
+    def test_unstarted_task(self):
+        out = self.path('out.json')
+        self.store_running(1, [out, {'run': True}])
+        self.queue.start()
+        self.wait_for(lambda: os.path.exists(out))
+        self.assertEqual(load_state_file(out), {'run': True})
+
+    def test_interrupted_task(self):
+        # A pid no process can have.
+        out = self.path('out.json')
+        self.store_running(1, [out, {'run': True}], pid=2 ** 22 + 1)
+        self.queue.start()
+        # The interrupt function is called with the task's args, in place of
+        # the task.
+        self.assertEqual(load_state_file(out), {'run': True})
+        self.assertEqual(self.queue_files(), [])
+        self.assertEqual(self.queue.get_stats()['completed'], 0)
+
+        os.remove(out)
+        self.store_running(2, [out, {}], pid=2 ** 22 + 1,
+                           interrupt_function=None)
+        self.queue.stop()
+        self.queue.start()
+        self.assertFalse(os.path.exists(out))
+        self.assertEqual(self.queue_files(), [])
+
+    def test_adopted_task(self):
+        out = self.path('out.json')
+        proc = subprocess.Popen(['sleep', '.3'])
+        self.store_running(1, [out, {}], proc=proc)
+        self.queue.start()
+        self.assertEqual(self.queue.get_stats()['running'], 1)
+        proc.wait()
+        self.wait_for(lambda: not self.queue_files())
+        # The task is neither run again nor reported interrupted.
+        self.assertFalse(os.path.exists(out))
+
+    def test_reused_pid(self):
+        # A process given the pid of a task's process after it died, as after
+        # a reboot, differs in start time, and the task was interrupted.
+        out = self.path('out.json')
+        start_time = workqueue._get_start_time(os.getpid())
+        self.store_running(1, [out, {'run': True}], pid=os.getpid(),
+                           start_time=start_time - 1)
+        self.store_running(2, [out, {}], pid=os.getpid())
+        self.queue.start()
+        self.assertEqual(self.queue.get_stats()['running'], 0)
+        self.assertEqual(self.queue_files(), [])
+        self.assertTrue(os.path.exists(out))
+
+    def test_get_start_time(self):
+        proc = subprocess.Popen(['sleep', '.3'])
+        start_time = workqueue._get_start_time(proc.pid)
+        self.assertTrue(start_time >= workqueue._get_start_time(os.getpid()))
+        self.assertEqual(workqueue._get_start_time(proc.pid), start_time)
+        proc.wait()
+        self.assertIsNone(workqueue._get_start_time(proc.pid))
+        self.assertIsNone(workqueue._get_start_time(2 ** 22 + 1))
+
+    def test_fork_with_held_locks(self):
+        # Tasks fork while other threads of the service may hold the locks
+        # of the state cache, change notifier, and lock stats. The task must
+        # not wait on their copies, which are never released in the child.
+        saved = (state._backend, state._cache, state._notifier)
+        backend = JSONStateBackend('json', state_dir=self.path('state'))
+        os.makedirs(self.path('state', 'jobs'))
+        state._backend = backend
+        state._cache = StateCache(backend)
+        state._notifier = ChangeNotifier(backend)
+        held = threading.Event()
+        release = threading.Event()
+        def hold():
+            with state._cache._lock:
+                with state._notifier._cond:
+                    with locks._stats_lock:
+                        held.set()
+                        release.wait()
+        holder = threading.Thread(target=hold)
+        holder.start()
+        try:
+            held.wait()
+            self.queue.start()
+            self.queue.submit(store_state, ('jobs', 1, {'state': 'Done'}))
+            def done():
+                return self.queue.get_stats()['completed'] == 1
+            try:
+                self.wait_for(done)
+            except AssertionError:
+                # Kill the deadlocked task.
+                task = load_state_file(os.path.join(self.queue_dir,
+                                                    self.queue_files()[0]))
+                os.kill(task['pid'], 9)
+                raise
+        finally:
+            release.set()
+            holder.join()
+            state._backend, state._cache, state._notifier = saved
+        self.assertEqual(backend.load('jobs', 1)['state'], 'Done')
+
+    def test_bounded_stop(self):
+        # A task process that outlives stop() is left running, and adopted
+        # by the next start().
+        proc = subprocess.Popen(['sleep', '1'])
+        self.store_running(1, [self.path('out.json'), {}], proc=proc)
+        self.queue.start()
+        start = time.time()
+        self.queue.stop(timeout=.1)
+        self.assertTrue(time.time() - start < .5)
+        self.assertIsNone(proc.poll())
+        self.assertEqual(self.queue_files(), ['000000000001.running'])
+
+        self.queue.start()
+        self.assertEqual(self.queue.get_stats()['running'], 1)
+        proc.wait()
+        self.wait_for(lambda: not self.queue_files())
+
+
+class TrashTest(ToolsBase):
+
+    def setUp(self):
+        ToolsBase.setUp(self)
+        self.trash_dir = self.path('trash')
+        self.cfg = {'cluster': {'trash_reap_interval': 60}}
+        self.get_pce_config = trash.get_pce_config
+        trash.get_pce_config = lambda: self.cfg
+        self.sleep = trash.time.sleep
+        self.sleeps = []
+        trash.time.sleep = self.sleeps.append
+
+    def tearDown(self):
+        trash.get_pce_config = self.get_pce_config
+        trash.time.sleep = self.sleep
+        ToolsBase.tearDown(self)
+
+    def make_tree(self, name, num_files):
+        """Make a folder tree holding num_files files and a symlink."""
+        root = self.path(name)
+        os.makedirs(os.path.join(root, 'sub', 'subsub'))
+        os.symlink('sub', os.path.join(root, 'link'))
+        for i in range(num_files - 1):
+            dir = os.path.join(root, ['', 'sub', 'sub/subsub'][i % 3])
+            self.write(os.path.join(dir, 'file%d' % i), 'data')
+        return root
+
+    def test_trash_tree(self):
+        root = self.make_tree('run', 4)
+        self.assertTrue(trash_tree(root, trash_dir=self.trash_dir))
+        self.assertFalse(os.path.exists(root))
+        self.assertEqual(len(os.listdir(self.trash_dir)), 1)
+        self.assertFalse(trash_tree(root, trash_dir=self.trash_dir))
+
+        self.assertEqual(reap_trash(rate=0, trash_dir=self.trash_dir), (1, 4))
+        self.assertEqual(os.listdir(self.trash_dir), [])
+        self.assertEqual(self.sleeps, [])
+
+    def test_trash_disabled(self):
+        self.cfg['cluster']['trash_reap_interval'] = 0
+        root = self.make_tree('run', 4)
+        self.assertTrue(trash_tree(root, trash_dir=self.trash_dir))
+        self.assertFalse(os.path.exists(root))
+        self.assertFalse(os.path.exists(self.trash_dir))
+
+    def test_reap_pacing(self):
+        trash_tree(self.make_tree('run1', 15), trash_dir=self.trash_dir)
+        trash_tree(self.make_tree('run2', 10), trash_dir=self.trash_dir)
+        self.assertEqual(reap_trash(rate=10, trash_dir=self.trash_dir),
+                         (2, 25))
+        # Removals are paced across trees, sleeping out the rest of each
+        # second in which rate files were removed.
+        self.assertEqual(len(self.sleeps), 2)
+        for secs in self.sleeps:
+            self.assertTrue(0 < secs <= 1.0, secs)
+        self.assertEqual(os.listdir(self.trash_dir), [])
+
+    def test_reap_empty(self):
+        self.assertEqual(reap_trash(rate=10, trash_dir=self.trash_dir),
+                         (0, 0))
+
+
+class BuildCacheTest(ToolsBase):
+
+    def setUp(self):
+        ToolsBase.setUp(self)
+        self.cache = BuildCache(cache_dir=self.path('cache'), max_entries=2)
+        self.run_dir = self.path('run')
+        os.makedirs(os.path.join(self.run_dir, 'config'))
+        os.makedirs(os.path.join(self.run_dir, 'src'))
+        self.write(os.path.join(self.run_dir, 'config/onramp_metadata.cfg'),
+                   '[onramp]\n'
+                   '[[build_cache]]\n'
+                   'inputs = src/*.c, src/Makefile\n'
+                   'outputs = src/ring\n'
+                   'runparams = ring.iters\n')
+        self.write(os.path.join(self.run_dir, 'src/ring.c'), 'int main;')
+        self.write(os.path.join(self.run_dir, 'src/Makefile'), 'ring:')
+        self.set_iters(10)
+        self.spec = get_build_spec(self.run_dir)
+
+    def set_iters(self, iters):
+        self.write(os.path.join(self.run_dir, 'onramp_runparams.cfg'),
+                   '[ring]\niters = %d\n' % iters)
+
+    def build(self, output):
+        self.write(os.path.join(self.run_dir, 'src/ring'), output)
+        return self.cache.store(self.run_dir, self.spec,
+                                self.cache.get_key(self.run_dir, self.spec))
+
+    def entries(self):
+        return sorted(name for name in os.listdir(self.cache.cache_dir)
+                      if not name.startswith('.'))
+
+    def test_get_build_spec(self):
+        self.assertEqual(self.spec, {
+            'inputs': ['src/*.c', 'src/Makefile'],
+            'outputs': ['src/ring'],
+            'runparams': ['ring.iters']
+        })
+        os.remove(os.path.join(self.run_dir, 'config/onramp_metadata.cfg'))
+        self.assertIsNone(get_build_spec(self.run_dir))
+
+    def test_get_key(self):
+        key = self.cache.get_key(self.run_dir, self.spec)
+        self.assertEqual(self.cache.get_key(self.run_dir, self.spec), key)
+        # Files not listed as inputs do not change the key.
+        self.write(os.path.join(self.run_dir, 'src/README'), 'notes')
+        self.assertEqual(self.cache.get_key(self.run_dir, self.spec), key)
+
+        self.set_iters(20)
+        iters_key = self.cache.get_key(self.run_dir, self.spec)
+        self.assertNotEqual(iters_key, key)
+        self.write(os.path.join(self.run_dir, 'src/ring.c'), 'int main();')
+        self.assertNotEqual(self.cache.get_key(self.run_dir, self.spec),
+                            iters_key)
+
+    def test_store_restore(self):
+        key = self.cache.get_key(self.run_dir, self.spec)
+        self.assertFalse(self.cache.restore(self.run_dir, key))
+        output = os.path.join(self.run_dir, 'src/ring')
+        self.write(output, 'binary')
+        os.utime(output, (1000000000, 1000000000))
+        self.assertEqual(self.cache.store(self.run_dir, self.spec, key), 1)
+        # Stored only once.
+        self.assertEqual(self.cache.store(self.run_dir, self.spec, key), 0)
+
+        os.remove(output)
+        self.assertTrue(self.cache.restore(self.run_dir, key))
+        with open(output) as f:
+            self.assertEqual(f.read(), 'binary')
+        self.assertEqual(os.stat(output).st_mtime, 1000000000)
+
+        # A rebuild in the run folder does not change the entry.
+        self.write(output, 'rebuilt')
+        os.remove(output)
+        self.cache.restore(self.run_dir, key)
+        with open(output) as f:
+            self.assertEqual(f.read(), 'binary')
+
+    def test_prune(self):
+        keys = []
+        for iters in range(3):
+            self.set_iters(iters)
+            keys.append(self.cache.get_key(self.run_dir, self.spec))
+            self.assertEqual(self.build('binary%d' % iters), 1)
+            # Entries were used in the order stored.
+            os.utime(os.path.join(self.cache.cache_dir, keys[-1]),
+                     (1000000000 + iters, 1000000000 + iters))
+        # Storing the third entry removed the first.
+        self.assertEqual(self.entries(), sorted(keys[1:]))
+
+        # Restoring marks an entry as recently used, so it outlives entries
+        # stored after it.
+        self.assertTrue(self.cache.restore(self.run_dir, keys[1]))
+        self.set_iters(3)
+        self.build('binary3')
+        self.assertEqual(self.entries(),
+                         sorted([keys[1],
+                                 self.cache.get_key(self.run_dir,
+                                                    self.spec)]))
+
+
+class RunDirsTest(ToolsBase):
+
+    def setUp(self):
+        ToolsBase.setUp(self)
+        self.reflink = rundirs._reflink
+        self.hardlink = rundirs._hardlink
+        self.mod_dir = self.path('mod')
+        self.run_dir = self.path('run')
+        for dir in ['bin', 'config', 'src', 'log']:
+            os.makedirs(os.path.join(self.mod_dir, dir))
+        self.write(os.path.join(self.mod_dir, 'config/onramp_metadata.cfg'),
+                   '[onramp]\nmutable = src/*.dat\n')
+        self.write(os.path.join(self.mod_dir, 'bin/onramp_run.py'), 'run')
+        self.write(os.path.join(self.mod_dir, 'src/ring.c'), 'int main;')
+        self.write(os.path.join(self.mod_dir, 'src/input.dat'), '1 2 3')
+        self.write(os.path.join(self.mod_dir, 'log/deploy.log'), 'deployed')
+        os.symlink('ring.c', os.path.join(self.mod_dir, 'src/link.c'))
+
+    def tearDown(self):
+        rundirs._reflink = self.reflink
+        rundirs._hardlink = self.hardlink
+        ToolsBase.tearDown(self)
+
+    def no_reflinks(self):
+        """Fail reflinks, as on a filesystem without them."""
+        rundirs._reflink = lambda src, dst: False
+
+    def no_hardlinks(self):
+        """Fail hardlinks, as across filesystems."""
+        rundirs._hardlink = lambda src, dst: False
+
+    def materialize(self, link_mode):
+        return materialize_run_dir(self.mod_dir, self.run_dir,
+                                   mutable=get_mutable_globs(self.mod_dir),
+                                   link_mode=link_mode)
+
+    def is_hardlinked(self, rel):
+        return (os.stat(os.path.join(self.mod_dir, rel)).st_ino
+                == os.stat(os.path.join(self.run_dir, rel)).st_ino)
+
+    def check_contents(self):
+        for rel in ['bin/onramp_run.py', 'src/ring.c', 'src/input.dat',
+                    'log/deploy.log', 'config/onramp_metadata.cfg']:
+            with open(os.path.join(self.run_dir, rel)) as f:
+                with open(os.path.join(self.mod_dir, rel)) as g:
+                    self.assertEqual(f.read(), g.read())
+        self.assertEqual(os.readlink(os.path.join(self.run_dir, 'src/link.c')),
+                         'ring.c')
+
+    def test_get_mutable_globs(self):
+        self.assertEqual(get_mutable_globs(self.mod_dir), ['src/*.dat'])
+        self.assertEqual(get_mutable_globs(self.run_dir), [])
+
+    def test_reflink(self):
+        stats = self.materialize('reflink')
+        self.check_contents()
+        # Mutable and PCE-written files are copied, others reflinked where
+        # supported, and never hardlinked.
+        self.assertEqual(stats['linked'], 0)
+        self.assertEqual(stats['reflinked'] + stats['copied'], 5)
+        self.assertTrue(stats['copied'] >= 2)
+        for rel in ['bin/onramp_run.py', 'src/ring.c']:
+            self.assertFalse(self.is_hardlinked(rel))
+
+    def test_reflink_fallback(self):
+        self.no_reflinks()
+        stats = self.materialize('reflink')
+        self.check_contents()
+        self.assertEqual(stats, {'reflinked': 0, 'linked': 0, 'copied': 5})
+
+    def test_hardlink(self):
+        self.no_reflinks()
+        stats = self.materialize('hardlink')
+        self.check_contents()
+        self.assertEqual(stats, {'reflinked': 0, 'linked': 3, 'copied': 2})
+        self.assertTrue(self.is_hardlinked('src/ring.c'))
+        self.assertFalse(self.is_hardlinked('src/input.dat'))
+        self.assertFalse(self.is_hardlinked('log/deploy.log'))
+
+    def test_hardlink_fallback(self):
+        self.no_reflinks()
+        self.no_hardlinks()
+        stats = self.materialize('hardlink')
+        self.check_contents()
+        self.assertEqual(stats, {'reflinked': 0, 'linked': 0, 'copied': 5})
+
+    def test_copy(self):
+        stats = self.materialize('copy')
+        self.check_contents()
+        self.assertEqual(stats, {'reflinked': 0, 'linked': 0, 'copied': 5})
+
+    def test_bad_link_mode(self):
+        self.assertRaises(ValueError, self.materialize, 'symlink')
+        self.assertFalse(os.path.exists(self.run_dir))
+
+    def test_share_file(self):
+        src = os.path.join(self.mod_dir, 'src/ring.c')
+        self.no_reflinks()
+        self.assertEqual(share_file(src, self.path('a'), link_mode='hardlink'),
+                         'linked')
+        self.assertEqual(share_file(src, self.path('b')), 'copied')
+        self.no_hardlinks()
+        self.assertEqual(share_file(src, self.path('c'), link_mode='hardlink'),
+                         'copied')
+        self.assertRaises(ValueError, share_file, src, self.path('d'),
+                          link_mode='symlink')
+
+
+class HooksTest(ToolsBase):
+
+    def setUp(self):
+        ToolsBase.setUp(self)
+        self.local_python = hooks._local_python
+        hooks._local_python = sys.executable
+        os.makedirs(self.path('bin'))
+        os.makedirs(self.path('log'))
+
+    def tearDown(self):
+        hooks._local_python = self.local_python
+        ToolsBase.tearDown(self)
+
+    def test_run_command(self):
+        usage = {}
+        code, output = run_command(['sh', '-c', 'pwd; echo err >&2; exit 3'],
+                                   self.tmp_dir, usage=usage)
+        self.assertEqual(code, 3)
+        self.assertEqual(output, '%s\nerr\n' % os.path.realpath(self.tmp_dir))
+        self.assertEqual(sorted(usage.keys()),
+                         ['max_rss', 'sys', 'user', 'wall'])
+        self.assertTrue(usage['max_rss'] > 0)
+        self.assertTrue(usage['wall'] >= 0)
+
+        # Exit statuses are mapped to -128 to 127.
+        code, output = run_command(['sh', '-c', 'exit 255'], self.tmp_dir)
+        self.assertEqual(code, -1)
+        self.assertRaises(OSError, run_command, [self.path('missing')],
+                          self.tmp_dir)
+
+    def test_timeout(self):
+        usage = {}
+        start = time.time()
+        try:
+            run_command(['sh', '-c', 'echo started; sleep 30 & sleep 30'],
+                        self.tmp_dir, timeout=1, usage=usage)
+        except HookTimeout as e:
+            self.assertEqual(e.timeout, 1)
+            self.assertEqual(e.output, 'started\n')
+        else:
+            self.fail('HookTimeout not raised')
+        # Not held up by the backgrounded sleep, which also holds the
+        # command's output pipe.
+        self.assertTrue(time.time() - start < 10)
+        self.assertTrue(usage['wall'] >= 1)
+
+        # A command that exits in time is not affected by the timeout.
+        self.assertEqual(run_command(['true'], self.tmp_dir, timeout=5),
+                         (0, ''))
+
+    def test_run_hook(self):
+        self.write(self.path('bin/onramp_deploy.py'),
+                   'import os\nprint(os.path.basename(os.getcwd()))\n')
+        usage = {}
+        code, output = run_hook(self.tmp_dir, 'bin/onramp_deploy.py',
+                                log_id='deploy', usage=usage)
+        self.assertEqual(code, 0)
+        self.assertEqual(output, '%s\n' % os.path.basename(self.tmp_dir))
+        self.assertTrue(usage['wall'] > 0)
+        with open(self.path('log/onramp_deploy.log')) as f:
+            log = f.read()
+        self.assertTrue(log.startswith('The following output was logged '))
+        self.assertTrue(log.endswith('\n\n' + output))
+
+    def test_add_usage(self):
+        totals = {}
+        add_usage(totals, 'deploy', {'wall': 1.5, 'user': 1.0, 'sys': .25,
+                                     'max_rss': 2048})
+        add_usage(totals, 'deploy', {'wall': .5, 'user': None, 'sys': None,
+                                     'max_rss': None})
+        add_usage(totals, 'status', {'wall': .1, 'user': .1, 'sys': .1,
+                                     'max_rss': 1024})
+        add_usage(totals, 'deploy', {'wall': 1.0, 'user': .5, 'sys': .25,
+                                     'max_rss': 1024})
+        self.assertEqual(totals, {
+            'deploy': {'count': 3, 'wall': 3.0, 'user': 1.5, 'sys': .5,
+                       'max_rss': 2048},
+            'status': {'count': 1, 'wall': .1, 'user': .1, 'sys': .1,
+                       'max_rss': 1024}
+        })
+
+
+class SchedulerStatusTest(ToolsBase):
+    """Tests answer scheduler commands from self.responses, by command name,
+    in place of running them.
+    """
+
+    def setUp(self):
+        ToolsBase.setUp(self)
+        self.call = schedulers._call
+        schedulers._call = self.fake_call
+        self.calls = []
+        self.responses = {}
+
+    def tearDown(self):
+        schedulers._call = self.call
+        ToolsBase.tearDown(self)
+
+    def fake_call(self, args, **kwargs):
+        """Return the response to args, raising it if an exception."""
+        self.calls.append(args)
+        response = self.responses[args[0]]
+        if callable(response):
+            response = response(args)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+    def failed(self, output):
+        return subprocess.CalledProcessError(1, 'cmd', output=output)
+
+    def scontrol(self, states):
+        """Return a fake scontrol answering for jobs with the given states."""
+        def scontrol(args):
+            num = int(args[3])
+            if num not in states:
+                return self.failed('slurm_load_jobs error: Invalid job id '
+                                   'specified')
+            return ('JobId=%d JobName=ring\n   JobState=%s Reason=None\n'
+                    % (num, states[num]))
+        return scontrol
+
+    def test_slurm_batch(self):
+        self.responses['squeue'] = '1 RUNNING\n2 PENDING\n'
+        self.responses['sacct'] = '3|COMPLETED\n3.batch|COMPLETED\n'
+        statuses = SLURMScheduler('SLURM').check_status_many([1, 2, 3])
+        self.assertEqual(statuses, {1: (0, 'Running'), 2: (0, 'Queued'),
+                                    3: (0, 'Done')})
+        self.assertEqual([args[0] for args in self.calls],
+                         ['squeue', 'sacct'])
+
+    def test_slurm_purged_without_accounting(self):
+        # squeue fails on the purged job 3, and sacct fails as accounting is
+        # disabled. Each job is then checked alone, so only the purged job
+        # fails.
+        self.responses['squeue'] = self.failed('slurm_load_jobs error: '
+                                               'Invalid job id specified')
+        self.responses['sacct'] = self.failed('sacct: error: Slurm '
+                                              'accounting storage is '
+                                              'disabled')
+        self.responses['scontrol'] = self.scontrol({1: 'RUNNING',
+                                                    2: 'COMPLETED'})
+        statuses = SLURMScheduler('SLURM').check_status_many([1, 2, 3])
+        self.assertEqual(statuses[1], (0, 'Running'))
+        self.assertEqual(statuses[2], (0, 'Done'))
+        self.assertEqual(statuses[3][0], -1)
+        self.assertEqual(sorted(args[3] for args in self.calls
+                                if args[0] == 'scontrol'), ['1', '2', '3'])
+
+    def test_pbs_failed_call(self):
+        # qstat failing without listing any job, as when the server is
+        # unreachable, checks each job alone.
+        self.responses['qstat'] = lambda args: (
+            self.failed('qstat: cannot connect to server') if len(args) > 3
+            else ('%s.fakehost  user  batch  ring  1  1  1  --  01:00  R  '
+                  '00:01\n' % args[2]))
+        statuses = PBSScheduler('PBS').check_status_many([1, 2])
+        self.assertEqual(statuses, {1: (0, 'Running'), 2: (0, 'Running')})
+
+
+class StreamLimitTest(ToolsBase):
+    """Tests call dispatchers directly, each call in a new CherryPy request."""
+
+    def setUp(self):
+        ToolsBase.setUp(self)
+        self.saved = dict((name, getattr(dispatchers, name)) for name in
+                          ['get_pce_config', 'get_job_output_file',
+                           'follow_job_output', '_open_streams'])
+        self.output_file = self.path('output.txt')
+        self.write(self.output_file, 'started\n')
+        dispatchers.get_pce_config = lambda: {'server': {'max_streams': 2}}
+        # Job 1 is running.
+        dispatchers.get_job_output_file = \
+            lambda job_id, element=None: (1, self.output_file)
+        dispatchers.follow_job_output = \
+            lambda job_id, offset=0, element=None: iter(['started\n'])
+        dispatchers._open_streams = 0
+        self.requests = []
+
+    def tearDown(self):
+        for name, value in self.saved.items():
+            setattr(dispatchers, name, value)
+        ToolsBase.tearDown(self)
+
+    def follow(self):
+        """Request to follow output of job 1 in a new request."""
+        request = Request(Host('127.0.0.1', 80), Host('127.0.0.1', 1234))
+        # Copied from the class when a request is run.
+        request.hooks = Request.hooks.copy()
+        cherrypy.serving.load(request, Response())
+        self.requests.append(request)
+        return dispatchers.JobOutput({}, 'onramp').GET('1', follow='1')
+
+    def end(self, request):
+        """Run the end of request hooks of a request, as when it ends."""
+        request.hooks.run('on_end_request')
+
+    def test_follow_output(self):
+        for i in range(2):
+            self.assertEqual(list(self.follow()), ['started\n'])
+            self.assertEqual(cherrypy.response.headers['Content-Type'],
+                             'text/plain')
+        self.assertEqual(dispatchers._open_streams, 2)
+
+        # Refused while max_streams are open.
+        self.assertEqual(self.follow(), 'Too many streams open')
+        self.assertEqual(cherrypy.response.status, 503)
+        self.assertEqual(cherrypy.response.headers['Retry-After'], '10')
+        self.end(self.requests[-1])
+        self.assertEqual(dispatchers._open_streams, 2)
+
+        # Allowed again once a follower disconnects.
+        self.end(self.requests[0])
+        self.assertEqual(dispatchers._open_streams, 1)
+        self.assertEqual(list(self.follow()), ['started\n'])
+        self.assertEqual(dispatchers._open_streams, 2)
+
+    def test_finished_output(self):
+        # Output of finished jobs is served at once and not counted.
+        dispatchers.get_job_output_file = \
+            lambda job_id, element=None: (0, self.output_file)
+        dispatchers._open_streams = 2
+        self.assertNotEqual(self.follow(), 'Too many streams open')
+        self.assertNotEqual(cherrypy.response.status, 503)
+        self.assertEqual(dispatchers._open_streams, 2)
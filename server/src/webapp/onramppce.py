@@ -116,7 +116,15 @@ class PCEAccess():
         headers = {"content-type": "application/json"}
         r = s.post(url, data=data, headers=headers)
 
-        if r.status_code != 200:
+        if r.status_code == 429:
+            # PCE work queue is full. The request may be retried later.
+            self._logger.warn('%s busy: 429 from POST %s, retry after %ss'
+                              % (self._name, url,
+                                 r.headers.get('Retry-After', '?')))
+            return False
+
+        # Launches, installs and deploys are queued and answered with 202.
+        if r.status_code not in (200, 202):
             self._logger.error('%s Error: %d from POST %s: %s'
                                % (self._name, r.status_code, url, r.text))
             return False
@@ -433,6 +441,52 @@ class PCEAccess():
 
         return True
 
+    def _fetch_job_output(self, job_id, output_file):
+        """Stream job output from the PCE to the local output.txt.
+
+        Output is only fetched if the saved copy does not match the sha256
+        digest given by the PCE.
+
+        Args:
+            job_id (int): Id of the job.
+            output_file (dict): output_file attr of the job as given by the PCE.
+
+        Returns:
+            'True' if the output is saved, 'False' if not.
+        """
+        prefix = ("%sfetch_job_output(%s)" % (self._name, str(job_id)))
+
+        job_dir = os.path.join(self._pce_job_dir, str(job_id))
+        if not os.path.exists(job_dir):
+            os.makedirs(job_dir)
+        output_path = os.path.join(job_dir, "output.txt")
+        digest_path = os.path.join(job_dir, "output.sha256")
+
+        if os.path.exists(output_path) and os.path.exists(digest_path):
+            with open(digest_path, 'r') as f:
+                if f.read().strip() == output_file['sha256']:
+                    return True
+
+        url = "%s/%s" % (self._url, output_file['url'])
+        self._logger.debug("%s Fetching %d bytes from %s"
+                           % (prefix, output_file['size'], url))
+        r = requests.get(url, stream=True)
+        if r.status_code != 200:
+            self._logger.error('%s Error: %d from GET %s'
+                               % (self._name, r.status_code, url))
+            return False
+
+        # Write to a temp file so a partial download is never used.
+        tmp_path = output_path + ".part"
+        with open(tmp_path, 'wb') as f:
+            for chunk in r.iter_content(64 * 1024):
+                f.write(chunk)
+        os.rename(tmp_path, output_path)
+        with open(digest_path, 'w') as f:
+            f.write(output_file['sha256'])
+
+        return True
+
     def get_job_output(self, job_id):
         prefix = ("%sget_job_output(%s)" % (self._name, str(job_id)))
         self._logger.debug("%s load Job output: %s" % (prefix, str(job_id)))
@@ -666,6 +720,8 @@ class PCEAccess():
 
         self._logger.debug("%s job RAW %s" % (prefix, str(job)))
         self._save_job_output( job["job_id"], job["output"] )
+        if job.get('output_file'):
+            self._fetch_job_output( job["job_id"], job["output_file"] )
 
         self._logger.debug("%s Response: ID = %d/%d, State = %s" 
                            % (prefix, job["job_id"], job_id, job["state"]) )